@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------------
+# Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+#
+# The MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# -----------------------------------------------------------------------------------
+
+import os
+import sys
+import imp
+import argparse
+
+# importing the hackathon package initializes the whole server: flask app, components and scheduled jobs. Register it
+# as a bare package instead, so that only the models and their dependencies are loaded. Mongoengine is connected by
+# hackathon.hmongo with the mongodb settings in config.py
+package = imp.new_module("hackathon")
+package.__path__ = [os.path.join(os.path.dirname(os.path.realpath(__file__)), "hackathon")]
+sys.modules["hackathon"] = package
+
+from hackathon.hmongo.index_checker import check_query_shapes, sync_indexes
+
+
+def check_indexes(sync=False):
+    """Report the hot query shapes that are not covered by index
+
+    Run it against a local mongod after changing queries or indexes in hackathon/hmongo/models.py. Indexes are created
+    automatically by mongoengine, but an index declared with new options conflicts with the existing one, use --sync
+    to drop the conflicting indexes and recreate them.
+    """
+    if sync:
+        for index in sync_indexes():
+            print "undeclared index: %s" % index
+
+    uncovered = check_query_shapes()
+    for description, problems in uncovered:
+        print "NOT COVERED: %s (%s)" % (description, ", ".join(problems))
+
+    if not uncovered:
+        print "all query shapes are covered by index"
+    return len(uncovered)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="report the query shapes that are not covered by index")
+    parser.add_argument("--sync", action="store_true", help="drop conflicting indexes and create declared ones first")
+    args = parser.parse_args()
+    exit(1 if check_indexes(args.sync) else 0)
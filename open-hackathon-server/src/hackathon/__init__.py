@@ -148,6 +148,7 @@ def init_components():
     from hackathon.template import TemplateLibrary
     from hackathon.remote.guacamole import GuacamoleInfo
     from hackathon.cache.cache_mgr import CacheManagerExt
+    from hackathon.provisioning_engine import ProvisioningEngine
 
     # dependencies MUST be provided in advance
     factory.provide("util", Utility)
@@ -159,12 +160,15 @@ def init_components():
     init_sms()
     factory.provide("email", Email)
 
-    # cache
-    factory.provide("cache", CacheManagerExt)
+    # cache. One instance per process so that in-memory cache is shared by all components
+    factory.provide("cache", CacheManagerExt())
 
     # scheduler
     factory.provide("scheduler", scheduler)
 
+    # one instance per process so that the provisioning steps in flight are shared by all experiment starters
+    factory.provide("provisioning_engine", ProvisioningEngine())
+
     # business components
     factory.provide("user_manager", UserManager)
     factory.provide("user_profile_manager", UserProfileManager)
@@ -193,6 +197,8 @@ def init_components():
     factory.provide("hosted_docker_proxy", get_class("hackathon.docker.hosted_docker.HostedDockerFormation"))
     factory.provide("alauda_docker_proxy", get_class("hackathon.docker.alauda_docker.AlaudaDockerFormation"))
     factory.provide("huawei_docker_proxy", get_class("hackathon.docker.huawei_cce_docker.HuaweiDockerFormation"))
+    factory.provide("image_puller", get_class("hackathon.docker.image_puller.ImagePuller"))
+    factory.provide("file_transfer", get_class("hackathon.docker.file_transfer.FileTransfer"))
 
     # storage
     init_hackathon_storage()
@@ -204,10 +210,11 @@ def init_db():
 
 
 def init_expr_components():
-    from expr import ExprManager, AzureVMExprStarter, AzureHostedDockerStarter, AlaudaDockerStarter
+    from expr import ExprManager, AzureVMExprStarter, AzureHostedDockerStarter, AlaudaDockerStarter, WarmPool
     from expr.huawei_expr_starter import HuaweiExprStarter
 
     factory.provide("expr_manager", ExprManager)
+    factory.provide("warm_pool", WarmPool)
     factory.provide("alauda_docker", AlaudaDockerStarter)
     factory.provide("azure_docker", AzureHostedDockerStarter)
     factory.provide("azure_vm", AzureVMExprStarter)
@@ -294,30 +301,66 @@ def __init_schedule_jobs():
         hackathon_manager = RequiredFeature("hackathon_manager")
         host_server_manager = RequiredFeature("docker_host_manager")
 
-        # schedule job to check recycle operation
+        # experiments are recycled at their expires_at, the job is a safety net which also arms the wake-up job
         next_run_time = util.get_now() + timedelta(seconds=10)
         sche.add_interval(feature="expr_manager",
                           method="scheduler_recycle_expr",
                           id="scheduler_recycle_expr",
                           next_run_time=next_run_time,
-                          minutes=10)
+                          minutes=safe_get_config("recycle.sweep_interval_minutes", 30))
 
         # schedule job to pre-allocate environment
         hackathon_manager.schedule_pre_allocate_expr_job()
 
-        # schedule job to pull docker images automatically
-        #if not safe_get_config("docker.alauda.enabled", False):
-        #     docker = RequiredFeature("hosted_docker_proxy")
-        #     docker.ensure_images()
+        # keep the container state index warm so that status polling of experiments won't wait for docker hosts. The
+        # index lives in every process
+        sche.add_interval(feature="hosted_docker_proxy",
+                          method="refresh_container_states",
+                          id="refresh_container_states",
+                          per_process=True,
+                          seconds=safe_get_config("docker.container_state.refresh_interval_seconds", 20))
+
+        # schedule jobs to pull docker images of online hackathons to their docker hosts
+        sche.add_interval(feature="hosted_docker_proxy",
+                          method="ensure_images",
+                          id="ensure_images",
+                          next_run_time=util.get_now() + timedelta(seconds=30),
+                          minutes=safe_get_config("docker.image_pull.interval_minutes", 60))
+
+        # resync host ports reserved on docker hosts with their containers to repair leaked reservations
+        sche.add_interval(feature="docker_host_manager",
+                          method="reconcile_docker_hosts",
+                          id="reconcile_docker_hosts",
+                          minutes=safe_get_config("docker.reconcile_interval_minutes", 10))
 
         # schedule job to pre-create a docker host server VM
         #host_server_manager.schedule_pre_allocate_host_server_job()
-    # init the overtime-sessions detection to update users' online status
+    # init the overtime-sessions detection to update users' online status. Operation times are kept per process
     sche.add_interval(feature="user_manager",
                       method="check_user_online_status",
                       id="check_user_online_status",
+                      per_process=True,
                       minutes=10)
 
+    # take over provisioning steps of dead processes
+    sche.add_interval(feature="provisioning_engine",
+                      method="resume_orphans",
+                      id="resume_provisioning_orphans",
+                      seconds=safe_get_config("provisioning.resume_interval_seconds", 60))
+
+    # recount hackathon stats to repair the drift of counters
+    sche.add_interval(feature="hackathon_manager",
+                      method="reconcile_hackathon_stats",
+                      id="reconcile_hackathon_stats",
+                      minutes=safe_get_config("stat.reconcile_interval_minutes", 60))
+
+    # write back the expire date of tokens that extended in cache. The extensions are kept per process
+    sche.add_interval(feature="user_manager",
+                      method="flush_token_expire_dates",
+                      id="flush_token_expire_dates",
+                      per_process=True,
+                      seconds=safe_get_config("login.token_cache.flush_interval_seconds", 30))
+
 
 def init_app():
     """Initialize the application.
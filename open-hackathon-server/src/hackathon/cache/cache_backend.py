@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+import abc
+import time
+import cPickle as pickle
+from collections import OrderedDict
+from threading import Lock
+
+from beaker.cache import CacheManager
+from beaker.util import parse_cache_config_options
+
+from hackathon.log import log
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+__all__ = [
+    "CacheBackend",
+    "FileCacheBackend",
+    "MemoryCacheBackend",
+    "RedisCacheBackend",
+    "TieredCacheBackend",
+]
+
+
+class CacheBackend(object):
+    """Base and abstract class for the storage of CacheManagerExt
+
+    Values passed in and returned are plain python objects. Every backend counts its hits, misses and evictions.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # "+=" is not atomic, the backend is called by request threads concurrently
+        self._counter_lock = Lock()
+
+    @abc.abstractmethod
+    def get(self, key):
+        """Get the value mapped to the key
+
+        :type key: str|unicode
+        :param key: the cache key
+
+        :rtype: tuple
+        :return (True, value) if key found and not expired, otherwise (False, None)
+        """
+        pass
+
+    @abc.abstractmethod
+    def set(self, key, value, expire):
+        """Map the value to the key
+
+        :type expire: int
+        :param expire: seconds before the key expires
+        """
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key):
+        pass
+
+    @abc.abstractmethod
+    def clear(self):
+        pass
+
+    def delete_local(self, key):
+        """Remove the key from storage of current process only. Called when another process invalidated the key"""
+        self.delete(key)
+
+    def clear_local(self):
+        """Clear storage of current process only. Called when another process cleared the cache"""
+        self.clear()
+
+    def stats(self):
+        """Return the hit/miss/eviction counters in dict"""
+        return {
+            "type": self.__class__.__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+    def _count(self, found):
+        with self._counter_lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+class FileCacheBackend(CacheBackend):
+    """The original beaker file cache. Values are pickled to data_dir and locked by files in lock_dir
+
+    More configuration refer to http://beaker.readthedocs.org/en/latest/caching.html#about
+    """
+
+    def __init__(self, data_dir="/tmp/cache/data", lock_dir="/tmp/cache/lock", expire=3600):
+        super(FileCacheBackend, self).__init__()
+        cache_opts = {
+            'cache.type': 'memory',
+            'cache.data_dir': data_dir,
+            'cache.lock_dir': lock_dir
+        }
+        manager = CacheManager(**parse_cache_config_options(cache_opts))
+        # values are saved as (fresh_until, value), use a new namespace to skip files written in old format
+        self.tmpl_cache = manager.get_cache('ohp_cache', type='file', expire=expire)
+
+    def get(self, key):
+        try:
+            value = self.tmpl_cache.get(key=key)
+            self._count(True)
+            return True, value
+        except KeyError:
+            self._count(False)
+            return False, None
+
+    def set(self, key, value, expire):
+        self.tmpl_cache.set_value(key, value, expiretime=expire)
+
+    def delete(self, key):
+        self.tmpl_cache.remove_value(key=key)
+
+    def clear(self):
+        self.tmpl_cache.clear()
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process LRU cache with per-key expiry and bounded entry count
+
+    Values are stored pickled so that every reader gets its own copy, the same as the file cache did. Callers are used
+    to modify what they get (for example the units of a TemplateContent), a shared instance would be polluted.
+    """
+
+    def __init__(self, capacity=1000, serialize=True):
+        super(MemoryCacheBackend, self).__init__()
+        self.capacity = capacity
+        self.serialize = serialize
+        # key -> (expire_at, value)
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self._count(False)
+                return False, None
+
+            # re-insert as most recently used
+            self.__entries[key] = entry
+            self._count(True)
+
+        value = entry[1]
+        return True, pickle.loads(value) if self.serialize else value
+
+    def set(self, key, value, expire):
+        if self.serialize:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (time.time() + expire, value)
+            while len(self.__entries) > self.capacity:
+                self.__entries.popitem(last=False)
+                with self._counter_lock:
+                    self.evictions += 1
+
+    def delete(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        stats = super(MemoryCacheBackend, self).stats()
+        stats["size"] = len(self.__entries)
+        stats["capacity"] = self.capacity
+        return stats
+
+
+class RedisCacheBackend(CacheBackend):
+    """Cache shared by all server processes, stored in redis
+
+    Keys are prefixed so that several environments can share one redis. Evictions are done by redis itself according
+    to its maxmemory-policy, so they are not counted here. Any redis error is treated as a miss so that the cache never
+    breaks the request.
+    """
+
+    def __init__(self, host="localhost", port=6379, db=0, prefix="ohp:"):
+        super(RedisCacheBackend, self).__init__()
+        if redis is None:
+            raise ImportError("redis is required by RedisCacheBackend, run 'pip install redis' first")
+
+        self.prefix = prefix
+        self.client = redis.StrictRedis(host=host, port=port, db=db, socket_timeout=1)
+
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except Exception as e:
+            log.error(e)
+            value = None
+
+        self._count(value is not None)
+        if value is None:
+            return False, None
+        return True, pickle.loads(value)
+
+    def set(self, key, value, expire):
+        try:
+            self.client.setex(self.prefix + key, int(expire), pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        except Exception as e:
+            log.error(e)
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception as e:
+            log.error(e)
+
+    def clear(self):
+        try:
+            keys = self.client.keys(self.prefix + "*")
+            if keys:
+                self.client.delete(*keys)
+        except Exception as e:
+            log.error(e)
+
+
+class TieredCacheBackend(CacheBackend):
+    """Two level cache: l1 is in-process, l2 is shared by processes and optional
+
+    Hits of l2 are copied to l1 so that the next read of the same key won't leave current process. The remaining time
+    to live in l2 is unknown, so copied values expire from l1 after 'promote_expire' seconds.
+    """
+
+    def __init__(self, l1, l2=None, promote_expire=60):
+        super(TieredCacheBackend, self).__init__()
+        self.l1 = l1
+        self.l2 = l2
+        self.promote_expire = promote_expire
+
+    def get(self, key):
+        found, value = self.l1.get(key)
+        if not found and self.l2:
+            found, value = self.l2.get(key)
+            if found:
+                self.l1.set(key, value, self.promote_expire)
+
+        self._count(found)
+        return found, value
+
+    def set(self, key, value, expire):
+        self.l1.set(key, value, expire)
+        if self.l2:
+            self.l2.set(key, value, expire)
+
+    def delete(self, key):
+        self.l1.delete(key)
+        if self.l2:
+            self.l2.delete(key)
+
+    def clear(self):
+        self.l1.clear()
+        if self.l2:
+            self.l2.clear()
+
+    def delete_local(self, key):
+        # l2 is shared and already updated by the process who published the invalidation
+        self.l1.delete(key)
+
+    def clear_local(self):
+        self.l1.clear()
+
+    def stats(self):
+        stats = super(TieredCacheBackend, self).stats()
+        stats["l1"] = self.l1.stats()
+        if self.l2:
+            stats["l2"] = self.l2.stats()
+        return stats
@@ -23,19 +23,71 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
-
-from beaker.cache import CacheManager
-from beaker.util import parse_cache_config_options
+import time
+from threading import Thread, Lock, Event
 
 from hackathon import Component
-
+from hackathon.util import safe_get_config
+from hackathon.constants import HEALTH_STATUS
+from cache_backend import FileCacheBackend, MemoryCacheBackend, RedisCacheBackend, TieredCacheBackend
+from invalidation_bus import CacheInvalidationBus
 
 __all__ = ["CacheManagerExt"]
 
 
+class Flight(object):
+    """An in-progress call of createfunc that other callers of the same key wait for"""
+
+    def __init__(self):
+        self.event = Event()
+        self.value = None
+        self.error = None
+        # set if the key is invalidated while createfunc is running, the result must not be cached then
+        self.invalidated = False
+
+
 class CacheManagerExt(Component):
-    """To cache resource"""
-    def get_cache(self, key, createfunc):
+    """To cache resource
+
+    The storage is configured by "cache.type" in config.py:
+        - "memory": in-process LRU cache, optionally backed by redis which is shared by all processes. Default.
+        - "file": the beaker file cache in /tmp/cache/data
+
+    Expire time can be configured per namespace by "cache.namespaces". Keys without namespace expire after
+    "cache.expire" seconds.
+
+    If "cache.invalidation.enabled", invalidate and clear are broadcast to all server processes through a MongoDB
+    capped collection, so that long expire time can be used without serving stale data from other processes.
+
+    On cache miss, only one caller per key in current process runs createfunc, others wait for its result. If a
+    namespace is configured in "cache.stale_while_revalidate", expired value keeps being returned for the configured
+    seconds while it's refreshed in background.
+
+    Example for config.py:
+    "cache": {
+        "type": "memory",
+        "capacity": 1000,
+        "expire": 3600,
+        "namespaces": {
+            "hackathon_stat": 10,
+            "hackathon_config": 3600
+        },
+        "stale_while_revalidate": {
+            "hackathon_stat": 30
+        },
+        "redis": {
+            "enabled": False,
+            "host": "localhost",
+            "port": 6379
+        },
+        "invalidation": {
+            "enabled": True,
+            "collection": "cache_invalidation"
+        }
+    }
+    """
+
+    def get_cache(self, key, createfunc, namespace=None):
         """Get cached data of the returns of createfunc depending on the key.
         If key and createfunc exist in cache, returns the cached data,
         otherwise caches the returns of createfunc and returns data.
@@ -47,15 +99,38 @@ class CacheManagerExt(Component):
         :param createfunc: only the name of function, have no parameters,
             its return type can be any basic object, like String, int, tuple, list, dict, etc.
 
+        :type namespace: String
+        :param namespace: namespace of the key that decides the expire time. see "cache.namespaces" in config.py
+
         :rtype: String
         :return: the value mapped to the key
 
         :example:
-            CacheManager.get_cache(key="abc", createfunc=func)
+            CacheManager.get_cache(key="abc", createfunc=func, namespace="hackathon_stat")
+
+        """
+        if self.bus:
+            self.bus.ensure_listening()
 
+        found, item = self.backend.get(key)
+        if found:
+            fresh_until, value = item
+            if fresh_until < time.time():
+                # stale but still in the revalidate window
+                self.__refresh_in_background(key, createfunc, namespace)
+            return value
+
+        return self.__create_once(key, createfunc, namespace)
+
+    def get_expire(self, namespace=None):
+        """Get the expire seconds of a namespace
+
+        :rtype: int
+        :return: seconds configured for the namespace, or the default expire time if namespace not configured
         """
-        results = self.tmpl_cache.get(key=key, createfunc=createfunc)
-        return results
+        if namespace and namespace in self.namespace_expires:
+            return self.namespace_expires[namespace]
+        return self.expire
 
     def invalidate(self, key):
         """remove the key-value pair in the cache
@@ -68,7 +143,10 @@ class CacheManagerExt(Component):
 
         """
         try:
-            self.tmpl_cache.remove_value(key=key)
+            self.__mark_invalidated(key)
+            self.backend.delete(key)
+            if self.bus:
+                self.bus.publish_invalidate(key)
             return True
         except Exception as e:
             self.log.error(e)
@@ -81,26 +159,139 @@ class CacheManagerExt(Component):
         :return: True if clear the cache correctly, otherwise False
         """
         try:
-            self.tmpl_cache.clear()
+            self.__mark_invalidated()
+            self.backend.clear()
+            if self.bus:
+                self.bus.publish_clear()
             return True
         except Exception as e:
             self.log.error(e)
             return False
 
+    def stats(self):
+        """Return the hit/miss/eviction counters of the cache
+
+        :rtype: dict
+        :return: counters of the backend. For "memory" cache, counters of l1 and l2 are included too
+        """
+        return self.backend.stats()
+
+    def report_health(self):
+        """Report the cache counters as a health check item"""
+        stats = self.stats()
+        stats["status"] = HEALTH_STATUS.OK
+        return stats
+
+    def __mark_invalidated(self, key=None):
+        """Tell the in-flight createfunc of key, or of all keys if key is None, not to cache its result"""
+        with self.__flight_lock:
+            flights = [self.__flights.get(key)] if key is not None else self.__flights.values()
+            for flight in flights:
+                if flight:
+                    flight.invalidated = True
+
+    def __on_remote_invalidate(self, key):
+        # shared backend like redis is cleaned by the process who published it
+        self.__mark_invalidated(key)
+        self.backend.delete_local(key)
+
+    def __on_remote_clear(self):
+        self.__mark_invalidated()
+        self.backend.clear_local()
+
+    def __create_once(self, key, createfunc, namespace):
+        """Call createfunc and cache the result. Concurrent callers of the same key wait for the first one"""
+        with self.__flight_lock:
+            flight = self.__flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = Flight()
+                self.__flights[key] = flight
+
+        if not is_leader:
+            if not flight.event.wait(self.flight_timeout):
+                self.log.warn("wait for cache key %s timeout, create it directly" % key)
+                return createfunc()
+            if flight.error:
+                raise flight.error
+
+            # read from cache again so that each caller gets its own copy like a cache hit
+            found, item = self.backend.get(key)
+            return item[1] if found else flight.value
+
+        return self.__lead(key, flight, createfunc, namespace)
+
+    def __lead(self, key, flight, createfunc, namespace):
+        """Run createfunc for the flight registered by the caller, then wake up the callers waiting for it"""
+        try:
+            flight.value = createfunc()
+            if not flight.invalidated:
+                self.__set(key, flight.value, namespace)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.__flight_lock:
+                self.__flights.pop(key, None)
+            flight.event.set()
+
+    def __refresh_in_background(self, key, createfunc, namespace):
+        # the flight is registered together with the check, so that concurrent readers of the stale value start one
+        # refresh only
+        with self.__flight_lock:
+            if key in self.__flights:
+                return
+            flight = Flight()
+            self.__flights[key] = flight
+
+        def refresh():
+            try:
+                self.__lead(key, flight, createfunc, namespace)
+            except Exception as e:
+                self.log.error(e)
+
+        t = Thread(target=refresh)
+        t.setDaemon(True)
+        t.start()
+
+    def __set(self, key, value, namespace):
+        """Save value together with the time it turns stale. It's kept in backend until the revalidate window ends"""
+        expire = self.get_expire(namespace)
+        stale = self.stale_seconds.get(namespace, 0) if namespace else 0
+        self.backend.set(key, (time.time() + expire, value), expire + stale)
+
     def __init__(self):
         """initialize the class CacheManager
-        More configuration refer to http://beaker.readthedocs.org/en/latest/caching.html#about
+
+        Note that the instance is shared by the whole process, see init_components in hackathon/__init__.py
         """
-        # store the basic configuration
-        self.cache_opts = {
-            'cache.type': 'memory',
-            # can be "memory" or "file"
-            'cache.data_dir': '/tmp/cache/data',
-            'cache.lock_dir': '/tmp/cache/lock'
-        }
-        # create CacheManager instance with cache_opts
-        self.cache = CacheManager(**parse_cache_config_options(self.cache_opts))
-        # In addition to the defaults supplied to the CacheManager instance,
-        # any of the Cache options can be changed on a per-namespace basis,
-        # by setting a type, and expire option.
-        self.tmpl_cache = self.cache.get_cache('mytemplate', type='file', expire=3600)
+        self.expire = safe_get_config("cache.expire", 3600)
+        self.namespace_expires = safe_get_config("cache.namespaces", {})
+        self.stale_seconds = safe_get_config("cache.stale_while_revalidate", {})
+        self.flight_timeout = safe_get_config("cache.single_flight_timeout", 60)
+        self.__flights = {}
+        self.__flight_lock = Lock()
+
+        cache_type = safe_get_config("cache.type", "memory")
+        if cache_type == "file":
+            self.backend = FileCacheBackend(data_dir=safe_get_config("cache.data_dir", "/tmp/cache/data"),
+                                            lock_dir=safe_get_config("cache.lock_dir", "/tmp/cache/lock"),
+                                            expire=self.expire)
+        else:
+            l1 = MemoryCacheBackend(capacity=safe_get_config("cache.capacity", 1000))
+            l2 = None
+            if safe_get_config("cache.redis.enabled", False):
+                l2 = RedisCacheBackend(host=safe_get_config("cache.redis.host", "localhost"),
+                                       port=safe_get_config("cache.redis.port", 6379),
+                                       db=safe_get_config("cache.redis.db", 0))
+            self.backend = TieredCacheBackend(l1, l2, promote_expire=safe_get_config("cache.redis.promote_expire", 60))
+
+        self.bus = None
+        if safe_get_config("cache.invalidation.enabled", False):
+            self.bus = CacheInvalidationBus(self.db,
+                                            on_invalidate=self.__on_remote_invalidate,
+                                            on_clear=self.__on_remote_clear,
+                                            collection=safe_get_config("cache.invalidation.collection",
+                                                                       "cache_invalidation"),
+                                            size=safe_get_config("cache.invalidation.size", 1024 * 1024))
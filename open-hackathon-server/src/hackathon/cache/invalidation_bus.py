@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+import os
+import time
+import socket
+import uuid
+from threading import Thread, Lock
+
+from pymongo import CursorType
+from pymongo.errors import CollectionInvalid
+
+from hackathon.log import log
+from hackathon.util import get_now
+
+__all__ = ["CacheInvalidationBus"]
+
+# message types
+INVALIDATE = "invalidate"
+CLEAR = "clear"
+
+
+class CacheInvalidationBus(object):
+    """Broadcast cache invalidations to all server processes through a MongoDB capped collection
+
+    Every process tails the capped collection with a tailable cursor in a daemon thread. When a key is invalidated in
+    one process, a message is inserted and all other processes drop the key from their in-process cache.
+
+    The listener thread is started lazily and restarted after fork, so it works for both pre-fork servers(uwsgi,
+    gunicorn) and the flask dev server.
+
+    :Example:
+        bus = CacheInvalidationBus(db, on_invalidate=lambda key: ..., on_clear=lambda: ...)
+        bus.publish_invalidate("__template__1__")
+    """
+
+    def __init__(self, db, on_invalidate, on_clear, collection="cache_invalidation", size=1024 * 1024):
+        """
+        :type db: pymongo.database.Database
+        :param db: the database where capped collection is created
+
+        :type on_invalidate: function
+        :param on_invalidate: function(key) called when another process invalidates a key
+
+        :type on_clear: function
+        :param on_clear: function() called when another process clears the cache
+
+        :type size: int
+        :param size: size in bytes of the capped collection
+        """
+        self.db = db
+        self.on_invalidate = on_invalidate
+        self.on_clear = on_clear
+        self.collection_name = collection
+        self.size = size
+
+        self.__pid = None
+        self.__origin = None
+        self.__lock = Lock()
+
+        self.__collection_ready = False
+        try:
+            self.__ensure_collection()
+        except Exception as e:
+            # retried by publish and the listener
+            log.error(e)
+
+    def publish_invalidate(self, key):
+        self.__publish(INVALIDATE, key)
+
+    def publish_clear(self):
+        self.__publish(CLEAR)
+
+    def ensure_listening(self):
+        """Start the listener thread if it's not started in current process"""
+        if self.__pid == os.getpid():
+            return
+
+        with self.__lock:
+            if self.__pid == os.getpid():
+                return
+
+            self.__pid = os.getpid()
+            self.__origin = "%s:%d:%s" % (socket.gethostname(), self.__pid, uuid.uuid4().hex[:8])
+            t = Thread(target=self.__listen, name="cache-invalidation-bus")
+            t.setDaemon(True)
+            t.start()
+
+    def __publish(self, message_type, key=None):
+        self.ensure_listening()
+        try:
+            self.__ensure_collection()
+            self.db[self.collection_name].insert_one({
+                "type": message_type,
+                "key": key,
+                "origin": self.__origin,
+                "create_time": get_now()})
+        except Exception as e:
+            # other processes will get the new value after expiry at most
+            log.error(e)
+
+    def __ensure_collection(self):
+        """Create the capped collection unless it exists. Done once per process unless MongoDB fails"""
+        if self.__collection_ready:
+            return
+
+        try:
+            if self.collection_name not in self.db.collection_names():
+                self.db.create_collection(self.collection_name, capped=True, size=self.size)
+                # tailable cursor on empty collection is dead immediately, insert a placeholder
+                self.db[self.collection_name].insert_one({"type": "init", "create_time": get_now()})
+        except CollectionInvalid:
+            pass  # created by another process meanwhile
+        self.__collection_ready = True
+
+    def __listen(self):
+        """Tail the capped collection and dispatch messages of other processes. Reconnect on any error"""
+        last_id = None
+        retry_seconds = 1
+        while True:
+            try:
+                self.__ensure_collection()
+                collection = self.db[self.collection_name]
+                if last_id is None:
+                    # skip all messages published before current process started
+                    latest = list(collection.find().sort("$natural", -1).limit(1))
+                    last_id = latest[0]["_id"] if latest else None
+
+                query = {"_id": {"$gt": last_id}} if last_id else {}
+                cursor = collection.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for message in cursor:
+                        last_id = message["_id"]
+                        self.__dispatch(message)
+                    retry_seconds = 1
+            except Exception as e:
+                log.error(e)
+                retry_seconds = min(retry_seconds * 2, 60)
+
+            time.sleep(retry_seconds)
+
+    def __dispatch(self, message):
+        if message.get("origin") == self.__origin:
+            return
+
+        try:
+            if message["type"] == INVALIDATE:
+                self.on_invalidate(message["key"])
+            elif message["type"] == CLEAR:
+                self.on_clear()
+        except Exception as e:
+            log.error(e)
@@ -47,10 +47,19 @@ Config = {
         "port": MONGODB_PORT
     },
     "login": {
-        "token_valid_time_minutes": 60
+        "token_valid_time_minutes": 60,
+        "token_cache": {
+            "capacity": 10000,
+            "ttl_seconds": 60,
+            "flush_interval_seconds": 30,
+            # logout is broadcast through this capped collection if "cache.invalidation.enabled"
+            "invalidation_collection": "token_invalidation"
+        }
     },
     "azure": {
         "cert_base": "",
+        # assigned public endpoints of a cloud service are cached and refreshed after seconds below
+        "endpoint_cache_seconds": 60
     },
     "guacamole": {
         "host": "http://localhost:8080"
@@ -62,7 +71,90 @@ Config = {
         "database": MONGODB_DB,
         "collection": "jobs",
         "host": MONGODB_HOST,
-        "port": MONGODB_PORT
+        "port": MONGODB_PORT,
+        # thread pool of jobs in job store above
+        "durable_workers": 10,
+        # one-off jobs like polls are kept in memory unless they ask to be durable
+        "transient_workers": 20,
+        # pending one-off jobs in memory, more are rejected
+        "transient_capacity": 1000,
+        # durable jobs are leased in mongodb so that a job runs once in the cluster even if every process schedules it
+        "lease": {
+            "enabled": True,
+            # a one-off job won't be run again by another process within the lease
+            "one_off_seconds": 600,
+            # a tick of interval job is leased for (interval - margin) seconds
+            "tick_margin_seconds": 5
+        }
+    },
+    "cache": {
+        # "memory" for in-process LRU cache(optionally backed by redis), "file" for beaker file cache
+        "type": "memory",
+        "capacity": 1000,
+        "expire": 3600,
+        "namespaces": {
+            "hackathon_stat": 10,
+            "hackathon_config": 3600
+        },
+        # serve expired value for extra seconds while it's refreshed in background
+        "stale_while_revalidate": {
+            "hackathon_stat": 30
+        },
+        "single_flight_timeout": 60,
+        "redis": {
+            "enabled": False,
+            "host": "localhost",
+            "port": 6379,
+            "db": 0,
+            "promote_expire": 60
+        },
+        # broadcast invalidations to all server processes through a capped collection of mongodb
+        "invalidation": {
+            "enabled": True,
+            "collection": "cache_invalidation",
+            "size": 1024 * 1024
+        }
+    },
+    "health": {
+        # health items are checked concurrently, items without response before the deadline are reported as timeout
+        "max_workers": 8,
+        "timeout_seconds": 10,
+        "cache_seconds": 10,
+        "docker_ping_workers": 16,
+        "docker_ping_timeout_seconds": 5
+    },
+    "provisioning": {
+        # steps of starting/stopping experiments are polled in a worker pool and checkpointed on transitions only
+        "max_workers": 8,
+        "lease_grace_seconds": 60,
+        "resume_interval_seconds": 60,
+        # a step raising exceptions this many times in a row fails like a timeout
+        "max_step_errors": 3
+    },
+    "recycle": {
+        # experiments are recycled at their expires_at in batches, see "recycle_minutes" of hackathon config
+        "batch_size": 50,
+        "max_workers": 4,
+        "sweep_interval_minutes": 30
+    },
+    "warm_pool": {
+        # idle experiments are pre-started per hackathon and template, see "pre_allocate_number" of hackathon config
+        "fill_workers": 8,
+        # default of "pre_allocate_concurrency" of hackathon config
+        "max_starting": 5,
+        # a pool is filled by one process at a time, leased until the experiments to start are saved
+        "fill_lease_seconds": 600
+    },
+    "stat": {
+        # hackathon stats are counted incrementally and recounted periodically to repair drift
+        "reconcile_interval_minutes": 60
+    },
+    "template": {
+        # templates are kept on local disk by content hash, remote storage is revalidated by ETag/If-Modified-Since
+        "store_dir": "/tmp/hackathon/templates",
+        "fetch_timeout_seconds": 10,
+        # count of compiled templates kept in memory, shared by all experiments of the same template version
+        "compiled_capacity": 100
     },
     "storage": {
         "type": "local",
@@ -80,6 +172,39 @@ Config = {
         }
     },
     "docker": {
+        # how to select docker host for new container: "most_free", "least_loaded" or "bin_pack"
+        "host_placement": "most_free",
+        # reservations on docker hosts are resynced with their containers periodically to repair leaks
+        "reconcile_interval_minutes": 10,
+        # http client of docker remote api, one connection pool per docker host
+        "client": {
+            "pool_size": 10,
+            "connect_timeout_seconds": 3,
+            "read_timeout_seconds": 60,
+            # retries of idempotent requests(GET, DELETE) on connection error, timeout or 5xx
+            "retries": 2,
+            "backoff_seconds": 0.5
+        },
+        # running state of containers is listed per host instead of inspected per container
+        "container_state": {
+            "max_age_seconds": 30,
+            "refresh_interval_seconds": 20
+        },
+        # images of hackathon templates are pulled to docker hosts ahead, each (host, image) once
+        "image_pull": {
+            "max_workers": 8,
+            "per_host": 2,
+            "interval_minutes": 60,
+            "lease_seconds": 600,
+            "progress_interval_seconds": 2,
+            # a failed pull is retried after the backoff, doubled on every failure up to the max
+            "retry_backoff_seconds": 60,
+            "retry_max_backoff_seconds": 3600
+        },
+        # guacctl is put into containers by docker archive API, or uploaded over SSH on docker hosts before docker 1.8
+        "file_transfer": {
+            "ssh_timeout_seconds": 10
+        },
         "alauda": {
             "token": "",
             "namespace": "",
@@ -72,9 +72,13 @@ class HACKATHON_STAT:
     Attributes:
         LIKE: number of user that likes a hackathon
         REGISTER: number of registered users
+        ONLINE: number of registered users that are online
+        TEAM: number of teams
     """
     LIKE = "like"
     REGISTER = "register"
+    ONLINE = "online"
+    TEAM = "team"
 
 
 class HACKATHON_CONFIG:
@@ -89,6 +93,7 @@ class HACKATHON_CONFIG:
         PRE_ALLOCATE_ENABLED: bool, whether to pre-start several environment. default false
         PRE_ALLOCATE_NUMBER: int, the maximum count of pre-start environment per hackathon and per template. default 1
         PRE_ALLOCATE_INTERVAL_SECONDS: int, interval seconds for pre-allocate job
+        PRE_ALLOCATE_CONCURRENCY: int, the maximum count of pre-start environment starting at the same time per template
         ALAUDA_ENABLED: bool,default false, whether to use alauda service, no azure resource needed if true
         FREEDOM_TEAM: bool,default true,Whether to allow freedom of the team
     """
@@ -99,6 +104,7 @@ class HACKATHON_CONFIG:
     PRE_ALLOCATE_ENABLED = "pre_allocate_enabled"
     PRE_ALLOCATE_NUMBER = "pre_allocate_number"
     PRE_ALLOCATE_INTERVAL_SECONDS = "pre_allocate_interval_second"
+    PRE_ALLOCATE_CONCURRENCY = "pre_allocate_concurrency"
     FREEDOM_TEAM = "freedom_team"
     CLOUD_PROVIDER = "cloud_provider"
     DEV_PLAN_REQUIRED = "dev_plan_required"
@@ -336,6 +342,22 @@ class DockerHostServerStatus:
     UNAVAILABLE = 3
 
 
+class DockerImageStatus:
+    """
+    Status of docker image on docker host, see model HostImage
+
+    Attributes:
+        PULLING: image is being pulled by a server process
+        READY: image exists on docker host
+        FAILED: the last pull failed
+        MISSING: image was ready but removed from docker host later
+    """
+    PULLING = 0
+    READY = 1
+    FAILED = 2
+    MISSING = 3
+
+
 class DHS_QUERY_STATE:
     """state to indicate the progress when query available docker host server"""
     SUCCESS = 0
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+
+sys.path.append("..")
+
+import json
+import zlib
+import base64
+import cPickle as pickle
+from datetime import datetime
+
+from bson import ObjectId
+
+from context import Context
+
+__all__ = ["encode_context", "decode_context"]
+
+# first byte of encoded data. Pickles never start with it, so the data saved before the codec can still be decoded
+CODEC_VERSION = "\x01"
+
+# tags of values that JSON cannot represent. A JSON object without tag is a Context
+TAG_DICT = "$dict"
+TAG_OID = "$oid"
+TAG_DATE = "$date"
+TAG_BYTES = "$bytes"
+TAG_PICKLE = "$pickle"
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def encode_context(context):
+    """Serialize a Context into compact bytes for job stores and checkpoints
+
+    Format version 1 is zlib compressed JSON. Contexts, lists, strings, numbers, ObjectIds and datetimes are stored
+    natively; other objects(e.g. models of azure SDK) are pickled as the last resort.
+
+    :type context: Context
+    :param context: the context to encode, nested Contexts/lists/dicts are supported
+
+    :rtype: str
+    :return: the encoded bytes
+    """
+    data = json.dumps(_to_json(context), separators=(",", ":"))
+    return CODEC_VERSION + zlib.compress(data)
+
+
+def decode_context(data):
+    """Deserialize bytes returned by encode_context, or a pickled Context saved before the codec
+
+    :type data: str
+    :param data: the encoded bytes
+
+    :rtype: Context
+    """
+    data = str(data)
+    if not data.startswith(CODEC_VERSION):
+        return pickle.loads(data)
+
+    return _from_json(json.loads(zlib.decompress(data[len(CODEC_VERSION):])))
+
+
+def _to_json(value):
+    if value is None or isinstance(value, (bool, int, long, float, unicode)):
+        return value
+    if isinstance(value, str):
+        try:
+            return value.decode("utf-8")
+        except UnicodeDecodeError:
+            return {TAG_BYTES: base64.b64encode(value)}
+    if isinstance(value, Context):
+        return dict((k, _to_json(v)) for k, v in value.to_dict().iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, dict) and all(isinstance(k, basestring) for k in value):
+        return {TAG_DICT: dict((k, _to_json(v)) for k, v in value.iteritems())}
+    if isinstance(value, ObjectId):
+        return {TAG_OID: str(value)}
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return {TAG_DATE: value.strftime(DATE_FORMAT)}
+
+    return {TAG_PICKLE: base64.b64encode(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))}
+
+
+def _from_json(value):
+    if isinstance(value, list):
+        return [_from_json(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+
+    if len(value) == 1:
+        tag, tagged = value.items()[0]
+        if tag == TAG_DICT:
+            return dict((k, _from_json(v)) for k, v in tagged.iteritems())
+        elif tag == TAG_OID:
+            return ObjectId(tagged)
+        elif tag == TAG_DATE:
+            return datetime.strptime(tagged, DATE_FORMAT)
+        elif tag == TAG_BYTES:
+            return base64.b64decode(tagged)
+        elif tag == TAG_PICKLE:
+            return pickle.loads(base64.b64decode(tagged))
+
+    return Context(**dict((k, _from_json(v)) for k, v in value.iteritems()))
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+import time
+from threading import Lock
+
+__all__ = ["ContainerStateIndex"]
+
+
+class ContainerStateIndex(object):
+    """In-process index of container running states, refreshed by host
+
+    Each docker host has a snapshot: the running state of all its containers listed by one '/containers/json?all=1'
+    call, and the time it's taken. Lookups are answered from snapshots not older than 'max_age_seconds' so that status
+    polling costs one request per host instead of one per container. Unknown containers and stale snapshots return None
+    and the caller is supposed to refresh the snapshot or inspect the container.
+
+    :Example:
+        index = ContainerStateIndex(max_age_seconds=30)
+        index.update(host_id, {container_id: True})
+        index.get(host_id, container_id)  # True
+    """
+
+    def __init__(self, max_age_seconds=30):
+        self.max_age_seconds = max_age_seconds
+        # host key -> (refreshed_at, {container id: running})
+        self.__snapshots = {}
+        # host key -> lock that makes concurrent refreshes of the same host wait for one request
+        self.__host_locks = {}
+        self.__lock = Lock()
+
+    def get(self, host_key, container_id):
+        """Return the running state of a container
+
+        :rtype: bool
+        :return True if running or restarting, False if not, None if unknown or the snapshot of its host is stale
+        """
+        snapshot = self.__snapshots.get(host_key)
+        if snapshot is None or snapshot[0] + self.max_age_seconds < time.time():
+            return None
+        return snapshot[1].get(container_id)
+
+    def is_fresh(self, host_key):
+        snapshot = self.__snapshots.get(host_key)
+        return snapshot is not None and snapshot[0] + self.max_age_seconds >= time.time()
+
+    def update(self, host_key, states, refreshed_at=None):
+        """Replace the snapshot of a docker host
+
+        :type states: dict
+        :param states: container id -> running state of all containers on the host
+
+        :type refreshed_at: float
+        :param refreshed_at: the time.time() before the list request was sent, now by default
+        """
+        self.__snapshots[host_key] = (refreshed_at or time.time(), states)
+
+    def forget(self, host_key, container_id):
+        """Drop the state of a container, for example after it's started or stopped by us"""
+        snapshot = self.__snapshots.get(host_key)
+        if snapshot:
+            snapshot[1].pop(container_id, None)
+
+    def host_lock(self, host_key):
+        with self.__lock:
+            return self.__host_locks.setdefault(host_key, Lock())
+
+    def clear(self):
+        self.__snapshots.clear()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+import time
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+
+from hackathon.log import log
+from hackathon.util import safe_get_config
+
+__all__ = ["DockerClient", "get_docker_client", "get_docker_clients_stats"]
+
+# calls that can be sent again safely if the connection fails
+IDEMPOTENT_METHODS = ["GET", "HEAD", "DELETE"]
+
+
+class DockerClient(object):
+    """HTTP client of the docker remote API on one docker host
+
+    Connections are kept alive in a bounded pool, a request waits for a free connection once the pool is used up
+    instead of opening a new one. Every request has connect/read timeouts. Idempotent requests are retried with
+    exponential backoff on connection errors, timeouts and 5xx responses.
+
+    Don't create it directly, use get_docker_client(docker_host) so that all components share one pool per host.
+
+    :Example:
+        client = get_docker_client(docker_host)
+        resp = client.get("/containers/json")
+    """
+
+    def __init__(self, base_url, pool_size=10, connect_timeout=3, read_timeout=60, retries=2, backoff_seconds=0.5):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_seconds = backoff_seconds
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.requests = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.__lock = Lock()
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def request(self, method, path, retry=True, **kwargs):
+        """Send request to docker host
+
+        :type method: str|unicode
+        :param method: http method
+
+        :type path: str|unicode
+        :param path: path of the docker remote API, e.g. '/containers/json'
+
+        :type retry: bool
+        :param retry: whether to retry an idempotent request on failure
+
+        :param kwargs: other args of requests, 'timeout' overwrites the default connect/read timeouts
+
+        :rtype: requests.Response
+        :return the response of last attempt
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        attempts = 1 + self.retries if retry and method in IDEMPOTENT_METHODS else 1
+
+        for attempt in range(attempts):
+            start = time.time()
+            try:
+                resp = self.session.request(method, self.base_url + path, **kwargs)
+                failed = resp.status_code >= 500
+                self.__record(time.time() - start, failed)
+                if not failed or attempt + 1 == attempts:
+                    return resp
+            except (ConnectionError, Timeout) as e:
+                self.__record(time.time() - start, True)
+                if attempt + 1 == attempts:
+                    raise
+                log.debug("%s %s%s failed: %s, will retry" % (method, self.base_url, path, e))
+
+            time.sleep(self.backoff_seconds * (2 ** attempt))
+
+    def stats(self):
+        """Return the request/error counters and latency in seconds"""
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "avg_seconds": round(self.total_seconds / self.requests, 3) if self.requests else 0,
+            "max_seconds": round(self.max_seconds, 3)
+        }
+
+    def __record(self, seconds, failed):
+        with self.__lock:
+            self.requests += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            if failed:
+                self.errors += 1
+
+
+# base url -> DockerClient, shared by the whole process
+docker_clients = {}
+docker_clients_lock = Lock()
+
+
+def get_docker_client(docker_host):
+    """Get the shared client of a docker host
+
+    :type docker_host: DockerHostServer
+    :param docker_host: the docker host
+
+    :rtype: DockerClient
+    """
+    base_url = 'http://%s:%d' % (docker_host.public_dns, docker_host.public_docker_api_port)
+    client = docker_clients.get(base_url)
+    if client is None:
+        with docker_clients_lock:
+            client = docker_clients.get(base_url)
+            if client is None:
+                client = DockerClient(base_url,
+                                      pool_size=safe_get_config("docker.client.pool_size", 10),
+                                      connect_timeout=safe_get_config("docker.client.connect_timeout_seconds", 3),
+                                      read_timeout=safe_get_config("docker.client.read_timeout_seconds", 60),
+                                      retries=safe_get_config("docker.client.retries", 2),
+                                      backoff_seconds=safe_get_config("docker.client.backoff_seconds", 0.5))
+                docker_clients[base_url] = client
+    return client
+
+
+def get_docker_clients_stats():
+    """Return the stats of all docker clients in dict keyed by the url of docker host"""
+    return dict((url, client.stats()) for url, client in docker_clients.items())
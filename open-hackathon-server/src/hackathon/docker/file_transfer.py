@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+import tarfile
+import time
+from cStringIO import StringIO
+from os.path import abspath, dirname, realpath
+from threading import Lock
+
+import pexpect
+
+from hackathon import Component
+from hackathon.util import safe_get_config
+from docker_client import get_docker_client
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+__all__ = ["FileTransfer"]
+
+GUACCTL_LOCAL_PATH = abspath("%s/../expr/guacctl.sh" % dirname(realpath(__file__)))
+GUACCTL_REMOTE_DIR = "/usr/local/sbin"
+GUACCTL_NAME = "guacctl"
+
+# the tar archive of guacctl is built once per process
+guacctl_archive = None
+guacctl_archive_lock = Lock()
+
+
+def get_guacctl_archive():
+    """Return the uncompressed tar archive that contains guacctl as an executable"""
+    global guacctl_archive
+    if guacctl_archive is None:
+        with guacctl_archive_lock:
+            if guacctl_archive is None:
+                with open(GUACCTL_LOCAL_PATH, "rb") as f:
+                    content = f.read()
+
+                buf = StringIO()
+                tar = tarfile.open(fileobj=buf, mode="w")
+                info = tarfile.TarInfo(GUACCTL_NAME)
+                info.size = len(content)
+                info.mode = 0755
+                info.mtime = time.time()
+                tar.addfile(info, StringIO(content))
+                tar.close()
+                guacctl_archive = buf.getvalue()
+    return guacctl_archive
+
+
+class FileTransfer(Component):
+    """Copy files like guacctl into docker containers
+
+    Files are injected through the archive API of docker remote API(requires docker 1.8+) right after the container is
+    created, which costs one http request on the pooled docker client. Copying over SSH into the running container is
+    the fallback for docker hosts without the archive API: in process by paramiko if it's installed, otherwise by scp.
+    """
+
+    def inject_guacctl(self, docker_host, container_id):
+        """Put guacctl into a created container before it's started
+
+        :type docker_host: DockerHostServer
+        :param docker_host: the docker host where the container is created
+
+        :type container_id: str|unicode
+        :param container_id: id of the container
+
+        :rtype: bool
+        :return: True if guacctl is injected, False if it should be uploaded over SSH later
+        """
+        try:
+            return self.put_archive(docker_host, container_id, GUACCTL_REMOTE_DIR, get_guacctl_archive())
+        except Exception as e:
+            self.log.error(e)
+            return False
+
+    def put_archive(self, docker_host, container_id, path, archive):
+        """Extract a tar archive into a directory of container
+
+        :type path: str|unicode
+        :param path: directory inside container, it must exist
+
+        :type archive: str
+        :param archive: content of uncompressed tar archive
+
+        :rtype: bool
+        :return: True if extracted
+        """
+        resp = get_docker_client(docker_host).request("PUT",
+                                                      "/containers/%s/archive?path=%s" % (container_id, path),
+                                                      data=archive,
+                                                      headers={"content-type": "application/x-tar"})
+        if resp.status_code != 200:
+            self.log.debug("cannot put archive into container %s: %d %s" % (container_id, resp.status_code,
+                                                                              resp.content))
+            return False
+        return True
+
+    def upload_guacctl(self, remote):
+        """Upload guacctl into a running container over SSH
+
+        :type remote: dict
+        :param remote: remote parameters of virtual environment, with keys hostname, port, username and password
+        """
+        remote_path = "%s/%s" % (GUACCTL_REMOTE_DIR, GUACCTL_NAME)
+        if paramiko is not None:
+            self.__sftp_put(remote, GUACCTL_LOCAL_PATH, remote_path)
+        else:
+            self.__scp_put(remote, GUACCTL_LOCAL_PATH, remote_path)
+
+    def __sftp_put(self, remote, local_path, remote_path):
+        timeout = safe_get_config("docker.file_transfer.ssh_timeout_seconds", 10)
+        client = paramiko.SSHClient()
+        # containers are created on the fly, there is no known host key to verify against
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(remote["hostname"],
+                           port=int(remote["port"]),
+                           username=remote["username"],
+                           password=remote["password"],
+                           timeout=timeout,
+                           allow_agent=False,
+                           look_for_keys=False)
+            sftp = client.open_sftp()
+            try:
+                sftp.put(local_path, remote_path)
+                sftp.chmod(remote_path, 0755)
+            finally:
+                sftp.close()
+        finally:
+            client.close()
+
+    def __scp_put(self, remote, local_path, remote_path):
+        p = pexpect.spawn("scp -P %s %s %s@%s:%s" %
+                          (remote["port"],
+                           local_path,
+                           remote["username"],
+                           remote["hostname"],
+                           remote_path))
+        i = p.expect([pexpect.TIMEOUT, 'yes/no', 'password: '])
+        if i == 1:
+            p.sendline("yes")
+            i = p.expect([pexpect.TIMEOUT, 'password:'])
+
+        if i != 0:
+            p.sendline(remote["password"])
+            p.expect(pexpect.EOF)
+        p.close()
@@ -33,18 +33,31 @@ sys.path.append("..")
 from compiler.ast import flatten
 from threading import Lock
 import json
-import requests
+import time
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from hackathon import RequiredFeature, Component, Context
-from hackathon.hmongo.models import DockerContainer, DockerHostServer
-from hackathon.constants import HEALTH, HEALTH_STATUS, HACKATHON_CONFIG, CLOUD_PROVIDER
+from hackathon.hmongo.models import DockerContainer, DockerHostServer, Hackathon
+from hackathon.constants import HEALTH, HEALTH_STATUS, HACKATHON_CONFIG, CLOUD_PROVIDER, HACK_STATUS
+from hackathon.util import safe_get_config
+from docker_client import get_docker_client, get_docker_clients_stats
+from container_state_index import ContainerStateIndex
+
+# hosts are requested concurrently by health check and container state refresh so that hosts down won't add up their
+# timeouts
+ping_executor = ThreadPoolExecutor(max_workers=safe_get_config("health.docker_ping_workers", 16))
+
+# running state of containers of all hosts, shared by all instances in current process
+container_state_index = ContainerStateIndex(
+    max_age_seconds=safe_get_config("docker.container_state.max_age_seconds", 30))
 
 
 class HostedDockerFormation(Component):
     hackathon_template_manager = RequiredFeature("hackathon_template_manager")
     hackathon_manager = RequiredFeature("hackathon_manager")
     expr_manager = RequiredFeature("expr_manager")
+    image_puller = RequiredFeature("image_puller")
     """
     Docker resource management based on docker remote api v1.18
     Host resource are required. Azure key required in case of azure.
@@ -64,24 +77,31 @@ class HostedDockerFormation(Component):
         """
         try:
             # TODO skip hackathons that are offline or ended
-            hosts = self.db.find_all_objects(DockerHostServer)
-            alive = 0
-            for host in hosts:
-                if self.ping(host):
-                    alive += 1
-            if alive == len(hosts):
+            hosts = DockerHostServer.objects().only("vm_name", "public_dns", "public_docker_api_port")
+            timeout = safe_get_config("health.docker_ping_timeout_seconds", 5)
+            futures = dict((ping_executor.submit(self.ping, host, timeout), host.vm_name) for host in hosts)
+            # a host that doesn't respond in time is regarded as down
+            done, not_done = wait(futures.keys(), timeout=timeout + 1)
+            down = [name for future, name in futures.iteritems() if future in not_done or not future.result()]
+
+            alive = len(futures) - len(down)
+            if alive == len(futures):
                 return {
-                    HEALTH.STATUS: HEALTH_STATUS.OK
+                    HEALTH.STATUS: HEALTH_STATUS.OK,
+                    "clients": get_docker_clients_stats()
                 }
             elif alive > 0:
                 return {
                     HEALTH.STATUS: HEALTH_STATUS.WARNING,
-                    HEALTH.DESCRIPTION: 'at least one docker host servers are down'
+                    HEALTH.DESCRIPTION: 'at least one docker host servers are down',
+                    "down": down,
+                    "clients": get_docker_clients_stats()
                 }
             else:
                 return {
                     HEALTH.STATUS: HEALTH_STATUS.ERROR,
-                    HEALTH.DESCRIPTION: 'all docker host servers are down'
+                    HEALTH.DESCRIPTION: 'all docker host servers are down',
+                    "clients": get_docker_clients_stats()
                 }
         except Exception as e:
             return {
@@ -97,8 +117,9 @@ class HostedDockerFormation(Component):
         :param container_name:
         :return:
         """
-        containers_url = '%s/containers/create?name=%s' % (self.__get_vm_url(docker_host), container_name)
-        req = requests.post(containers_url, data=json.dumps(container_config), headers=self.application_json)
+        req = get_docker_client(docker_host).post('/containers/create?name=%s' % container_name,
+                                                  data=json.dumps(container_config),
+                                                  headers=self.application_json)
         self.log.debug(req.content)
         # todo check the http code first
         container = json.loads(req.content)
@@ -113,9 +134,9 @@ class HostedDockerFormation(Component):
         :param container_id:
         :return:
         """
-        url = '%s/containers/%s/start' % (self.__get_vm_url(docker_host), container_id)
-        req = requests.post(url, headers=self.application_json)
+        req = get_docker_client(docker_host).post('/containers/%s/start' % container_id, headers=self.application_json)
         self.log.debug(req.content)
+        container_state_index.forget(str(docker_host.id), container_id)
 
     def stop_container(self, host_server, container_name):
         """
@@ -124,34 +145,38 @@ class HostedDockerFormation(Component):
         :param docker_host:
         :return:
         """
-        containers_url = '%s/containers/%s?force=1' % (self.__get_vm_url(host_server), container_name)
-        req = requests.delete(containers_url)
-        return req
+        return get_docker_client(host_server).delete('/containers/%s?force=1' % container_name)
 
     def pull_image(self, context):
-        # todo fix pull_image?
-        docker_host_id, image_name, tag = context.docker_host, context.image_name, context.tag
-        docker_host = self.db.find_first_object_by(DockerHostServer, id=docker_host_id)
+        """Pull an image to docker host in background, see ImagePuller
+
+        :type context: Context
+        :param context: with docker_host(id), image_name and tag
+        """
+        docker_host = DockerHostServer.objects(id=context.docker_host).first()
         if not docker_host:
-            return
-        pull_image_url = self.__get_vm_url(docker_host) + "/images/create?fromImage=" + image_name + '&tag=' + tag
-        self.log.debug(" send request to pull image:" + pull_image_url)
-        return requests.post(pull_image_url)
+            return False
+        return self.image_puller.pull(docker_host, "%s:%s" % (context.image_name, context.tag))
 
     def get_pulled_images(self, docker_host):
-        get_images_url = self.__get_vm_url(docker_host) + "/images/json?all=0"
-        current_images_info = json.loads(requests.get(get_images_url).content)  # [{},{},{}]
+        current_images_info = json.loads(get_docker_client(docker_host).get("/images/json?all=0").content)  # [{},{},{}]
         current_images_tags = map(lambda x: x['RepoTags'], current_images_info)  # [[],[],[]]
         return flatten(current_images_tags)  # [ imange:tag, image:tag ]
 
     def ensure_images(self):
-        hackathons = self.hackathon_manager.get_online_hackathons()
+        """Keep a job pulling images for every online hackathon, called by scheduled job
+
+        Hackathons applying for online are included so that images are ready before they go online.
+        """
+        hackathons = Hackathon.objects(status__in=[HACK_STATUS.APPLY_ONLINE, HACK_STATUS.ONLINE])
         map(lambda h: self.__ensure_images_for_hackathon(h), hackathons)
 
     def is_container_running(self, docker_container):
         """check container's running status on docker host
 
-        if status is Running or Restarting returns True , else returns False
+        if status is Running or Restarting returns True , else returns False. The status is read from the container
+        list of its host which is requested once per 'docker.container_state.max_age_seconds' for all containers. Only
+        containers missing in the list are inspected one by one.
 
         :type docker_container: DockerContainer
         :param docker_container: the container that you want to check
@@ -162,6 +187,10 @@ class HostedDockerFormation(Component):
         """
         docker_host = docker_container.host_server
         if docker_host:
+            running = self.__get_indexed_container_state(docker_host, docker_container.container_id)
+            if running is not None:
+                return running
+
             container_info = self.__get_container_info_by_container_id(docker_host, docker_container.container_id)
             if container_info is None:
                 return False
@@ -180,13 +209,20 @@ class HostedDockerFormation(Component):
 
         """
         try:
-            ping_url = '%s/_ping' % self.__get_vm_url(docker_host)
-            req = requests.get(ping_url, timeout=timeout)
+            # no retry, the caller wants to know whether the host responds in time
+            req = get_docker_client(docker_host).get('/_ping', retry=False, timeout=timeout)
             return req.status_code == 200 and req.content == 'OK'
         except Exception as e:
             self.log.error(e)
             return False
 
+    def refresh_container_states(self):
+        """Refresh the container states of all docker hosts. Called by scheduled job to keep the index warm"""
+        hosts = DockerHostServer.objects().only("public_dns", "public_docker_api_port")
+        futures = [ping_executor.submit(self.__refresh_container_states, host) for host in hosts]
+        wait(futures)
+        return sum(1 for f in futures if f.result())
+
     def get_containers_detail_by_ve(self, virtual_environment):
         """Get all containers' detail from "Database" filtered by related virtual_environment
 
@@ -203,8 +239,7 @@ class HostedDockerFormation(Component):
         """
         return: json(as list form) through "Docker restful API"
         """
-        containers_url = '%s/containers/json' % self.__get_vm_url(docker_host)
-        req = requests.get(containers_url, timeout=timeout)
+        req = get_docker_client(docker_host).get('/containers/json', timeout=timeout)
         self.log.debug(req.content)
         return self.util.convert(json.loads(req.content))
 
@@ -214,8 +249,48 @@ class HostedDockerFormation(Component):
 
     # --------------------------------------------- helper function ---------------------------------------------#
 
-    def __get_vm_url(self, docker_host):
-        return 'http://%s:%d' % (docker_host.public_dns, docker_host.public_docker_api_port)
+    def __get_indexed_container_state(self, docker_host, container_id):
+        """Get container state from index, refresh the snapshot of the host first if it's stale
+
+        Concurrent refreshes of the same host wait for the first one instead of sending their own requests.
+
+        :rtype: bool
+        :return running state, None if the container is not found or the host cannot be listed
+        """
+        host_key = str(docker_host.id)
+        if not container_state_index.is_fresh(host_key):
+            with container_state_index.host_lock(host_key):
+                if not container_state_index.is_fresh(host_key):
+                    self.__refresh_container_states(docker_host)
+
+        return container_state_index.get(host_key, container_id)
+
+    def __refresh_container_states(self, docker_host):
+        """List all containers of a host, including the stopped ones, and replace its snapshot in the index
+
+        :rtype: bool
+        :return True if refreshed successfully
+        """
+        try:
+            refreshed_at = time.time()
+            req = get_docker_client(docker_host).get("/containers/json?all=1")
+            if req.status_code != 200:
+                self.log.debug("failed to list containers of %s: %s" % (docker_host.public_dns, req.content))
+                return False
+
+            states = {}
+            for c in json.loads(req.content):
+                if "State" in c:
+                    states[c["Id"]] = c["State"] in ["running", "restarting"]
+                else:
+                    # remote api before 1.23, Status is like 'Up 2 hours', 'Restarting (1) 3 seconds ago'
+                    states[c["Id"]] = c.get("Status", "").startswith(("Up", "Restarting"))
+
+            container_state_index.update(str(docker_host.id), states, refreshed_at)
+            return True
+        except Exception as e:
+            self.log.error(e)
+            return False
 
     def __get_schedule_job_id(self, hackathon):
         return "pull_images_for_hackathon_%s" % hackathon.id
@@ -247,7 +322,7 @@ class HostedDockerFormation(Component):
                                             id=job_id,
                                             context=context,
                                             next_run_time=next_run_time,
-                                            minutes=60)
+                                            minutes=safe_get_config("docker.image_pull.interval_minutes", 60))
 
     def __get_container_info_by_container_id(self, docker_host, container_id):
         """get a container info by container_id from a docker host
@@ -260,8 +335,7 @@ class HostedDockerFormation(Component):
         :return dic object of the container info if not None
         """
         try:
-            get_container_url = self.__get_vm_url(docker_host) + "/containers/%s/json?all=0" % container_id
-            req = requests.get(get_container_url)
+            req = get_docker_client(docker_host).get("/containers/%s/json?all=0" % container_id)
             if 300 > req.status_code >= 200:
                 container_info = json.loads(req.content)
                 return container_info
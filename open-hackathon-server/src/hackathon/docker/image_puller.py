@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+import os
+import json
+import time
+import socket
+import urllib
+from collections import deque
+from datetime import timedelta
+from threading import Lock
+
+from concurrent.futures import ThreadPoolExecutor
+from mongoengine import Q, NotUniqueError
+
+from hackathon import Component, RequiredFeature
+from hackathon.hmongo.models import HostImage
+from hackathon.constants import DockerImageStatus
+from hackathon.util import safe_get_config
+from docker_client import get_docker_client
+
+__all__ = ["ImagePuller"]
+
+# pulls of all hosts share the pool, one pull occupies a worker until it's done
+pull_executor = ThreadPoolExecutor(max_workers=safe_get_config("docker.image_pull.max_workers", 8))
+
+# host id -> pulls waiting for their turn on the host. A pull is submitted to the pool only when the host has room, so
+# that pulls queued for a busy host won't hold workers needed by other hosts
+host_queues = {}
+# host id -> count of pulls submitted to the pool
+host_running = {}
+# (host id, image) of the pulls accepted by current process, queued or running
+pulls_in_flight = set()
+pull_lock = Lock()
+
+
+class ImagePuller(Component):
+    """Pull docker images to docker hosts ahead of experiments so that containers won't wait on cold pulls
+
+    Every (host, image) is pulled once no matter how many hackathons or templates ask for it: pulls in flight are
+    tracked in current process and leased in MongoDB across processes. The inventory of images per host is kept in
+    HostImage together with the progress of pulls, from which get_images_status tells whether a hackathon is ready.
+
+    Concurrency is bounded by 'docker.image_pull.max_workers' in total and 'docker.image_pull.per_host' per host. A
+    failed pull is retried after a backoff that doubles on every failure, from 'docker.image_pull.retry_backoff_seconds'
+    up to 'docker.image_pull.retry_max_backoff_seconds'.
+    """
+    hosted_docker_proxy = RequiredFeature("hosted_docker_proxy")
+
+    def ensure_images(self, hosts, images):
+        """Pull the images missing on hosts
+
+        :type hosts: list
+        :param hosts: list of DockerHostServer
+
+        :type images: list
+        :param images: list of image names in 'name:tag' format
+
+        :rtype: int
+        :return: count of pulls submitted
+        """
+        images = set(images)
+        submitted = 0
+        for host in hosts:
+            try:
+                present = self.sync_inventory(host)
+            except Exception as e:
+                self.log.error(e)
+                continue
+
+            for image in images - present:
+                if self.pull(host, image):
+                    submitted += 1
+
+        return submitted
+
+    def sync_inventory(self, host):
+        """Record the images that exist on host as ready, and the ready ones no longer on host as missing
+
+        :type host: DockerHostServer
+        :param host: the docker host
+
+        :rtype: set
+        :return: images on host in 'name:tag' format
+        """
+        present = set(i for i in self.hosted_docker_proxy.get_pulled_images(host) if i and i != "<none>:<none>")
+        known = set(i.image for i in HostImage.objects(host=host, status=DockerImageStatus.READY).only("image"))
+        for image in present - known:
+            HostImage.objects(host=host, image=image).update_one(upsert=True,
+                                                                 set__status=DockerImageStatus.READY,
+                                                                 set__update_time=self.util.get_now())
+
+        removed = known - present
+        if removed:
+            self.log.debug("images %s removed from %s" % (list(removed), host.vm_name))
+            HostImage.objects(host=host, image__in=list(removed), status=DockerImageStatus.READY).update(
+                set__status=DockerImageStatus.MISSING,
+                set__update_time=self.util.get_now())
+        return present
+
+    def pull(self, host, image):
+        """Pull an image to host in background unless it's being pulled already
+
+        :type host: DockerHostServer
+        :param host: the docker host
+
+        :type image: str|unicode
+        :param image: image name in 'name:tag' format
+
+        :rtype: bool
+        :return: True if a new pull submitted
+        """
+        key = (str(host.id), image)
+        with pull_lock:
+            if key in pulls_in_flight:
+                return False
+            pulls_in_flight.add(key)
+
+        if not self.__lease(host, image):
+            self.log.debug("image %s is being pulled to %s by another process or failed recently" % (image,
+                                                                                                    host.vm_name))
+            with pull_lock:
+                pulls_in_flight.discard(key)
+            return False
+
+        with pull_lock:
+            host_queues.setdefault(key[0], deque()).append((host, image, key))
+        self.__submit_queued(key[0])
+        return True
+
+    def get_images_status(self, hosts, images):
+        """Return whether the images are ready on all hosts and the details of those not ready
+
+        :type hosts: list
+        :param hosts: list of DockerHostServer
+
+        :type images: list
+        :param images: list of image names in 'name:tag' format
+
+        :rtype: dict
+        :return: {"ready": bool, "hosts": {vm_name: {image: {"status": ..., "progress": ..., "error": ...}}}}
+        """
+        images = set(images)
+        inventory = HostImage.objects(host__in=hosts, image__in=list(images)).no_dereference()
+        found = dict(((str(i.host.id), i.image), i) for i in inventory)
+
+        ready = True
+        details = {}
+        for host in hosts:
+            for image in images:
+                item = found.get((str(host.id), image))
+                if item and item.status == DockerImageStatus.READY:
+                    continue
+
+                ready = False
+                details.setdefault(host.vm_name, {})[image] = {
+                    "status": item.status if item else None,
+                    "progress": item.progress if item else {},
+                    "error": item.error if item else None
+                }
+
+        return {"ready": ready, "hosts": details}
+
+    def __lease(self, host, image):
+        # taken when the pull is submitted so that other processes won't submit the same one, renewed by __renew_lease
+        # once the pull gets its turn
+        now = self.util.get_now()
+        lease_seconds = safe_get_config("docker.image_pull.lease_seconds", 600)
+        try:
+            # the upsert fails with duplicate key if another process is pulling and its lease not expired yet, or the
+            # last pull failed and its backoff not passed yet
+            HostImage.objects(Q(status__nin=[DockerImageStatus.PULLING, DockerImageStatus.FAILED]) |
+                              Q(status=DockerImageStatus.PULLING, lease_until__lt=now) |
+                              (Q(status=DockerImageStatus.FAILED) & (Q(retry_after=None) | Q(retry_after__lte=now))),
+                              host=host, image=image).update_one(
+                upsert=True,
+                set__status=DockerImageStatus.PULLING,
+                set__progress={},
+                set__error=None,
+                set__owner=_owner(),
+                set__lease_until=now + timedelta(seconds=lease_seconds),
+                set__update_time=now)
+            return True
+        except NotUniqueError:
+            return False
+
+    def __renew_lease(self, host, image):
+        # the pull might wait for a worker and the semaphore of host longer than the lease, in which case another
+        # process could have taken it over
+        now = self.util.get_now()
+        return HostImage.objects(host=host, image=image, status=DockerImageStatus.PULLING, owner=_owner()).update_one(
+            set__lease_until=now + timedelta(seconds=safe_get_config("docker.image_pull.lease_seconds", 600)),
+            set__update_time=now) > 0
+
+    def __submit_queued(self, host_id):
+        """Submit the queued pulls of host to the pool as long as the host has room"""
+        per_host = safe_get_config("docker.image_pull.per_host", 2)
+        with pull_lock:
+            queue = host_queues.get(host_id)
+            while queue and host_running.get(host_id, 0) < per_host:
+                host, image, key = queue.popleft()
+                host_running[host_id] = host_running.get(host_id, 0) + 1
+                pull_executor.submit(self.__pull, host, image, key)
+            if not queue:
+                host_queues.pop(host_id, None)
+
+    def __pull(self, host, image, key):
+        try:
+            if not self.__renew_lease(host, image):
+                self.log.debug("lease of pulling %s to %s lost while queued, skipped" % (image, host.vm_name))
+                return
+
+            self.log.debug("start pulling image %s to %s" % (image, host.vm_name))
+            error = self.__stream_pull(host, image)
+            if error:
+                self.__on_failed(host, image, error)
+            else:
+                self.log.debug("image %s pulled to %s" % (image, host.vm_name))
+                self.__update(host, image,
+                              set__status=DockerImageStatus.READY,
+                              set__failures=0,
+                              set__retry_after=None)
+        except Exception as e:
+            self.log.error(e)
+            self.__on_failed(host, image, repr(e))
+        finally:
+            with pull_lock:
+                pulls_in_flight.discard(key)
+                host_running[key[0]] -= 1
+            self.__submit_queued(key[0])
+
+    def __on_failed(self, host, image, error):
+        self.log.warn("pull image %s to %s failed: %s" % (image, host.vm_name, error))
+        item = HostImage.objects(host=host, image=image).only("failures").first()
+        failures = (item.failures or 0) + 1 if item else 1
+        backoff = min(safe_get_config("docker.image_pull.retry_backoff_seconds", 60) * 2 ** (failures - 1),
+                      safe_get_config("docker.image_pull.retry_max_backoff_seconds", 3600))
+        self.__update(host, image,
+                      set__status=DockerImageStatus.FAILED,
+                      set__error=error,
+                      set__failures=failures,
+                      set__retry_after=self.util.get_now() + timedelta(seconds=backoff))
+
+    def __stream_pull(self, host, image):
+        """Pull image by docker remote API and record the progress it streams back
+
+        :rtype: str
+        :return: error message reported by docker, None if succeeded
+        """
+        name, _, tag = image.rpartition(":")
+        path = "/images/create?" + urllib.urlencode({"fromImage": name, "tag": tag})
+        resp = get_docker_client(host).post(path, stream=True)
+        if resp.status_code != 200:
+            return "%d %s" % (resp.status_code, resp.content)
+
+        # layer id -> (current, total)
+        layers = {}
+        done = set()
+        interval = safe_get_config("docker.image_pull.progress_interval_seconds", 2)
+        lease_seconds = safe_get_config("docker.image_pull.lease_seconds", 600)
+        last_update = 0
+        progress = None
+        for line in resp.iter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if "error" in event:
+                return event["error"]
+
+            layer = event.get("id")
+            status = event.get("status", "")
+            if layer and "progressDetail" in event and event["progressDetail"]:
+                detail = event["progressDetail"]
+                layers[layer] = (detail.get("current", 0), detail.get("total", 0))
+            if layer and status.startswith(("Pull complete", "Already exists")):
+                done.add(layer)
+                layers.setdefault(layer, (0, 0))
+
+            progress = {
+                "layers": len(layers),
+                "layers_done": len(done),
+                "current": sum(c for c, t in layers.values()),
+                "total": sum(t for c, t in layers.values()),
+                "status": status}
+            if time.time() - last_update >= interval:
+                last_update = time.time()
+                # keep the lease while the pull makes progress
+                if not self.__update(host, image,
+                                     set__progress=progress,
+                                     set__lease_until=self.util.get_now() + timedelta(seconds=lease_seconds)):
+                    return "lease of pulling lost"
+
+        if progress:
+            self.__update(host, image, set__progress=progress)
+        return None
+
+    def __update(self, host, image, **update):
+        """Update the image being pulled by current process. Nothing is updated if the lease was taken over by another
+        process, in case the pull went on longer than the lease
+
+        :rtype: bool
+        :return: True if updated
+        """
+        update["set__update_time"] = self.util.get_now()
+        return HostImage.objects(host=host, image=image, owner=_owner()).update_one(**update) > 0
+
+
+def _owner():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
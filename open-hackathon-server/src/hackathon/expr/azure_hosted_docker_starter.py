@@ -25,24 +25,27 @@ THE SOFTWARE.
 import sys
 
 sys.path.append("..")
-from compiler.ast import flatten
-from threading import Lock
 
 from docker_expr_starter import DockerExprStarter
 from hackathon import RequiredFeature, Context
+from hackathon.provisioning_engine import CONTINUE
 from hackathon.hmongo.models import Hackathon, Experiment, DockerContainer, PortBinding, DockerHostServer, AzureKey
-from hackathon.constants import DHS_QUERY_STATE, EStatus, AVMStatus, VERemoteProvider, VEStatus
+from hackathon.constants import DHS_QUERY_STATE, AVMStatus, VERemoteProvider, VEStatus
 from hackathon.hazure import VirtualMachineAdapter
 from hackathon.template import DOCKER_UNIT
-from hackathon.hazure.utils import find_unassigned_endpoints, add_endpoint_to_network_config, \
-    delete_endpoint_from_network_config
+from hackathon.hazure.utils import add_endpoint_to_network_config, delete_endpoint_from_network_config
+from hackathon.hazure.endpoint_allocator import get_endpoint_allocator
 
 FEATURE = "azure_docker"
 IN_PROGRESS = 'InProgress'
 SUCCEEDED = 'Succeeded'
-MAX_TRIAL = 20
-TRIAL_INTERVAL_SECONDS = 10
 DEPLOYMENT_SLOT = "Production"
+# async operations are polled every POLL_INTERVAL_SECONDS at first, backing off to POLL_MAX_INTERVAL_SECONDS
+POLL_INTERVAL_SECONDS = 2
+POLL_MAX_INTERVAL_SECONDS = 10
+STEP_TIMEOUT_SECONDS = 200
+HOST_TIMEOUT_SECONDS = 60
+FILE_TRANSFER_TIMEOUT_SECONDS = 600
 
 __all__ = ["AzureHostedDockerStarter"]
 
@@ -50,13 +53,10 @@ __all__ = ["AzureHostedDockerStarter"]
 class AzureHostedDockerStarter(DockerExprStarter):
     docker = RequiredFeature("hosted_docker_proxy")
     docker_host_manager = RequiredFeature("docker_host_manager")
-    host_ports = []
-    host_port_max_num = 30
-
-    def __init__(self):
-        self.lock = Lock()
 
     def get_docker_host_server(self, context):
+        # a retry of the step after a reservation was made, reserve again from scratch
+        self._release_reservation(context)
         hackathon = Hackathon.objects(id=context.hackathon_id).no_dereference().first()
         try:
             host_resp = self.docker_host_manager.get_available_docker_host(hackathon)
@@ -64,95 +64,82 @@ class AzureHostedDockerStarter(DockerExprStarter):
             self.log.error(e)
             host_resp = Context(state=DHS_QUERY_STATE.ONGOING)
 
-        context.trial = context.get("trial", 0) + 1
         if host_resp.state == DHS_QUERY_STATE.SUCCESS:
+            # a slot is reserved, it's released on failure or owned by the container once it's started
+            context.reserved_host_server_id = host_resp.docker_host_server.id
             # assign ports
             self.__assign_ports(context, host_resp.docker_host_server)
-        elif host_resp.state == DHS_QUERY_STATE.ONGOING and context.trial < 20:
-            # tried up to 20 times
-            self.log.debug("host servers are all busy, %d times tried, will retry in 3 seconds" % context.trial)
-            self.scheduler.add_once(FEATURE, "get_docker_host_server", context, seconds=3)
+        elif host_resp.state == DHS_QUERY_STATE.ONGOING:
+            self.log.debug("host servers are all busy, will retry later")
+            return CONTINUE
         else:
             self.log.error("no available host server")
             self._on_virtual_environment_failed(context)
 
     def query_network_config_status(self, context):
         vm_adapter = self.__get_azure_vm_adapter(context)
-        try:
-            context.trial = context.get("trial", 0) + 1
-            result = vm_adapter.get_operation_status(context.request_id)
-            if result.status == IN_PROGRESS and context.trial < MAX_TRIAL:
-                self.log.debug('wait for async [%s] loop count [%d]' % (context.request_id, context.trial))
-                self.scheduler.add_once(FEATURE, "query_network_config_status", context, seconds=TRIAL_INTERVAL_SECONDS)
-            elif result.status == SUCCEEDED:
-                context.trial = 0
-                self.query_vm_status(context)
-            elif context.trial >= MAX_TRIAL:
-                self.log.error("timeout when configure network")
-                self._on_virtual_environment_failed(context)
-            else:
-                self.log.error(vars(result))
-                if result.error:
-                    self.log.error(result.error.code)
-                    self.log.error(vars(result.error))
-                self.log.error('Asynchronous operation did not succeed.')
-                self._on_virtual_environment_failed(context)
-        except Exception as e:
-            self.log.error(e)
-            self.scheduler.add_once(FEATURE, "query_network_config_status", context, seconds=TRIAL_INTERVAL_SECONDS)
+        result = vm_adapter.get_operation_status(context.request_id)
+        if result.status == IN_PROGRESS:
+            self.log.debug('wait for async [%s]' % context.request_id)
+            return CONTINUE
+        elif result.status == SUCCEEDED:
+            self.__start_step(context, "query_vm_status")
+        else:
+            self.log.error(vars(result))
+            if result.error:
+                self.log.error(result.error.code)
+                self.log.error(vars(result.error))
+            self.log.error('Asynchronous operation did not succeed.')
+            get_endpoint_allocator().invalidate(context.cloud_service_name)
+            self._on_virtual_environment_failed(context)
 
     def query_vm_status(self, context):
         vm_adapter = self.__get_azure_vm_adapter(context)
-        try:
-            context.trial = context.get("trial", 0) + 1
-            result = vm_adapter.get_virtual_machine_instance_status(context.cloud_service_name,
-                                                                    DEPLOYMENT_SLOT,
-                                                                    context.virtual_machine_name)
-            if result is None:
-                self.log.error("cannot find vm or deployment slot")
-                self._on_virtual_environment_failed(context)
-            elif result == AVMStatus.READY_ROLE:
-                self.__update_virtual_environment_cfg(context)
-            elif context.trial > MAX_TRIAL:
-                self._on_virtual_environment_failed(context)
-            else:
-                self.log.debug(
-                    'wait for virtual machine [%r] loop count [%d]' % (context.virtual_machine_name, context.trial))
-                self.scheduler.add_once(FEATURE, "query_vm_status", context, seconds=TRIAL_INTERVAL_SECONDS)
-        except Exception as e:
-            self.log.error(e)
-            self.scheduler.add_once(FEATURE, "query_vm_status", context, seconds=TRIAL_INTERVAL_SECONDS)
+        result = vm_adapter.get_virtual_machine_instance_status(context.cloud_service_name,
+                                                                DEPLOYMENT_SLOT,
+                                                                context.virtual_machine_name)
+        if result is None:
+            self.log.error("cannot find vm or deployment slot")
+            self._on_virtual_environment_failed(context)
+        elif result == AVMStatus.READY_ROLE:
+            self.__update_virtual_environment_cfg(context)
+        else:
+            self.log.debug('wait for virtual machine [%r]' % context.virtual_machine_name)
+            return CONTINUE
 
     def _internal_start_virtual_environment(self, context):
-        self.get_docker_host_server(context)
+        self.__start_step(context, "get_docker_host_server", timeout_seconds=HOST_TIMEOUT_SECONDS)
 
     def _get_docker_proxy(self):
         return self.docker
 
     def _hooks_on_virtual_environment_success(self, context):
-        context.trial = 0
-        self.enable_guacd_file_transfer(context)
+        if context.get("guacctl_injected"):
+            return
+        self.__start_step(context, "enable_guacd_file_transfer", timeout_method=None,
+                          timeout_seconds=FILE_TRANSFER_TIMEOUT_SECONDS, max_interval_seconds=30)
 
     def enable_guacd_file_transfer(self, context):
         try:
-            context.trial += 1
             self._enable_guacd_file_transfer(context)
         except Exception as e:
-            self.log.info("enable guacamole file transfer failed count: %d" % context.trial)
+            self.log.info("enable guacamole file transfer failed, will retry later")
             self.log.error(e)
-            if context.trial < 20:
-                self.scheduler.add_once(FEATURE, "enable_guacd_file_transfer", context, seconds=30)
+            return CONTINUE
 
     def __assign_host_ports(self, context, host_server):
         """assign ports that map a port on docker host server to a port inside docker"""
-        unit = context.unit
+        unit = self._get_unit(context)
         # assign host port
         try:
             port_cfg = unit.get_ports()
-            for cfg in port_cfg:
-                cfg[DOCKER_UNIT.PORTS_HOST_PORT] = self.__get_available_host_port(host_server,
-                                                                                  cfg[DOCKER_UNIT.PORTS_PORT])
-            context.port_config = port_cfg
+            host_ports = self.docker_host_manager.reserve_host_ports(host_server,
+                                                                     [cfg[DOCKER_UNIT.PORTS_PORT] for cfg in port_cfg])
+            # released on failure or owned by the container once it's started, like the reserved slot
+            context.reserved_host_ports = host_ports
+            # copy the port config of unit which is shared by experiments of the template
+            context.port_config = [dict(cfg, **{DOCKER_UNIT.PORTS_HOST_PORT: host_port})
+                                   for cfg, host_port in zip(port_cfg, host_ports)]
             self.__assign_public_ports(context, host_server)
         except Exception as e:
             self.log.error(e)
@@ -178,21 +165,23 @@ class AzureHostedDockerStarter(DockerExprStarter):
             public_ports_cfg = filter(lambda p: DOCKER_UNIT.PORTS_PUBLIC in p, port_cfg)
             host_ports = [u[DOCKER_UNIT.PORTS_HOST_PORT] for u in public_ports_cfg]
 
-            # get assigned ports of cloud service
-            assigned_endpoints = vm_adapter.get_assigned_endpoints(cloud_service_name)
-            if not assigned_endpoints:
+            # assigned ports of cloud service are read from azure once per cache period, not once per container
+            allocator = get_endpoint_allocator()
+            try:
+                endpoints_to_assign = allocator.allocate(cloud_service_name, host_ports,
+                                                         lambda: vm_adapter.get_assigned_endpoints(cloud_service_name))
+            except Exception as e:
+                self.log.error(e)
                 self.log.debug('fail to assign endpoints: %s' % cloud_service_name)
                 self._on_virtual_environment_failed(context)
                 return
 
-            endpoints_to_assign = find_unassigned_endpoints(host_ports, assigned_endpoints)
-            # duplication detection for public endpoint
-            deployment_name = vm_adapter.get_deployment_name(cloud_service_name, DEPLOYMENT_SLOT)
-            network_config = vm_adapter.get_virtual_machine_network_config(cloud_service_name,
-                                                                           deployment_name,
-                                                                           virtual_machine_name)
-            new_network_config = add_endpoint_to_network_config(network_config, endpoints_to_assign, host_ports)
             try:
+                deployment_name = vm_adapter.get_deployment_name(cloud_service_name, DEPLOYMENT_SLOT)
+                network_config = vm_adapter.get_virtual_machine_network_config(cloud_service_name,
+                                                                               deployment_name,
+                                                                               virtual_machine_name)
+                new_network_config = add_endpoint_to_network_config(network_config, endpoints_to_assign, host_ports)
                 result = vm_adapter.update_virtual_machine_network_config(cloud_service_name,
                                                                           deployment_name,
                                                                           virtual_machine_name,
@@ -201,6 +190,8 @@ class AzureHostedDockerStarter(DockerExprStarter):
             except Exception as e:
                 self.log.error(e)
                 self.log.error('fail to assign endpoints: %s' % endpoints_to_assign)
+                # the endpoints might be taken by others(e.g. another server process), read azure again next time
+                allocator.invalidate(cloud_service_name)
                 self._on_virtual_environment_failed(context)
                 return
 
@@ -215,8 +206,7 @@ class AzureHostedDockerStarter(DockerExprStarter):
             # query azure to make sure the network config updated
             context.virtual_machine_name = virtual_machine_name
             context.cloud_service_name = cloud_service_name
-            context.trial = 0
-            self.query_network_config_status(context)
+            self.__start_step(context, "query_network_config_status")
 
     def __update_virtual_environment_cfg(self, context):
         experiment = Experiment.objects(id=context.experiment_id).no_dereference().first()
@@ -240,7 +230,7 @@ class AzureHostedDockerStarter(DockerExprStarter):
             virtual_environment.docker_container.port_bindings.append(port_binding)
 
         # guacamole config
-        guacamole = context.unit.get_remote()
+        guacamole = self._get_unit(context).get_remote()
         port_cfg = filter(lambda p:
                           p[DOCKER_UNIT.PORTS_PORT] == guacamole[DOCKER_UNIT.REMOTE_PORT],
                           context.port_config)
@@ -275,11 +265,8 @@ class AzureHostedDockerStarter(DockerExprStarter):
         if exist:
             virtual_environment.docker_container.container_id = exist["Id"]
             experiment.save()
-            host_server.container_count += 1
-            host_server.save()
         else:
-            context.unit.set_ports(context.port_config)
-            container_config = context.unit.get_container_config()
+            container_config = self._get_unit(context).overlay(ports=context.port_config).get_container_config()
 
             try:
                 # create docker container
@@ -287,10 +274,11 @@ class AzureHostedDockerStarter(DockerExprStarter):
                 virtual_environment.docker_container.container_id = container_create_result["Id"]
                 experiment.save()
 
+                # copy guacctl in before start, otherwise it's uploaded over SSH once the container is running
+                context.guacctl_injected = self.file_transfer.inject_guacctl(host_server, container_create_result["Id"])
+
                 # start docker container
                 self.docker.start_container(host_server, container_create_result["Id"])
-                host_server.container_count += 1
-                host_server.save()
             except Exception as e:
                 self.log.error(e)
                 self.log.error("container %s fail to create or start" % container_name)
@@ -309,6 +297,9 @@ class AzureHostedDockerStarter(DockerExprStarter):
         self.log.debug("starting container %s is successful ... " % container_name)
         virtual_environment.status = VEStatus.RUNNING
         experiment.save()
+        # the reserved slot and ports are released when the container is removed
+        context.reserved_host_server_id = None
+        context.reserved_host_ports = None
         self._on_virtual_environment_success(context)
 
     def __stop_docker_container(self, context, host_server):
@@ -316,12 +307,15 @@ class AzureHostedDockerStarter(DockerExprStarter):
             self.docker.stop_container(host_server, context.container_name)
         except Exception as e:
             self.log.error(e)
+        finally:
+            self.docker_host_manager.release_docker_host(host_server)
+            self.docker_host_manager.release_host_ports(host_server, context.get("host_ports"))
 
         self._on_virtual_environment_stopped(context)
 
     def __assign_ports(self, context, host_server):
         self.log.debug("try to assign port on server %r" % host_server)
-        unit = context.unit
+        unit = self._get_unit(context)
         experiment = Experiment.objects(id=context.experiment_id).no_dereference().first()
         virtual_environment = experiment.virtual_environments.get(name=context.virtual_environment_name)
         container = DockerContainer(name=virtual_environment.name,
@@ -354,11 +348,12 @@ class AzureHostedDockerStarter(DockerExprStarter):
         """
         release the specified experiment's ports.
 
-        We can ignore host port here since it will be release when the container is deleted.
-        What we care about is the public ports configured on azure cloud service
+        Host ports are released when the container is deleted. The public ports configured on azure cloud service are
+        released first
         """
 
         host_server = docker_container.host_server
+        context.host_ports = [p.host_port for p in docker_container.port_bindings]
         if self.util.is_local():
             context.container_name = docker_container.name
             self.__stop_docker_container(context, host_server)
@@ -374,62 +369,63 @@ class AzureHostedDockerStarter(DockerExprStarter):
         network_config = vm_adapter.get_virtual_machine_network_config(cloud_service_name,
                                                                        deployment_name,
                                                                        virtual_machine_name)
-        host_ports = [p.host_port for p in docker_container.port_bindings]
-        new_network_config = delete_endpoint_from_network_config(network_config, host_ports)
+        new_network_config = delete_endpoint_from_network_config(network_config, context.host_ports)
         result = vm_adapter.update_virtual_machine_network_config(cloud_service_name,
                                                                   deployment_name,
                                                                   virtual_machine_name,
                                                                   new_network_config)
+        get_endpoint_allocator().release(cloud_service_name,
+                                         [p.public_port for p in docker_container.port_bindings if p.public_port])
         context.request_id = result.request_id
         context.cloud_service_name = cloud_service_name
         context.virtual_machine_name = virtual_machine_name
         context.host_server_id = host_server.id
-        context.trial = 0
         context.container_name = docker_container.name
 
-        self.__clear_ports_cache()
-        self.query_release_status(context)
+        self.__start_step(context, "query_release_status", step="release",
+                          timeout_method="_on_virtual_environment_unexpected_error")
 
     def query_release_status(self, context):
         vm_adapter = self.__get_azure_vm_adapter(context)
-        try:
-            context.trial = context.get("trial", 0) + 1
-            result = vm_adapter.get_operation_status(context.request_id)
-            if result.status == IN_PROGRESS and context.trial < MAX_TRIAL:
-                self.log.debug('wait for release [%s] loop count [%d]' % (context.request_id, context.trial))
-                self.scheduler.add_once(FEATURE, "query_release_status", context, seconds=TRIAL_INTERVAL_SECONDS)
-            elif result.status == SUCCEEDED:
-                context.trial = 0
-                self.query_vm_status_for_release(context)
-            else:
-                self.log.error("timeout when configure network")
-                self._on_virtual_environment_unexpected_error(context)
-        except Exception as e:
-            self.log.error(e)
-            self.scheduler.add_once(FEATURE, "query_release_status", context, seconds=TRIAL_INTERVAL_SECONDS)
+        result = vm_adapter.get_operation_status(context.request_id)
+        if result.status == IN_PROGRESS:
+            self.log.debug('wait for release [%s]' % context.request_id)
+            return CONTINUE
+        elif result.status == SUCCEEDED:
+            self.__start_step(context, "query_vm_status_for_release", step="release",
+                              timeout_method="_on_virtual_environment_unexpected_error")
+        else:
+            self.log.error("failed to configure network")
+            get_endpoint_allocator().invalidate(context.cloud_service_name)
+            self._on_virtual_environment_unexpected_error(context)
 
     def query_vm_status_for_release(self, context):
         vm_adapter = self.__get_azure_vm_adapter(context)
-        try:
-            context.trial = context.get("trial", 0) + 1
-            result = vm_adapter.get_virtual_machine_instance_status(context.cloud_service_name,
-                                                                    DEPLOYMENT_SLOT,
-                                                                    context.virtual_machine_name)
-            if result is None:
-                self.log.error("cannot find vm or deployment slot")
-                self._on_virtual_environment_unexpected_error(context)
-            elif result == AVMStatus.READY_ROLE:
-                host_server = DockerHostServer.objects(id=context.host_server_id).first()
-                self.__stop_docker_container(context, host_server)
-            elif context.trial > MAX_TRIAL:
-                self._on_virtual_environment_unexpected_error(context)
-            else:
-                self.log.debug(
-                    'wait for virtual machine [%r] loop count [%d]' % (context.virtual_machine_name, context.trial))
-                self.scheduler.add_once(FEATURE, "query_vm_status", context, seconds=TRIAL_INTERVAL_SECONDS)
-        except Exception as e:
-            self.log.error(e)
-            self.scheduler.add_once(FEATURE, "query_vm_status_for_release", context, seconds=TRIAL_INTERVAL_SECONDS)
+        result = vm_adapter.get_virtual_machine_instance_status(context.cloud_service_name,
+                                                                DEPLOYMENT_SLOT,
+                                                                context.virtual_machine_name)
+        if result is None:
+            self.log.error("cannot find vm or deployment slot")
+            self._on_virtual_environment_unexpected_error(context)
+        elif result == AVMStatus.READY_ROLE:
+            host_server = DockerHostServer.objects(id=context.host_server_id).first()
+            self.__stop_docker_container(context, host_server)
+        else:
+            self.log.debug('wait for virtual machine [%r]' % context.virtual_machine_name)
+            return CONTINUE
+
+    def __start_step(self, context, method, step="start", timeout_method="_on_virtual_environment_failed",
+                     timeout_seconds=STEP_TIMEOUT_SECONDS, max_interval_seconds=POLL_MAX_INTERVAL_SECONDS):
+        """Run 'method' in provisioning engine until it returns anything but CONTINUE
+
+        Steps of the same virtual environment share one step id so that only the latest one is checkpointed
+        """
+        step_id = "%s-%s-%s-%s" % (FEATURE, context.experiment_id, context.virtual_environment_name, step)
+        self.provisioning_engine.start_step(step_id, FEATURE, method, context,
+                                            timeout_method=timeout_method,
+                                            timeout_seconds=timeout_seconds,
+                                            interval_seconds=POLL_INTERVAL_SECONDS,
+                                            max_interval_seconds=max_interval_seconds)
 
     def __load_azure_key_id(self, context):
         # todo which key to use? how to support multi subscription?
@@ -456,66 +452,3 @@ class AzureHostedDockerStarter(DockerExprStarter):
         return VirtualMachineAdapter(azure_key.subscription_id,
                                      azure_key.get_local_pem_url(),
                                      host=azure_key.management_host)
-
-    def __get_available_host_port(self, docker_host, private_port):
-        """
-        We use double operation to ensure ports not conflicted, first we get ports from host machine, but in multiple
-        threads situation, the interval between two requests is too short, maybe the first thread do not get port
-        ended, so the host machine don't update ports in time, thus the second thread may get the same port.
-        To avoid this condition, we use static variable host_ports to cache the latest host_port_max_num ports.
-        Every thread visit variable host_ports is synchronized.
-        To save space, we will release the ports if the number over host_port_max_num.
-        :param docker_host:
-        :param private_port:
-        :return:
-        """
-        self.log.debug("try to assign docker port %d on server %r" % (private_port, docker_host))
-        containers = self.docker.list_containers(docker_host)
-        used_host_ports = flatten(map(lambda p: p['Ports'], containers))
-
-        # todo if azure return -1
-        def sub(port):
-            return port["PublicPort"] if "PublicPort" in port else -1
-
-        used_public_ports = map(lambda x: sub(x), used_host_ports)
-        return self.__safe_get_host_port(used_public_ports, private_port)
-
-    def __safe_get_host_port(self, port_bindings, port):
-        """
-        simple lock mechanism, visit static variable ports synchronize, because port_bindings is not in real-time,
-        so we should cache the latest ports, when the cache ports number is more than host_port_max_num,
-        we will release it to save space.
-        :param port_bindings:
-        :param port:
-        :return:
-        """
-        self.lock.acquire()
-        try:
-            host_port = port + 10000
-            while host_port in port_bindings or host_port in self.host_ports:
-                host_port += 1
-            if host_port >= 65535:
-                self.log.error("port used up on this host server")
-                raise Exception("no port available")
-            if len(self.host_ports) >= self.host_port_max_num:
-                self.__clear_ports_cache()
-            self.host_ports.append(host_port)
-            self.log.debug("host_port is %d " % host_port)
-            return host_port
-        finally:
-            self.lock.release()
-
-    def __clear_ports_cache(self):
-        """
-        cache ports, if ports' number more than host_port_max_num, release the ports.
-        But if there is a thread apply new ports, we will do this operation in the next loop.
-        Because the host machine do not update the ports information,
-        if we release ports now, the new ports will be lost.
-        :return:
-        """
-        num = Experiment.objects(status=EStatus.STARTING).count()
-        if num > 0:
-            self.log.debug("there are %d experiment is starting, host ports will updated in next loop" % num)
-            return
-        self.log.debug("-----release ports cache successfully------")
-        self.host_ports = []
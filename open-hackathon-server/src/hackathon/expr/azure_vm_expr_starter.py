@@ -29,6 +29,7 @@ sys.path.append("..")
 
 from expr_starter import ExprStarter
 from hackathon import RequiredFeature, Context
+from hackathon.provisioning_engine import CONTINUE
 from hackathon.hmongo.models import Hackathon, VirtualEnvironment, Experiment, AzureVirtualMachine, AzureEndPoint
 from hackathon.constants import (
     VE_PROVIDER, VERemoteProvider, VEStatus, ADStatus, AVMStatus, EStatus)
@@ -37,9 +38,15 @@ from hackathon.template.template_constants import AZURE_UNIT
 
 from hackathon.hazure import CloudServiceAdapter, StorageAccountAdapter, VirtualMachineAdapter
 from hackathon.hazure.utils import get_network_config, get_remote_parameters
+from hackathon.hazure.endpoint_allocator import get_endpoint_allocator
 from hackathon.hazure.constants import (
     ASYNC_OP_QUERY_INTERVAL, ASYNC_OP_RESULT, ASYNC_OP_QUERY_INTERVAL_LONG, REMOTE_CREATED_RECORD)
 
+FEATURE = "azure_vm"
+# async operations are polled every POLL_INTERVAL_SECONDS at first, backing off to ASYNC_OP_QUERY_INTERVAL(_LONG)
+POLL_INTERVAL_SECONDS = 3
+STEP_TIMEOUT_SECONDS = 30 * 60
+
 
 class AzureVMExprStarter(ExprStarter):
     azure_cert_manager = RequiredFeature("azure_cert_manager")
@@ -50,7 +57,7 @@ class AzureVMExprStarter(ExprStarter):
             hackathon = Hackathon.objects.get(id=context.hackathon_id)
             experiment = Experiment.objects.get(id=context.experiment_id)
 
-            self.__start_vm(experiment, hackathon, context.template_content.units)
+            self.__start_vm(experiment, hackathon, self._load_template_content(context).units)
         except Exception as e:
             self.log.error(e)
             experiment.status = EStatus.FAILED
@@ -187,9 +194,32 @@ class AzureVMExprStarter(ExprStarter):
     def __get_adapter_from_sctx(self, sctx, adapter_class):
         return adapter_class(sctx.subscription_id, sctx.pem_url, host=sctx.management_host)
 
+    def __get_network_config(self, ctx, adapter):
+        # public endpoints are allocated from the cached assigned endpoints of cloud service
+        name = ctx.cloud_service_name
+        return get_network_config(
+            ctx.raw_network_config,
+            assign=lambda endpoints: get_endpoint_allocator().allocate(
+                name, endpoints, lambda: adapter.get_assigned_endpoints(name)))
+
+    def __start_step(self, sctx, method, step="setup", timeout_method="_on_virtual_environment_failed",
+                     delay_seconds=0, max_interval_seconds=ASYNC_OP_QUERY_INTERVAL):
+        """Run 'method' in provisioning engine until it returns anything but CONTINUE
+
+        Units of an experiment are set up serially, all steps share one step id so that only the latest is checkpointed
+        """
+        self.provisioning_engine.start_step("%s-%s-%s" % (FEATURE, sctx.experiment_id, step), FEATURE, method, sctx,
+                                            timeout_method=timeout_method,
+                                            timeout_seconds=STEP_TIMEOUT_SECONDS,
+                                            interval_seconds=POLL_INTERVAL_SECONDS,
+                                            max_interval_seconds=max_interval_seconds,
+                                            delay_seconds=delay_seconds)
+
+    def __start_wait_step(self, sctx, method, max_interval_seconds=ASYNC_OP_QUERY_INTERVAL):
+        self.__start_step(sctx, method, delay_seconds=POLL_INTERVAL_SECONDS, max_interval_seconds=max_interval_seconds)
+
     def __schedule_setup(self, sctx):
-        self.scheduler.add_once("azure_vm", "schedule_setup", context=sctx,
-                                id="schedule_setup_" + str(sctx.experiment_id), seconds=0)
+        self.__start_step(sctx, "schedule_setup")
 
     def schedule_setup(self, ctx):
         current_job_index = ctx.current_job_index
@@ -206,9 +236,7 @@ class AzureVMExprStarter(ExprStarter):
         self.log.debug(
             "azure virtual environment %d: '%r' setup progress begin" %
             (current_job_index, job_ctxs[current_job_index]))
-        self.scheduler.add_once("azure_vm", "setup_cloud_service",
-                                id="setup_cloud_service_" + str(ctx.experiment_id),
-                                context=ctx, seconds=0)
+        self.__start_step(ctx, "setup_cloud_service")
 
     def setup_cloud_service(self, sctx):
         # get context from super context
@@ -233,8 +261,7 @@ class AzureVMExprStarter(ExprStarter):
 
             self.log.debug("azure virtual environment %d cloud service setup done" % sctx.current_job_index)
             # next step: setup storage
-            self.scheduler.add_once("azure_vm", "setup_storage", id="setup_storage_" + str(sctx.experiment_id),
-                                    context=sctx, seconds=0)
+            self.__start_step(sctx, "setup_storage")
         except Exception as e:
             self.log.error(
                 "azure virtual environment %d create remote cloud service failed: %r"
@@ -267,8 +294,7 @@ class AzureVMExprStarter(ExprStarter):
             self.log.debug("azure virtual environment %d storage setup done" % sctx.current_job_index)
 
             # next step: setup virtual machine
-            self.scheduler.add_once("azure_vm", "setup_virtual_machine",
-                                    id="setup_virtual_machine_" + str(sctx.experiment_id), context=sctx, seconds=0)
+            self.__start_step(sctx, "setup_virtual_machine")
         except Exception as e:
             self.log.error(
                 "azure virtual environment %d create storage account failed: %r"
@@ -294,9 +320,7 @@ class AzureVMExprStarter(ExprStarter):
         try:
             deployment_name = adapter.get_deployment_name(ctx.cloud_service_name, ctx.deployment_slot)
             if not ctx.is_vm_image:
-                network_config = get_network_config(
-                    ctx.raw_network_config,
-                    adapter.get_assigned_endpoints(ctx.cloud_service_name))
+                network_config = self.__get_network_config(ctx, adapter)
             else:
                 network_config = None
 
@@ -330,6 +354,7 @@ class AzureVMExprStarter(ExprStarter):
             self.log.error(
                 "azure virtual environment %d create virtual machine %r failed: %r"
                 % (sctx.current_job_index, ctx.virtual_machine_name, str(e)))
+            get_endpoint_allocator().invalidate(ctx.cloud_service_name)
             self._on_virtual_environment_failed(sctx)
 
     def __setup_virtual_machine_without_deployment_existed(self, sctx):
@@ -338,9 +363,7 @@ class AzureVMExprStarter(ExprStarter):
 
         try:
             if not ctx.is_vm_image:
-                network_config = get_network_config(
-                    ctx.raw_network_config,
-                    adapter.get_assigned_endpoints(ctx.cloud_service_name))
+                network_config = self.__get_network_config(ctx, adapter)
             else:
                 network_config = None
 
@@ -365,9 +388,10 @@ class AzureVMExprStarter(ExprStarter):
             self.log.error(
                 "azure virtual environment %d create virtual machine %r failed: %r"
                 % (sctx.current_job_index, ctx.virtual_machine_name, str(e)))
+            get_endpoint_allocator().invalidate(ctx.cloud_service_name)
             self._on_virtual_environment_failed(sctx)
 
-    def __check_vm_operation_status(self, sctx, on_success, on_failed, on_continue):
+    def __check_vm_operation_status(self, sctx, on_success, on_failed):
         ctx = sctx.job_ctxs[sctx.current_job_index]
         adapter = self.__get_adapter_from_sctx(sctx, VirtualMachineAdapter)
 
@@ -378,21 +402,17 @@ class AzureVMExprStarter(ExprStarter):
         elif res.error:
             on_failed(sctx)
         else:
-            on_continue(sctx)
+            return CONTINUE
 
     def __wait_for_add_virtual_machine(self, sctx):
         self.log.debug("azure virtual environment: %d, waiting for add virtual machine" % sctx.current_job_index)
-        self.scheduler.add_once(
-            "azure_vm", "wait_for_add_virtual_machine",
-            id="wait_for_add_virtual_machine_" + str(sctx.experiment_id),
-            context=sctx, seconds=ASYNC_OP_QUERY_INTERVAL)
+        self.__start_wait_step(sctx, "wait_for_add_virtual_machine")
 
     def wait_for_add_virtual_machine(self, sctx):
-        self.__check_vm_operation_status(
+        return self.__check_vm_operation_status(
             sctx,
             self.__on_add_virtual_machine_success,
-            self._on_virtual_environment_failed,
-            self.__wait_for_add_virtual_machine)
+            self._on_virtual_environment_failed)
 
     def __on_add_virtual_machine_success(self, sctx):
         ctx = sctx.job_ctxs[sctx.current_job_index]
@@ -407,17 +427,13 @@ class AzureVMExprStarter(ExprStarter):
 
     def __wait_for_create_virtual_machine_deployment(self, sctx):
         self.log.debug("azure virtual environment: %d, waiting for create vm_deployment" % sctx.current_job_index)
-        self.scheduler.add_once(
-            "azure_vm", "wait_for_create_virtual_machine_deployment",
-            id="wait_for_create_virtual_machine_deployment_" + str(sctx.experiment_id),
-            context=sctx, seconds=ASYNC_OP_QUERY_INTERVAL)
+        self.__start_wait_step(sctx, "wait_for_create_virtual_machine_deployment")
 
     def wait_for_create_virtual_machine_deployment(self, sctx):
-        self.__check_vm_operation_status(
+        return self.__check_vm_operation_status(
             sctx,
             self.__on_create_virtual_machine_deployment_success,
-            self._on_virtual_environment_failed,
-            self.__wait_for_create_virtual_machine_deployment)
+            self._on_virtual_environment_failed)
 
     def __on_create_virtual_machine_deployment_success(self, sctx):
         ctx = sctx.job_ctxs[sctx.current_job_index]
@@ -436,9 +452,7 @@ class AzureVMExprStarter(ExprStarter):
         adapter = self.__get_adapter_from_sctx(sctx, VirtualMachineAdapter)
 
         try:
-            network_config = get_network_config(
-                ctx.raw_network_config,
-                adapter.get_assigned_endpoints(ctx.cloud_service_name))
+            network_config = self.__get_network_config(ctx, adapter)
 
             if len(network_config.input_endpoints.input_endpoints) == 0:
                 # don't need to config, skip
@@ -457,29 +471,24 @@ class AzureVMExprStarter(ExprStarter):
             self.log.error(
                 "azure virtual environment %d error while config network: %r" %
                 (sctx.current_job_index, e.message))
+            get_endpoint_allocator().invalidate(ctx.cloud_service_name)
             self._on_virtual_environment_failed(sctx)
 
     def __wait_for_config_virtual_machine(self, sctx):
         self.log.debug("azure virtual environment: %d, waiting for configure network" % sctx.current_job_index)
-        self.scheduler.add_once(
-            "azure_vm", "wait_for_config_virtual_machine",
-            id="wait_for_config_virtual_machine_" + str(sctx.experiment_id),
-            context=sctx, seconds=ASYNC_OP_QUERY_INTERVAL)
+        self.__start_wait_step(sctx, "wait_for_config_virtual_machine")
 
     def wait_for_config_virtual_machine(self, sctx):
-        self.__check_vm_operation_status(
+        return self.__check_vm_operation_status(
             sctx,
 
             # currently we cannot rollback configs, so we don't record here
             self.__wait_for_virtual_machine_ready,
-            self._on_virtual_environment_failed,
-            self.__wait_for_config_virtual_machine)
+            self._on_virtual_environment_failed)
 
     def __wait_for_deployment_ready(self, sctx):
         self.log.debug("azure virtual environment: %d, waiting for deployment ready" % sctx.current_job_index)
-        self.scheduler.add_once(
-            "azure_vm", "wait_for_deployment_ready", id="wait_for_deployment_ready_" + str(sctx.experiment_id),
-            context=sctx, seconds=ASYNC_OP_QUERY_INTERVAL)
+        self.__start_wait_step(sctx, "wait_for_deployment_ready")
 
     def wait_for_deployment_ready(self, sctx):
         ctx = sctx.job_ctxs[sctx.current_job_index]
@@ -507,10 +516,8 @@ class AzureVMExprStarter(ExprStarter):
 
     def __wait_for_virtual_machine_ready(self, sctx):
         self.log.debug("azure virtual environment: %d, waiting for vm ready" % sctx.current_job_index)
-        self.scheduler.add_once(
-            "azure_vm", "wait_for_virtual_machine_ready",
-            id="wait_for_virtual_machine_ready_" + str(sctx.experiment_id),
-            context=sctx, seconds=ASYNC_OP_QUERY_INTERVAL_LONG)
+        self.__start_wait_step(sctx, "wait_for_virtual_machine_ready",
+                               max_interval_seconds=ASYNC_OP_QUERY_INTERVAL_LONG)
 
     def wait_for_virtual_machine_ready(self, sctx):
         ctx = sctx.job_ctxs[sctx.current_job_index]
@@ -537,7 +544,7 @@ class AzureVMExprStarter(ExprStarter):
                 else:
                     self.__setup_virtual_machine_done(sctx)
             else:
-                self.__wait_for_virtual_machine_ready(sctx)
+                return CONTINUE
         except Exception as e:
             self.log.error(
                 "azure virtual environment %d error while waiting for vm readt: %r" %
@@ -596,6 +603,7 @@ class AzureVMExprStarter(ExprStarter):
                         rec.cloud_service_name,
                         rec.deployment_name,
                         True)
+                get_endpoint_allocator().invalidate(rec.cloud_service_name)
             else:
                 self.log.warn("unknown record type: %s" % rec.type)
 
@@ -671,7 +679,7 @@ class AzureVMExprStarter(ExprStarter):
         return aep
 
     def __schedule_stop(self, sctx):
-        self.scheduler.add_once("azure_vm", "schedule_stop", context=sctx, seconds=0)
+        self.__start_step(sctx, "schedule_stop", step="stop", timeout_method="_on_stop_virtual_machine_failed")
 
     def schedule_stop(self, sctx):
         current_job_index = sctx.current_job_index
@@ -684,8 +692,7 @@ class AzureVMExprStarter(ExprStarter):
         self.log.debug(
             "azure virtual environment %d: '%r' stop progress begin" %
             (current_job_index, job_ctxs[current_job_index]))
-        self.scheduler.add_once("azure_vm", "stop_virtual_machine",
-                                id="stop_virtual_machine_" + str(sctx.experiment_id), context=sctx, seconds=0)
+        self.__start_step(sctx, "stop_virtual_machine", step="stop", timeout_method="_on_stop_virtual_machine_failed")
 
     def stop_virtual_machine(self, sctx):
         ctx = sctx.job_ctxs[sctx.current_job_index]
@@ -700,7 +707,7 @@ class AzureVMExprStarter(ExprStarter):
                 self.log.error(
                     "azure virtual environment %d stop vm failed: cannot get status of vm %r" %
                     (sctx.current_job_index, ctx.virtual_machine_name))
-                self.__on_stop_virtual_machine_failed(sctx)
+                self._on_stop_virtual_machine_failed(sctx)
             elif now_status != AVMStatus.STOPPED_DEALLOCATED:
                 try:
                     req = adapter.stop_virtual_machine(
@@ -709,7 +716,7 @@ class AzureVMExprStarter(ExprStarter):
                     self.log.error(
                         "azure virtual environment %d stop vm failed: %r" %
                         (sctx.current_job_index, str(e.message)))
-                    self.__on_stop_virtual_machine_failed(sctx)
+                    self._on_stop_virtual_machine_failed(sctx)
                     return False
 
                 ctx.request_id = req.request_id
@@ -720,22 +727,20 @@ class AzureVMExprStarter(ExprStarter):
             self.log.error(
                 "azure virtual environment %d error while stopping vm: %r" %
                 (sctx.current_job_index, e.message))
-            self.__on_stop_virtual_machine_failed(sctx)
+            self._on_stop_virtual_machine_failed(sctx)
 
     def __wait_for_stop_virtual_machine(self, sctx):
         self.log.debug("azure virtual environment %d, waiting for stop virtual machine" % sctx.current_job_index)
-        self.scheduler.add_once(
-            "azure_vm", "wait_for_stop_virtual_machine",
-            id="wait_for_stop_virtual_machine_" + str(sctx.experiment_id), context=sctx, seconds=ASYNC_OP_QUERY_INTERVAL)
+        self.__start_step(sctx, "wait_for_stop_virtual_machine", step="stop",
+                          timeout_method="_on_stop_virtual_machine_failed", delay_seconds=POLL_INTERVAL_SECONDS)
 
     def wait_for_stop_virtual_machine(self, sctx):
-        self.__check_vm_operation_status(
+        return self.__check_vm_operation_status(
             sctx,
             self.__stop_virtual_machine_done,
-            self.__on_stop_virtual_machine_failed,
-            self.__wait_for_stop_virtual_machine)
+            self._on_stop_virtual_machine_failed)
 
-    def __on_stop_virtual_machine_failed(self, sctx):
+    def _on_stop_virtual_machine_failed(self, sctx):
         try:
             self.log.debug("azure virtual environment %d stop vm failed" % sctx.current_job_index)
             # TODO: rollback
@@ -759,11 +764,11 @@ class AzureVMExprStarter(ExprStarter):
                 virtual_environment_name=ve.name))
 
             self.log.debug("azure virtual environment %d vm success callback done, step to next" % sctx.current_job_index)
-            # step to config next unit
+            # step to stop next unit
             sctx.current_job_index += 1
-            self.__schedule_setup(sctx)
+            self.__schedule_stop(sctx)
         except Exception as e:
             self.log.error(
                 "azure virtual environment %d error while stopping vm: %r" %
                 (sctx.current_job_index, e.message))
-            self.__on_stop_virtual_machine_failed(sctx)
+            self._on_stop_virtual_machine_failed(sctx)
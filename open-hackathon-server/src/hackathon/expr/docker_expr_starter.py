@@ -29,15 +29,17 @@ sys.path.append("..")
 
 import random
 import string
-import pexpect
-from os.path import abspath, dirname, realpath
 
+from hackathon import RequiredFeature
 from hackathon.hmongo.models import Experiment, VirtualEnvironment
 from hackathon.constants import VE_PROVIDER, VEStatus, VERemoteProvider, EStatus
 from expr_starter import ExprStarter
 
 
 class DockerExprStarter(ExprStarter):
+    docker_host_manager = RequiredFeature("docker_host_manager")
+    file_transfer = RequiredFeature("file_transfer")
+
     def _internal_rollback(self, context):
         # currently rollback share the same process as stop
         self._internal_stop_expr(context)
@@ -45,10 +47,24 @@ class DockerExprStarter(ExprStarter):
     def _stop_virtual_environment(self, virtual_environment, experiment, context):
         pass
 
+    def _on_virtual_environment_failed(self, context):
+        # give back the slot and ports reserved on docker host if the container didn't start
+        self._release_reservation(context)
+        super(DockerExprStarter, self)._on_virtual_environment_failed(context)
+
+    def _release_reservation(self, context):
+        """Give back the slot and ports reserved on docker host that the context still holds"""
+        if context.get("reserved_host_server_id"):
+            self.docker_host_manager.release_docker_host(context.reserved_host_server_id)
+            self.docker_host_manager.release_host_ports(context.reserved_host_server_id,
+                                                        context.get("reserved_host_ports"))
+            context.reserved_host_server_id = None
+            context.reserved_host_ports = None
+
     def _internal_start_expr(self, context):
-        for unit in context.template_content.units:
+        for index, unit in enumerate(self._load_template_content(context).units):
             try:
-                self.__start_virtual_environment(context, unit)
+                self.__start_virtual_environment(context, index, unit)
             except Exception as e:
                 self.log.error(e)
                 self._on_virtual_environment_failed(context)
@@ -75,12 +91,21 @@ class DockerExprStarter(ExprStarter):
             context.virtual_environment_name = ve.name
             self._stop_virtual_environment(ve, expr, context)
 
-    def __start_virtual_environment(self, context, docker_template_unit):
+    def _get_unit(self, context):
+        """Get the template unit of the virtual environment that context refers to, with its container name
+
+        :rtype: DockerTemplateUnit
+        """
+        unit = self._load_template_content(context).units[context.unit_index]
+        return unit.overlay(name=context.virtual_environment_name)
+
+    def __start_virtual_environment(self, context, unit_index, docker_template_unit):
         origin_name = docker_template_unit.get_name()
         prefix = str(context.experiment_id)[0:9]
         suffix = "".join(random.sample(string.ascii_letters + string.digits, 8))
         new_name = '%s-%s-%s' % (prefix, origin_name, suffix.lower())
-        docker_template_unit.set_name(new_name)
+        # the unit is shared by experiments of the template, the container name is set on an overlay of it
+        docker_template_unit = docker_template_unit.overlay(name=new_name)
         self.log.debug("starting to start container: %s" % new_name)
 
         # db document for VirtualEnvironment
@@ -97,29 +122,13 @@ class DockerExprStarter(ExprStarter):
 
         # start container remotely , use hosted docker or alauda docker
         context.virtual_environment_name = ve.name
-        context.unit = docker_template_unit
+        context.unit_index = unit_index
         self._internal_start_virtual_environment(context)
 
     def _enable_guacd_file_transfer(self, context):
         """
-        This function should be invoked after container is started in alauda_docker.py and hosted_docker.py
-        :param ve: virtual environment
+        Upload guacctl over SSH. It's the fallback when guacctl cannot be injected at container creation
         """
         expr = Experiment.objects(id=context.experiment_id).no_dereference().first()
         virtual_env = expr.virtual_environments.get(name=context.virtual_environment_name)
-        remote = virtual_env.remote_paras
-
-        p = pexpect.spawn("scp -P %s %s %s@%s:/usr/local/sbin/guacctl" %
-                          (remote["port"],
-                           abspath("%s/../expr/guacctl" % dirname(realpath(__file__))),
-                           remote["username"],
-                           remote["hostname"]))
-        i = p.expect([pexpect.TIMEOUT, 'yes/no', 'password: '])
-        if i == 1:
-            p.sendline("yes")
-            i = p.expect([pexpect.TIMEOUT, 'password:'])
-
-        if i != 0:
-            p.sendline(remote["password"])
-            p.expect(pexpect.EOF)
-        p.close()
+        self.file_transfer.upload_guacctl(virtual_env.remote_paras)
@@ -31,15 +31,23 @@ from datetime import timedelta
 
 from werkzeug.exceptions import PreconditionFailed, NotFound
 from mongoengine import Q
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from hackathon import Component, RequiredFeature, Context
 from hackathon.constants import EStatus, VERemoteProvider, VE_PROVIDER, VEStatus, ReservedUser, \
     HACK_NOTICE_EVENT, HACK_NOTICE_CATEGORY, CLOUD_PROVIDER, HACKATHON_CONFIG
 from hackathon.hmongo.models import Experiment, User, Hackathon, UserHackathon
 from hackathon.hackathon_response import not_found, ok
+from hackathon.util import safe_get_config
 
 __all__ = ["ExprManager"]
 
+# id of the job that wakes up at the soonest expires_at of experiments
+RECYCLE_JOB_ID = "recycle_expired_exprs"
+
+# expired experiments are stopped concurrently in batches
+recycle_executor = ThreadPoolExecutor(max_workers=safe_get_config("recycle.max_workers", 4))
+
 
 class ExprManager(Component):
     user_manager = RequiredFeature("user_manager")
@@ -47,6 +55,7 @@ class ExprManager(Component):
     admin_manager = RequiredFeature("admin_manager")
     template_library = RequiredFeature("template_library")
     hosted_docker_proxy = RequiredFeature("hosted_docker_proxy")
+    warm_pool = RequiredFeature("warm_pool")
 
     def start_expr(self, user, template_name, hackathon_name=None):
         """
@@ -90,6 +99,8 @@ class ExprManager(Component):
             return not_found('Experiment is not running')
 
         expr.last_heart_beat_time = self.util.get_now()
+        if expr.user:
+            expr.expires_at = self.hackathon_manager.get_expr_expire_time(expr.hackathon)
         expr.save()
         return ok()
 
@@ -123,6 +134,7 @@ class ExprManager(Component):
                 and len(virtual_environment_list) == experiment.template.virtual_environment_count:
             experiment.status = EStatus.RUNNING
             experiment.save()
+            self.on_expr_started(experiment)
             try:
                 self.template_library.template_verified(experiment.template.id)
             except:
@@ -132,86 +144,99 @@ class ExprManager(Component):
         # get a list of all experiments' detail
         user_name = context.user_name if "user_name" in context else None
         status = context.status if "status" in context else None
-        page = int(context.page) if "page" in context else 1
-        per_page = int(context.per_page) if "per_page" in context else 10
         users = User.objects(name=user_name).all() if user_name else []
 
         if user_name and status:
-            experiments_pagi = Experiment.objects(hackathon=hackathon, status=status, user__in=users).paginate(page, per_page)
+            experiments = Experiment.objects(hackathon=hackathon, status=status, user__in=users)
         elif user_name and not status:
-            experiments_pagi = Experiment.objects(hackathon=hackathon, user__in=users).paginate(page, per_page)
+            experiments = Experiment.objects(hackathon=hackathon, user__in=users)
         elif not user_name and status:
-            experiments_pagi = Experiment.objects(hackathon=hackathon, status=status).paginate(page, per_page)
+            experiments = Experiment.objects(hackathon=hackathon, status=status)
         else:
-            experiments_pagi = Experiment.objects(hackathon=hackathon).paginate(page, per_page)
+            experiments = Experiment.objects(hackathon=hackathon)
+
+        experiments_pagi = self.util.paginate_query(experiments, context, "-id", default_per_page=10)
 
         return self.util.paginate(experiments_pagi, self.__get_expr_with_detail)
 
     def scheduler_recycle_expr(self):
-        """recycle experiment according to hackathon basic info on recycle configuration
-
-        According to the hackathon's basic info on 'recycle_enabled', find out time out experiments
-        Then call function to recycle them
+        """Safety net of recycle, called by scheduled job
 
-        :return:
+        Experiments are recycled by recycle_expired_exprs at their expires_at. This one fills expires_at of the
+        experiments started before it's introduced, recycles whatever left expired in case the wake-up job was missed
+        and arms the wake-up job again.
         """
         self.log.debug("start checking recyclable experiment ... ")
         for hackathon in self.hackathon_manager.get_recyclable_hackathon_list():
             try:
-                # check recycle enabled
                 mins = self.hackathon_manager.get_recycle_minutes(hackathon)
-                # filter out the experiments that need to be recycled
-                exprs = Experiment.objects(create_time__lt=self.util.get_now() - timedelta(minutes=mins),
-                                           status=EStatus.RUNNING,
-                                           hackathon=hackathon)
+                exprs = Experiment.objects(hackathon=hackathon, status=EStatus.RUNNING, expires_at=None,
+                                           user__ne=None).only("create_time")
                 for expr in exprs:
-                    self.__recycle_expr(expr)
+                    expr.update(set__expires_at=expr.create_time + timedelta(minutes=mins))
             except Exception as e:
                 self.log.error(e)
 
+        return self.recycle_expired_exprs()
+
+    def recycle_expired_exprs(self):
+        """Recycle the experiments whose expires_at passed, then wake up again at the next expires_at
+
+        Expired experiments are taken in batches of 'recycle.batch_size' and recycled concurrently. An experiment is
+        claimed by clearing its expires_at before recycling, so that it's never recycled twice by processes.
+
+        :rtype: int
+        :return: count of experiments recycled
+        """
+        batch_size = safe_get_config("recycle.batch_size", 50)
+        recycled = 0
+        while True:
+            exprs = list(Experiment.objects(status=EStatus.RUNNING,
+                                            expires_at__lte=self.util.get_now()).order_by("expires_at").limit(batch_size))
+            batch = [e for e in exprs
+                     if Experiment.objects(id=e.id, expires_at=e.expires_at).update_one(unset__expires_at=True)]
+            if batch:
+                wait([recycle_executor.submit(self.__safe_recycle_expr, e) for e in batch])
+                recycled += len(batch)
+            if len(exprs) < batch_size:
+                break
+
+        if recycled:
+            self.log.debug("%d expired experiments recycled" % recycled)
+        self.arm_recycle_job()
+        return recycled
+
+    def arm_recycle_job(self, expires_at=None):
+        """Make sure the recycle job wakes up no later than expires_at
+
+        :type expires_at: datetime
+        :param expires_at: the expires_at that just set. The soonest expires_at of all experiments if None
+        """
+        if expires_at is None:
+            expr = Experiment.objects(status=EStatus.RUNNING, expires_at__ne=None).order_by("expires_at").only(
+                "expires_at").first()
+            if not expr:
+                return
+            expires_at = expr.expires_at
+
+        next_run_time = self.scheduler.get_next_run_time(RECYCLE_JOB_ID)
+        if next_run_time and next_run_time <= expires_at:
+            return
+
+        # a date job in the past is regarded as missed by apscheduler
+        run_date = max(expires_at, self.util.get_now() + timedelta(seconds=1))
+        self.scheduler.add_once("expr_manager", "recycle_expired_exprs",
+                                id=RECYCLE_JOB_ID,
+                                run_date=run_date,
+                                durable=True)
+
     def pre_allocate_expr(self, context):
-        # TODO: too complex, not check
+        """Fill the warm pools of a hackathon, called by scheduled job. See WarmPool"""
         hackathon_id = context.hackathon_id
         self.log.debug("executing pre_allocate_expr for hackathon %s " % hackathon_id)
         hackathon = Hackathon.objects(id=hackathon_id).first()
-        hackathon_templates = hackathon.templates
-        for template in hackathon_templates:
-            try:
-                template = template
-                pre_num = int(hackathon.config.get("pre_allocate_number", 1))
-                query = Q(status=EStatus.STARTING) | Q(status=EStatus.RUNNING)
-                curr_num = Experiment.objects(user=None, hackathon=hackathon, template=template).filter(query).count()
-                if template.provider == VE_PROVIDER.AZURE:
-                    if curr_num < pre_num:
-                        remain_num = pre_num - curr_num
-                        start_num = Experiment.objects(user=None, template=template, status=EStatus.STARTING).count()
-                        if start_num > 0:
-                            self.log.debug("there is an azure env starting, will check later ... ")
-                            return
-                        else:
-                            self.log.debug(
-                                "no starting template: %s , remain num is %d ... " % (template.name, remain_num))
-                            self.start_expr(None, template.name, hackathon.name)
-                            break
-                elif template.provider == VE_PROVIDER.DOCKER:
-                    if hackathon.config.get('cloud_provider') == CLOUD_PROVIDER.ALAUDA:
-                        # don't create pre-env if alauda used
-                        continue
-
-                    self.log.debug(
-                        "template name is %s, hackathon name is %s" % (template.name, hackathon.name))
-                    if curr_num < pre_num:
-                        remain_num = pre_num - curr_num
-                        start_num = Experiment.objects(user=None, template=template, status=EStatus.STARTING).count()
-                        if start_num > 0:
-                            self.log.debug("there is an docker container starting, will check later ... ")
-                            return
-                        self.log.debug("no idle template: %s, remain num is %d ... " % (template.name, remain_num))
-                        self.start_expr(None, template.name, hackathon.name)
-                        break
-            except Exception as e:
-                self.log.error(e)
-                self.log.error("check default experiment failed")
+        if hackathon:
+            return self.warm_pool.fill(hackathon)
 
     def assign_expr_to_admin(self, expr):
         """assign expr to admin to trun expr into pre_allocate_expr
@@ -222,6 +247,7 @@ class ExprManager(Component):
         :return:
         """
         expr.user = None
+        expr.expires_at = None
         expr.save()
 
     # --------------------------------------------- helper function ---------------------------------------------#
@@ -276,8 +302,24 @@ class ExprManager(Component):
         return self.__report_expr_status(context.experiment)
 
     def on_expr_started(self, experiment):
-        hackathon = experiment.hackathon
-        user = experiment.user
+        """Called when all virtual environments of the experiment are running
+
+        :type experiment: Experiment
+        :param experiment: the experiment started
+        """
+        if not experiment or not experiment.user:
+            # pre-allocated experiment that waits in warm pool
+            return
+
+        self.warm_pool.on_cold_start(experiment)
+        self.set_expr_expire_time(experiment)
+
+    def set_expr_expire_time(self, experiment):
+        """Start counting down the recycle of an experiment that a user just got"""
+        expires_at = self.hackathon_manager.get_expr_expire_time(experiment.hackathon)
+        experiment.update(set__expires_at=expires_at)
+        if expires_at:
+            self.arm_recycle_job(expires_at)
 
     def __report_expr_status(self, expr, isToConfirmExprStarting=False):
         # todo check whether need to restart Window-expr and Alauda-expr if it shutdown
@@ -382,11 +424,7 @@ class ExprManager(Component):
             return expr
 
         # try to assign pre-configured expr to user
-        expr = Experiment.objects(status=EStatus.RUNNING, hackathon=hackathon, template=template, user=None).first()
-        if expr:
-            expr.user = user
-            expr.save()
-            return expr
+        return self.warm_pool.claim(user, hackathon, template)
 
     def roll_back(self, expr_id):
         """
@@ -434,6 +472,12 @@ class ExprManager(Component):
         experiment.update_time = self.util.get_now()
         experiment.save()
 
+    def __safe_recycle_expr(self, expr):
+        try:
+            self.__recycle_expr(expr)
+        except Exception as e:
+            self.log.error(e)
+
     def __recycle_expr(self, expr):
         """recycle expr
 
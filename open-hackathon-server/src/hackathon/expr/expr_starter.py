@@ -38,6 +38,8 @@ class ExprStarter(Component):
     """Base for experiment starter"""
 
     template_library = RequiredFeature("template_library")
+    provisioning_engine = RequiredFeature("provisioning_engine")
+    expr_manager = RequiredFeature("expr_manager")
 
     def start_expr(self, context):
         """To start a new Experiment asynchronously
@@ -46,7 +48,10 @@ class ExprStarter(Component):
         :param context: the execution context.
 
         """
+        now = self.util.get_now()
         expr = Experiment(status=EStatus.INIT,
+                          create_time=now,
+                          update_time=now,
                           template=context.template,
                           user=context.user,
                           virtual_environments=[],
@@ -54,11 +59,15 @@ class ExprStarter(Component):
         expr.save()
 
         template_content = self.template_library.load_template(context.template)
+        if template_content is None:
+            raise Exception("cannot load template %s" % context.template.name)
         expr.status = EStatus.STARTING
         expr.save()
 
-        # context contains complex object, we need create another serializable one with only simple fields
-        new_context = Context(template_content=template_content,
+        # context contains complex object, we need create another serializable one with only simple fields. The
+        # template is referred by id and version, it's resolved from the compiled templates when a step runs
+        new_context = Context(template_id=context.template.id,
+                              template_hash=context.template.content_hash,
                               template_name=context.template.name,
                               hackathon_id=context.hackathon.id,
                               experiment_id=expr.id)
@@ -86,6 +95,13 @@ class ExprStarter(Component):
         """
         return self._internal_rollback(context)
 
+    def _load_template_content(self, context):
+        """Get the TemplateContent referred by context, it's shared so don't modify it
+
+        :rtype: TemplateContent
+        """
+        return self.template_library.load_template_by_ref(context.template_id, context.get("template_hash"))
+
     def _internal_start_expr(self, context):
         raise NotImplementedError()
 
@@ -131,4 +147,4 @@ class ExprStarter(Component):
 
     def _on_expr_started(self, context):
         # send notice
-        pass
+        self.expr_manager.on_expr_started(Experiment.objects(id=context.experiment_id).first())
@@ -27,36 +27,56 @@ THE SOFTWARE.
 import sys
 
 sys.path.append("..")
-from compiler.ast import flatten
-from threading import Lock
 
 from docker_expr_starter import DockerExprStarter
 from hackathon import RequiredFeature, Context
+from hackathon.provisioning_engine import CONTINUE
 from hackathon.hmongo.models import Hackathon, Experiment, DockerContainer, PortBinding, DockerHostServer, AzureKey
 from hackathon.constants import DHS_QUERY_STATE, EStatus, AVMStatus, VERemoteProvider, VEStatus
 from hackathon.template import DOCKER_UNIT
 
-FEATURE = "huawei_docker"
+FEATURE = "huawei_cce_docker"
 IN_PROGRESS = 'InProgress'
 SUCCEEDED = 'Succeeded'
-MAX_TRIAL = 20
 TRIAL_INTERVAL_SECONDS = 3
+HOST_TIMEOUT_SECONDS = 60
 DEPLOYMENT_SLOT = "Production"
 
 class HuaweiExprStarter(DockerExprStarter):
     docker = RequiredFeature("huawei_docker_proxy")
     docker_host_manager = RequiredFeature("docker_host_manager")
-    host_ports = []
-    host_port_max_num = 30
 
     def _internal_start_virtual_environment(self, context):
-        self.get_docker_host_server(context)
+        step_id = "%s-%s-%s-start" % (FEATURE, context.experiment_id, context.virtual_environment_name)
+        self.provisioning_engine.start_step(step_id, FEATURE, "get_docker_host_server", context,
+                                            timeout_method="_on_virtual_environment_failed",
+                                            timeout_seconds=HOST_TIMEOUT_SECONDS,
+                                            interval_seconds=TRIAL_INTERVAL_SECONDS,
+                                            max_interval_seconds=TRIAL_INTERVAL_SECONDS)
 
     def _get_docker_proxy(self):
         return self.docker
 
+    def _stop_virtual_environment(self, virtual_environment, experiment, context):
+        container = virtual_environment.docker_container
+        if virtual_environment.status == VEStatus.RUNNING and container:
+            host_server = container.host_server
+            try:
+                self.docker.stop_container(host_server, container.name)
+            except Exception as e:
+                self.log.error(e)
+            finally:
+                # the slot and ports reserved on docker host are given back even if the container fails to be removed
+                self.docker_host_manager.release_docker_host(host_server)
+                self.docker_host_manager.release_host_ports(host_server,
+                                                            [p.host_port for p in container.port_bindings])
+
+        self._on_virtual_environment_stopped(context)
+
     def get_docker_host_server(self, context):
         # TODO: currently do nothing
+        # a retry of the step after a reservation was made, reserve again from scratch
+        self._release_reservation(context)
         hackathon = Hackathon.objects(id=context.hackathon_id).no_dereference().first()
         try:
             host_resp = self.docker_host_manager.get_available_docker_host(hackathon)
@@ -64,23 +84,21 @@ class HuaweiExprStarter(DockerExprStarter):
             self.log.error(e)
             host_resp = Context(state=DHS_QUERY_STATE.ONGOING)
 
-        context.trial = context.get("trial", 0) + 1
         if host_resp.state == DHS_QUERY_STATE.SUCCESS:
             # start successfully, context will contains a DockerHostServer object
-            # and assign ports
+            # and assign ports. A slot is reserved, it's released on failure
+            context.reserved_host_server_id = host_resp.docker_host_server.id
             self.__assign_ports(context, host_resp.docker_host_server)
-        elif host_resp.state == DHS_QUERY_STATE.ONGOING and context.trial < MAX_TRIAL:
-            # tried up to 20 times
-            self.log.debug("host servers are all busy, %d times tried, will retry in %d seconds" %
-                           (context.trial, TRIAL_INTERVAL_SECONDS))
-            self.scheduler.add_once(FEATURE, "get_docker_host_server", context, seconds=TRIAL_INTERVAL_SECONDS)
+        elif host_resp.state == DHS_QUERY_STATE.ONGOING:
+            self.log.debug("host servers are all busy, will retry in %d seconds" % TRIAL_INTERVAL_SECONDS)
+            return CONTINUE
         else:
             self.log.error("no available host server")
             self._on_virtual_environment_failed(context)
 
     def __assign_ports(self, context, host_server):
         self.log.debug("try to assign port on server %r" % host_server)
-        unit = context.unit
+        unit = self._get_unit(context)
         experiment = Experiment.objects(id=context.experiment_id).no_dereference().first()
         virtual_environment = experiment.virtual_environments.get(name=context.virtual_environment_name)
         container = DockerContainer(name=virtual_environment.name,
@@ -96,42 +114,21 @@ class HuaweiExprStarter(DockerExprStarter):
 
     def __assign_host_ports(self, context, host_server):
         """assign ports that map a port on docker host server to a port inside docker"""
-        unit = context.unit
+        unit = self._get_unit(context)
         # assign host port
         try:
             port_cfg = unit.get_ports()
-            for cfg in port_cfg:
-                cfg[DOCKER_UNIT.PORTS_HOST_PORT] = self.__get_available_host_port(host_server,
-                                                                                  cfg[DOCKER_UNIT.PORTS_PORT])
-            context.port_config = port_cfg
+            host_ports = self.docker_host_manager.reserve_host_ports(host_server,
+                                                                     [cfg[DOCKER_UNIT.PORTS_PORT] for cfg in port_cfg])
+            context.reserved_host_ports = host_ports
+            # copy the port config of unit which is shared by experiments of the template
+            context.port_config = [dict(cfg, **{DOCKER_UNIT.PORTS_HOST_PORT: host_port})
+                                   for cfg, host_port in zip(port_cfg, host_ports)]
             self.__assign_public_ports(context, host_server)
         except Exception as e:
             self.log.error(e)
             self._on_virtual_environment_failed(context)
 
-    def __get_available_host_port(self, docker_host, private_port):
-        """
-        We use double operation to ensure ports not conflicted, first we get ports from host machine, but in multiple
-        threads situation, the interval between two requests is too short, maybe the first thread do not get port
-        ended, so the host machine don't update ports in time, thus the second thread may get the same port.
-        To avoid this condition, we use static variable host_ports to cache the latest host_port_max_num ports.
-        Every thread visit variable host_ports is synchronized.
-        To save space, we will release the ports if the number over host_port_max_num.
-        :param docker_host:
-        :param private_port:
-        :return:
-        """
-        self.log.debug("try to assign docker port %d on server %r" % (private_port, docker_host))
-        containers = self.docker.list_containers(docker_host)
-        used_host_ports = flatten(map(lambda p: p['Ports'], containers))
-
-        # todo if azure return -1
-        def sub(port):
-            return port["PublicPort"] if "PublicPort" in port else -1
-
-        used_public_ports = map(lambda x: sub(x), used_host_ports)
-        return self.__safe_get_host_port(used_public_ports, private_port)
-
     def __assign_public_ports(self, context, host_server):
         """assign ports on azure cloud service that map a public port to a port inside certain VM"""
         port_cfg = context.port_config
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+#
+# -----------------------------------------------------------------------------------
+# Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+#
+# The MIT License (MIT)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+# -----------------------------------------------------------------------------------
+
+
+import sys
+
+sys.path.append("..")
+
+import time
+from threading import Lock
+
+from concurrent.futures import ThreadPoolExecutor
+
+from hackathon import Component, RequiredFeature, Context
+from hackathon.constants import EStatus, VE_PROVIDER, CLOUD_PROVIDER, HACKATHON_CONFIG, HEALTH, HEALTH_STATUS
+from hackathon.hmongo.models import Experiment, Hackathon
+from hackathon.hackathon_scheduler import acquire_lease, release_lease
+from hackathon.util import safe_get_config
+
+__all__ = ["WarmPool"]
+
+# experiments of the pool are started concurrently, every start talks to cloud/docker hosts for a while
+fill_executor = ThreadPoolExecutor(max_workers=safe_get_config("warm_pool.fill_workers", 8))
+
+# counters of claims in current process
+pool_stats = {
+    "hits": 0,
+    "misses": 0,
+    "claim_seconds": 0.0,
+    "max_claim_seconds": 0.0,
+    "cold_starts": 0,
+    "cold_start_seconds": 0.0,
+    "max_cold_start_seconds": 0.0
+}
+pool_stats_lock = Lock()
+
+
+class WarmPool(Component):
+    """Keep a number of idle running experiments per (hackathon, template) that are given to users instantly
+
+    The target size of the pool is HACKATHON_CONFIG.PRE_ALLOCATE_NUMBER of the hackathon. The pool is filled by the
+    scheduled job 'pre_allocate_expr' as well as right after each claim. Missing experiments are started in parallel,
+    but no more than 'max_starting' of a template are starting at the same time so that a big pool won't flood the
+    docker hosts or the cloud API. A pool is filled by one process at a time: the pool is leased in MongoDB until the
+    starts submitted by the fill are done and their experiments saved, so that concurrent fills count them and won't
+    overshoot. The fill itself doesn't wait for the starts.
+
+    An idle experiment is one that's RUNNING and has no user. It's claimed by setting its user in a single
+    find_and_modify, two users never get the same experiment even if they are served by different processes.
+    """
+    expr_manager = RequiredFeature("expr_manager")
+
+    def fill(self, hackathon):
+        """Start experiments until the pool of every template of the hackathon reaches its target size
+
+        :type hackathon: Hackathon
+        :param hackathon: the hackathon whose pools to be filled
+
+        :rtype: int
+        :return: count of experiments submitted to start
+        """
+        if hackathon.config.get(HACKATHON_CONFIG.CLOUD_PROVIDER) == CLOUD_PROVIDER.ALAUDA:
+            # don't create pre-env if alauda used
+            return 0
+
+        target = int(hackathon.config.get(HACKATHON_CONFIG.PRE_ALLOCATE_NUMBER, 1))
+        max_starting = int(hackathon.config.get(HACKATHON_CONFIG.PRE_ALLOCATE_CONCURRENCY,
+                                                safe_get_config("warm_pool.max_starting", 5)))
+
+        submitted = 0
+        for template in hackathon.templates:
+            if template.provider not in [VE_PROVIDER.DOCKER, VE_PROVIDER.AZURE]:
+                continue
+
+            lease_key = "warm_pool_%s_%s" % (hackathon.id, template.id)
+            if not acquire_lease(lease_key, safe_get_config("warm_pool.fill_lease_seconds", 600)):
+                self.log.debug("warm pool of template %s is being filled by another process" % template.name)
+                continue
+
+            futures = []
+            try:
+                idle = Experiment.objects(status=EStatus.RUNNING, hackathon=hackathon, template=template,
+                                          user=None).count()
+                # experiments stay INIT until their templates are loaded
+                starting = Experiment.objects(status__in=[EStatus.INIT, EStatus.STARTING], hackathon=hackathon,
+                                              template=template, user=None).count()
+                count = min(target - idle - starting, max_starting - starting)
+                if count > 0:
+                    self.log.debug("warm pool of template %s: %d idle, %d starting, start %d more" % (
+                        template.name, idle, starting, count))
+                    futures = [fill_executor.submit(self.__start, hackathon.name, template.name)
+                               for i in range(count)]
+                    submitted += count
+            finally:
+                # experiments are saved once their starts are done, the next fill counts them
+                self.__release_when_done(lease_key, futures)
+
+        return submitted
+
+    def refill(self, context):
+        """Fill the pools of a hackathon, called by the job scheduled after claims
+
+        :type context: Context
+        :param context: with hackathon_id
+        """
+        hackathon = Hackathon.objects(id=context.hackathon_id).first()
+        if hackathon:
+            return self.fill(hackathon)
+
+    def claim(self, user, hackathon, template):
+        """Give an idle experiment of the pool to user
+
+        :type user: User
+        :param user: the user who starts experiment
+
+        :type hackathon: Hackathon
+        :param hackathon: the hackathon
+
+        :type template: Template
+        :param template: the template to start
+
+        :rtype: Experiment
+        :return: the experiment claimed, None if pool is empty
+        """
+        start = time.time()
+        expr = Experiment.objects(status=EStatus.RUNNING, hackathon=hackathon, template=template, user=None).modify(
+            new=True,
+            set__user=user,
+            set__update_time=self.util.get_now())
+        seconds = time.time() - start
+
+        with pool_stats_lock:
+            if expr:
+                pool_stats["hits"] += 1
+                pool_stats["claim_seconds"] += seconds
+                pool_stats["max_claim_seconds"] = max(pool_stats["max_claim_seconds"], seconds)
+            else:
+                pool_stats["misses"] += 1
+
+        if expr:
+            self.log.debug("experiment %s of warm pool claimed by user %s" % (expr.id, user.id))
+            self.expr_manager.set_expr_expire_time(expr)
+
+        # the pool shrinks by a claim and must be refilled before the next tick of 'pre_allocate_expr'. Jobs of the
+        # same hackathon are merged by the job id
+        if hackathon.config.get(HACKATHON_CONFIG.PRE_ALLOCATE_ENABLED, False):
+            self.scheduler.add_once("warm_pool", "refill",
+                                    context=Context(hackathon_id=hackathon.id),
+                                    id="warm_pool_refill_" + str(hackathon.id),
+                                    seconds=1)
+        return expr
+
+    def on_cold_start(self, experiment):
+        """Record the time a user waited for an experiment not from the pool
+
+        :type experiment: Experiment
+        :param experiment: the experiment that just turned RUNNING
+        """
+        if not experiment.user or not experiment.create_time:
+            return
+
+        seconds = (self.util.get_now() - experiment.create_time).total_seconds()
+        with pool_stats_lock:
+            pool_stats["cold_starts"] += 1
+            pool_stats["cold_start_seconds"] += seconds
+            pool_stats["max_cold_start_seconds"] = max(pool_stats["max_cold_start_seconds"], seconds)
+
+    def stats(self):
+        """Return the hit rate of pool and the time users wait for an experiment
+
+        :rtype: dict
+        """
+        hits, misses, cold_starts = pool_stats["hits"], pool_stats["misses"], pool_stats["cold_starts"]
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(float(hits) / (hits + misses), 3) if hits + misses else 0,
+            "avg_claim_seconds": round(pool_stats["claim_seconds"] / hits, 3) if hits else 0,
+            "max_claim_seconds": round(pool_stats["max_claim_seconds"], 3),
+            "cold_starts": cold_starts,
+            "avg_cold_start_seconds": round(pool_stats["cold_start_seconds"] / cold_starts, 3) if cold_starts else 0,
+            "max_cold_start_seconds": round(pool_stats["max_cold_start_seconds"], 3)
+        }
+
+    def report_health(self):
+        """Report the pool stats as a health check item"""
+        stats = self.stats()
+        stats[HEALTH.STATUS] = HEALTH_STATUS.OK
+        return stats
+
+    def __release_when_done(self, lease_key, futures):
+        """Release the lease of a pool once all the starts submitted by a fill are done"""
+        remaining = [len(futures)]
+        lock = Lock()
+
+        def on_done(future):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            release_lease(lease_key)
+
+        if not futures:
+            release_lease(lease_key)
+        for future in futures:
+            future.add_done_callback(on_done)
+
+    def __start(self, hackathon_name, template_name):
+        try:
+            resp = self.expr_manager.start_expr(None, template_name, hackathon_name)
+            if self.util.is_error(resp) or resp.get("status") == EStatus.FAILED:
+                self.log.warn("fail to start experiment of template %s for warm pool: %s" % (template_name, resp))
+                return False
+            return True
+        except Exception as e:
+            self.log.error(e)
+            return False
@@ -32,6 +32,7 @@ from mongoengine import Q
 
 from hackathon import Component, RequiredFeature
 from hackathon.hmongo.models import Hackathon, User, UserHackathon
+from hackathon.hmongo.batch_loader import get_loader
 from hackathon.constants import HACK_USER_TYPE, HACK_USER_STATUS
 from hackathon.hackathon_response import precondition_failed, ok, not_found, internal_server_error, bad_request
 
@@ -87,8 +88,8 @@ class AdminManager(Component):
         :rtype: list
         :return list of administrators including the detail information
         """
-        user_hackathon_rels = UserHackathon.objects(hackathon=hackathon,
-                                                    role__in=[HACK_USER_TYPE.ADMIN, HACK_USER_TYPE.JUDGE]).all()
+        user_hackathon_rels = get_loader(User).resolve(
+            UserHackathon.objects(hackathon=hackathon, role__in=[HACK_USER_TYPE.ADMIN, HACK_USER_TYPE.JUDGE]), "user")
 
         def get_admin_details(rel):
             dic = rel.dic()
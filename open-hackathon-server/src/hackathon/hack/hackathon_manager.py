@@ -34,10 +34,12 @@ from werkzeug.exceptions import PreconditionFailed, InternalServerError, BadRequ
 from flask import g, request
 import lxml
 from lxml.html.clean import Cleaner
-from mongoengine import Q
+from mongoengine import Q, NotUniqueError
 
 from hackathon.hmongo.models import Hackathon, UserHackathon, DockerHostServer, User, HackathonNotice, HackathonStat, \
     Organization, Award, Team
+from hackathon.hmongo.batch_loader import get_loader
+from hackathon.hmongo.projection import Projection
 from hackathon.hackathon_response import internal_server_error, ok, not_found, general_error, HTTP_CODE, bad_request
 from hackathon.constants import HACKATHON_CONFIG, HACK_USER_TYPE, HACK_STATUS, HACK_USER_STATUS, HTTP_HEADER, \
     FILE_TYPE, HACK_TYPE, HACKATHON_STAT, DockerHostServerStatus, HACK_NOTICE_CATEGORY, HACK_NOTICE_EVENT, \
@@ -49,6 +51,11 @@ __all__ = ["HackathonManager"]
 
 util = RequiredFeature("util")
 
+# fields of hackathons in hackathon list
+HACKATHON_LIST = Projection(Hackathon)
+# fields of notices in notice list
+NOTICE_LIST = Projection(HackathonNotice)
+
 
 class HackathonManager(Component):
     """Component to manage hackathon
@@ -116,13 +123,11 @@ class HackathonManager(Component):
             return self.__get_hackathon_stat(hackathon)
 
         cache_key = "hackathon_stat_%s" % hackathon.id
-        return self.cache.get_cache(key=cache_key, createfunc=internal_get_stat)
+        return self.cache.get_cache(key=cache_key, createfunc=internal_get_stat, namespace="hackathon_stat")
 
     # TODO: implement HackathonStat related features: order_by == 'registered_users_num':
     def get_hackathon_list(self, args):
         # get values from request's QueryString
-        page = int(args.get("page", 1))
-        per_page = int(args.get("per_page", 20))
         order_by = args.get("order_by", "create_time")
         status = args.get("status")
         name = args.get("name")
@@ -144,27 +149,29 @@ class HackathonManager(Component):
             order_by_condition = '-event_start_time'
         elif order_by == 'registered_users_num':  # 人气热点
             # hackathons with zero registered users would not be shown.
-            hot_hackathon_stat = HackathonStat.objects(type=HACKATHON_STAT.REGISTER, count__gt=0).order_by('-count')
+            hot_hackathon_stat = HackathonStat.objects(type=HACKATHON_STAT.REGISTER, count__gt=0).order_by(
+                '-count').only("hackathon").no_dereference()
             hot_hackathon_list = [stat.hackathon.id for stat in hot_hackathon_stat]
             condition_filter = Q(id__in=hot_hackathon_list)
         else:
             order_by_condition = '-id'
 
-        # perform db query with pagination
-        pagination = Hackathon.objects(status_filter & name_filter & condition_filter).order_by(
-            order_by_condition).paginate(page,
-                                         per_page)
+        # perform db query with pagination, by page number or by cursor. Hackathons are raw documents
+        pagination = self.util.paginate_query(
+            HACKATHON_LIST.apply(Hackathon.objects(status_filter & name_filter & condition_filter)),
+            args,
+            order_by_condition)
 
-        hackathon_list = pagination.items
-        hackathon_stat = HackathonStat.objects(hackathon__in=hackathon_list)
+        hackathon_list = [h["_id"] for h in pagination.items]
+        hackathon_stat = list(HackathonStat.objects(hackathon__in=hackathon_list).no_dereference())
 
         user = None
         user_hackathon = []
         team = []
         if self.user_manager.validate_login():
             user = g.user
-            user_hackathon = UserHackathon.objects(user=user, hackathon__in=hackathon_list)
-            team = Team.objects(members__user=user, hackathon__in=hackathon_list)
+            user_hackathon = list(UserHackathon.objects(user=user, hackathon__in=hackathon_list).no_dereference())
+            team = list(Team.objects(members__user=user, hackathon__in=hackathon_list).no_dereference())
 
         def func(hackathon):
             return self.__fill_hackathon_detail(hackathon, user, hackathon_stat, user_hackathon, team)
@@ -176,7 +183,8 @@ class HackathonManager(Component):
         return Hackathon.objects(status=HACK_STATUS.ONLINE)
 
     def get_user_hackathon_list_with_detail(self, user_id):
-        user_hackathon_rels = UserHackathon.objects(user=user_id, role=HACK_USER_TYPE.COMPETITOR).all()
+        user_hackathon_rels = get_loader(Hackathon).resolve(
+            UserHackathon.objects(user=user_id, role=HACK_USER_TYPE.COMPETITOR), "hackathon")
 
         def get_user_hackathon_detail(user_hackathon_rel):
             dict = user_hackathon_rel.dic()
@@ -227,6 +235,16 @@ class HackathonManager(Component):
         minutes = self.get_basic_property(hackathon, key, 60)
         return int(minutes)
 
+    def get_expr_expire_time(self, hackathon):
+        """Return the time to recycle an experiment of the hackathon that is started or used right now
+
+        :rtype: datetime
+        :return: None if recycle not enabled
+        """
+        if not self.is_recycle_enabled(hackathon):
+            return None
+        return self.util.get_now() + timedelta(minutes=self.get_recycle_minutes(hackathon))
+
     def validate_hackathon_name(self):
         if HTTP_HEADER.HACKATHON_NAME in request.headers:
             try:
@@ -310,6 +328,7 @@ class HackathonManager(Component):
         hackathon = g.hackathon
         try:
             UserHackathon.objects(hackathon=hackathon).delete()
+            HackathonStat.objects(hackathon=hackathon).delete()
             self.log.debug("delete hackathon:" + hackathon.name)
             hackathon.delete()
             hackathon.save()
@@ -327,6 +346,11 @@ class HackathonManager(Component):
             if hackathon.status == HACK_STATUS.OFFLINE or hackathon.status == HACK_STATUS.DRAFT:
                 hackathon.status = HACK_STATUS.APPLY_ONLINE
                 hackathon.save()
+                # start pulling images now, check them by get_images_status of hackathon_template_manager
+                self.scheduler.add_once("hackathon_template_manager", "pull_images_for_hackathon",
+                                        context=Context(hackathon_id=hackathon.id),
+                                        id="pull_images_for_hackathon_now_%s" % hackathon.id,
+                                        seconds=1)
             elif hackathon.status == HACK_STATUS.INIT:
                 req = general_error(code=HTTP_CODE.CREATE_NOT_FINISHED)
             return req
@@ -357,24 +381,22 @@ class HackathonManager(Component):
                                            like=True,
                                            remark="")
             user_hackathon.save()
-        if not user_hackathon.like:
-            user_hackathon.like = True
-            user_hackathon.save()
+            liked = True
+        else:
+            # only the request that really flips the flag is counted
+            liked = UserHackathon.objects(id=user_hackathon.id, like__ne=True).update_one(set__like=True)
 
         # increase the count of users that like this hackathon
-        self.increase_hackathon_stat(hackathon, HACKATHON_STAT.LIKE, 1)
+        if liked:
+            self.increase_hackathon_stat(hackathon, HACKATHON_STAT.LIKE, 1)
 
         return ok()
 
     def unlike_hackathon(self, user, hackathon):
         user_hackathon = UserHackathon.objects(user=user, hackathon=hackathon).first()
-        if user_hackathon:
-            user_hackathon.like = False
-            user_hackathon.save()
+        if user_hackathon and UserHackathon.objects(id=user_hackathon.id, like=True).update_one(set__like=False):
+            self.increase_hackathon_stat(hackathon, HACKATHON_STAT.LIKE, -1)
 
-        # sync the like count
-        like_count = UserHackathon.objects(hackathon=hackathon, like=True).count()
-        self.update_hackathon_stat(hackathon, HACKATHON_STAT.LIKE, like_count)
         return ok()
 
     def update_hackathon_stat(self, hackathon, stat_type, count):
@@ -389,22 +411,21 @@ class HackathonManager(Component):
         :type count: int
         :param count: the new count for this stat item
         """
-        stat = HackathonStat.objects(hackathon=hackathon, type=stat_type).first()
-        if stat:
-            stat.count = count
-            stat.update_time = self.util.get_now()
-        else:
-            stat = HackathonStat(hackathon=hackathon, type=stat_type, count=count)
-
-        if stat.count < 0:
-            stat.count = 0
-        stat.save()
+        now = self.util.get_now()
+        self.__upsert_hackathon_stat(hackathon, stat_type,
+                                     set__count=max(count, 0),
+                                     set__update_time=now,
+                                     set_on_insert__create_time=now)
 
     def increase_hackathon_stat(self, hackathon, stat_type, increase):
         """Increase or descrease the count for certain hackathon stat
 
-        :type hackathon: Hackathon
-        :param hackathon: instance of Hackathon to be counted
+        The count is updated by an atomic $inc so concurrent requests won't overwrite each other. A decrease that makes
+        the count negative is dropped, the count will be repaired by 'reconcile_hackathon_stats'. The stat is created
+        by upsert upon the first increase, (hackathon, type) is unique so that concurrent upserts create only one
+
+        :type hackathon: Hackathon|ObjectId
+        :param hackathon: instance or id of Hackathon to be counted
 
         :type stat_type: str|unicode
         :param stat_type: type of stat that defined in constants.py#HACKATHON_STAT
@@ -412,16 +433,85 @@ class HackathonManager(Component):
         :type increase: int
         :param increase: increase of the count. Can be positive or negative
         """
-        stat = HackathonStat.objects(hackathon=hackathon, type=stat_type).first()
-        if stat:
-            stat.count += increase
+        if increase == 0:
+            return
+
+        now = self.util.get_now()
+        if increase > 0:
+            self.__upsert_hackathon_stat(hackathon, stat_type,
+                                         inc__count=increase,
+                                         set__update_time=now,
+                                         set_on_insert__create_time=now)
         else:
-            stat = HackathonStat(hackathon=hackathon, type=stat_type, count=increase)
+            HackathonStat.objects(hackathon=hackathon, type=stat_type, count__gte=-increase).update_one(
+                inc__count=increase,
+                set__update_time=now)
+
+    def __upsert_hackathon_stat(self, hackathon, stat_type, **update):
+        # (hackathon, type) is unique. Of the concurrent upserts that insert the stat, the losers fail with duplicate
+        # key and are applied as plain updates by a second try
+        try:
+            HackathonStat.objects(hackathon=hackathon, type=stat_type).update_one(upsert=True, **update)
+        except NotUniqueError:
+            HackathonStat.objects(hackathon=hackathon, type=stat_type).update_one(upsert=True, **update)
+
+    def increase_online_stat(self, user_ids, increase):
+        """Increase or descrease the online count of all hackathons that the users registered
+
+        Called when users login or logout. Online users are counted among registered users only.
+
+        :type user_ids: list
+        :param user_ids: ids of users whose online status changed
+
+        :type increase: int
+        :param increase: 1 if the users become online, -1 if offline
+        """
+        if not user_ids:
+            return
+
+        registered = UserHackathon.objects(user__in=user_ids,
+                                           role=HACK_USER_TYPE.COMPETITOR,
+                                           deleted=False,
+                                           status__in=[HACK_USER_STATUS.AUTO_PASSED, HACK_USER_STATUS.AUDIT_PASSED])
+        for item in registered.aggregate({"$group": {"_id": "$hackathon", "count": {"$sum": 1}}}):
+            self.increase_hackathon_stat(item["_id"], HACKATHON_STAT.ONLINE, increase * item["count"])
+
+    def reconcile_hackathon_stats(self):
+        """Recount the stats of all hackathons to repair the drift of counters. It's called by a scheduled job"""
+        for hackathon in Hackathon.objects().only("id"):
+            try:
+                self.reconcile_hackathon_stat(hackathon)
+            except Exception as e:
+                self.log.error(e)
+
+    def reconcile_hackathon_stat(self, hackathon):
+        """Recount the stats of a hackathon and fix the counters that differ
+
+        :type hackathon: Hackathon
+        :param hackathon: instance of Hackathon to be recounted
+        """
+        reg_list = UserHackathon.objects(hackathon=hackathon,
+                                         role=HACK_USER_TYPE.COMPETITOR,
+                                         deleted=False,
+                                         status__in=[HACK_USER_STATUS.AUTO_PASSED, HACK_USER_STATUS.AUDIT_PASSED]
+                                         ).only("user").no_dereference().all()
+        reg_list = [uh.user.id for uh in reg_list]
+
+        counts = {
+            HACKATHON_STAT.REGISTER: len(reg_list),
+            HACKATHON_STAT.ONLINE: User.objects(id__in=reg_list, online=True).count() if reg_list else 0,
+            HACKATHON_STAT.LIKE: UserHackathon.objects(hackathon=hackathon, like=True).count(),
+            HACKATHON_STAT.TEAM: Team.objects(hackathon=hackathon).count()
+        }
+
+        stats = dict((stat.type, stat) for stat in HackathonStat.objects(hackathon=hackathon))
 
-        if stat.count < 0:
-            stat.count = 0
-        stat.update_time = self.util.get_now()
-        stat.save()
+        for stat_type, count in counts.iteritems():
+            stat = stats.get(stat_type)
+            if stat is None or stat.count != count:
+                self.log.debug("hackathon stat %s of %s drifted: %s -> %d" % (
+                    stat_type, hackathon.id, stat.count if stat else None, count))
+                self.update_hackathon_stat(hackathon, stat_type, count)
 
     def get_distinct_tags(self):
         """Return all distinct hackathon tags for auto-complete usage"""
@@ -658,7 +748,10 @@ class HackathonManager(Component):
                 event: 'int[,int...]',                   // filter by event, default unfiltered
                 order_by: 'time' | 'event' | 'category', // order by update_time, event, category, default by time
                 page: int,                               // page number after pagination, start from 1, default 1
-                per_page: int                            // items per page, default 1000
+                per_page: int,                           // items per page, default 1000
+                cursor: string,                          // paginate by cursor instead of page, '' for the first page
+                                                         // and "next" of the last response for the next one
+                with_total: bool                         // whether to count total in cursor pagination, default false
             }
 
         :return: json style text, see util.Utility
@@ -675,8 +768,6 @@ class HackathonManager(Component):
         notice_category = body.get("category")
         notice_event = body.get("event")
         order_by = body.get("order_by", "time")
-        page = int(body.get("page", 1))
-        per_page = int(body.get("per_page", 1000))
 
         hackathon_filter = Q()
         category_filter = Q()
@@ -719,17 +810,12 @@ class HackathonManager(Component):
         else:
             order_by_condition = '-update_time'
 
-        pagination = HackathonNotice.objects(
+        pagination = self.util.paginate_query(NOTICE_LIST.apply(HackathonNotice.objects(
             hackathon_filter & category_filter & event_filter & user_filter & is_read_filter
-        ).order_by(
-            order_by_condition
-        ).paginate(page, per_page)
-
-        def func(hackathon_notice):
-            return hackathon_notice.dic()
+        )), body, order_by_condition, default_per_page=1000)
 
         # return serializable items as well as total count
-        return self.util.paginate(pagination, func)
+        return self.util.paginate(pagination, NOTICE_LIST.dic)
 
     def check_notice_and_set_read_if_necessary(self, id):
         hackathon_notice = HackathonNotice.objects(id=id).first()
@@ -878,17 +964,21 @@ class HackathonManager(Component):
         return detail
 
     def __fill_hackathon_detail(self, hackathon, user, hackathon_stat, user_hackathon, team):
-        """Return hackathon info as well as its details including configs, stat, organizers, like if user logon"""
-        detail = hackathon.dic()
+        """Return hackathon info as well as its details including configs, stat, organizers, like if user logon
+
+        hackathon is a raw document of HACKATHON_LIST, stats, user_hackathon and team are loaded without dereference
+        """
+        hackathon_id = hackathon["_id"]
+        detail = HACKATHON_LIST.dic(hackathon)
 
         detail["stat"] = {
             "register": 0,
             "like": 0}
 
         for stat in hackathon_stat:
-            if stat.type == HACKATHON_STAT.REGISTER and stat.hackathon.id == hackathon.id:
+            if stat.type == HACKATHON_STAT.REGISTER and stat.hackathon.id == hackathon_id:
                 detail["stat"]["register"] = stat.count
-            elif stat.type == HACKATHON_STAT.LIKE and stat.hackathon.id == hackathon.id:
+            elif stat.type == HACKATHON_STAT.LIKE and stat.hackathon.id == hackathon_id:
                 detail["stat"]["like"] = stat.count
 
         if user:
@@ -896,7 +986,7 @@ class HackathonManager(Component):
             detail['user']['admin'] = user.is_super
             if user_hackathon:
                 for uh in user_hackathon:
-                    if uh.hackathon.id == hackathon.id:
+                    if uh.hackathon.id == hackathon_id:
                         detail['user']['admin'] = detail['user']['admin'] or (uh.role == HACK_USER_TYPE.ADMIN)
 
                         if uh.like:
@@ -905,7 +995,7 @@ class HackathonManager(Component):
                         if uh.role == HACK_USER_TYPE.COMPETITOR:
                             detail['registration'] = uh.dic()
                             for t in team:
-                                if t.hackathon.id == hackathon.id:
+                                if t.hackathon.id == hackathon_id:
                                     detail['team'] = t.dic()
                                     break
                         break
@@ -981,7 +1071,7 @@ class HackathonManager(Component):
             return configs
 
         cache_key = self.__get_config_cache_key(hackathon)
-        return self.cache.get_cache(key=cache_key, createfunc=__internal_get_config)
+        return self.cache.get_cache(key=cache_key, createfunc=__internal_get_config, namespace="hackathon_config")
 
     def __get_hackathon_organizers(self, hackathon):
         organizers = self.db.find_all_objects_by(HackathonOrganizer, hackathon_id=hackathon.id)
@@ -1026,18 +1116,8 @@ class HackathonManager(Component):
         for item in stats:
             result[item.type] = item.count
 
-        reg_list = UserHackathon.objects(hackathon=hackathon,
-                                         role=HACK_USER_TYPE.COMPETITOR,
-                                         deleted=False,
-                                         status__in=[HACK_USER_STATUS.AUTO_PASSED, HACK_USER_STATUS.AUDIT_PASSED]
-                                         ).only("user").no_dereference().all()
-        reg_list = [uh.user.id for uh in reg_list]
-        reg_count = len(reg_list)
-        if reg_count > 0:
-            online_count = User.objects(id__in=reg_list, online=True).count()
-            result["online"] = online_count
-            result["offline"] = reg_count - online_count
-
+        # counters are maintained upon registration, login and logout. see increase_online_stat
+        result["offline"] = max(result.get(HACKATHON_STAT.REGISTER, 0) - result[HACKATHON_STAT.ONLINE], 0)
         return result
 
     def __get_config_cache_key(self, hackathon):
@@ -1059,6 +1139,7 @@ class HackathonManager(Component):
                                     private_docker_api_port=4243,
                                     container_count=0,
                                     container_max_count=100,
+                                    free_slots=100,
                                     disabled=False,
                                     state=DockerHostServerStatus.DOCKER_READY,
                                     hackathon=hackathon)
@@ -30,7 +30,7 @@ from compiler.ast import flatten
 
 from flask import g
 
-from hackathon.hmongo.models import Template
+from hackathon.hmongo.models import Template, Hackathon, DockerHostServer
 
 from hackathon import Component, RequiredFeature, Context
 from hackathon.constants import VE_PROVIDER, TEMPLATE_STATUS
@@ -45,7 +45,7 @@ class HackathonTemplateManager(Component):
     team_manager = RequiredFeature("team_manager")
     hackathon_manager = RequiredFeature("hackathon_manager")
     template_library = RequiredFeature("template_library")
-    hosted_docker = RequiredFeature("hosted_docker")
+    image_puller = RequiredFeature("image_puller")
 
     def add_template_to_hackathon(self, template_id):
         try:
@@ -100,28 +100,37 @@ class HackathonTemplateManager(Component):
         return settings
 
     def pull_images_for_hackathon(self, context):
-        hackathon_id = context.hackathon_id
-        templates = self.__get_templates_for_pull(hackathon_id)
-        images = map(lambda x: self.__get_images_from_template(x), templates)
-        images_to_pull = flatten(images)
-
-        self.log.debug('expected images: %s on hackathon: %s' % (images_to_pull, hackathon_id))
-        # get all docker host server on hackathon
-        hosts = self.db.find_all_objects_by(DockerHostServer, hackathon_id=hackathon_id)
-        # loop to get every docker host
-        for docker_host in hosts:
-            download_images = self.__get_undownloaded_images_on_docker_host(docker_host, images_to_pull)
-            self.log.debug('need to pull images: %s on host: %s' % (download_images, docker_host.vm_name))
-            for dl_image in download_images:
-                image = dl_image.split(':')[0]
-                tag = dl_image.split(':')[1]
-                context = Context(image=image,
-                                  tag=tag,
-                                  docker_host=docker_host.id)
-                self.scheduler.add_once(feature="hosted_docker",
-                                        method="pull_image",
-                                        context=context,
-                                        seconds=3)
+        """Pull the images of hackathon's docker templates to its docker hosts, called by scheduled job
+
+        :type context: Context
+        :param context: with hackathon_id
+        """
+        hackathon = Hackathon.objects(id=context.hackathon_id).first()
+        if not hackathon:
+            return 0
+
+        images = self.__get_images_for_pull(hackathon)
+        self.log.debug('expected images: %s on hackathon: %s' % (images, hackathon.name))
+        if not images:
+            return 0
+
+        hosts = DockerHostServer.objects(hackathon=hackathon)
+        return self.image_puller.ensure_images(hosts, images)
+
+    def get_images_status(self, hackathon):
+        """Tell whether the images of hackathon's docker templates are pulled to all its docker hosts
+
+        :type hackathon: Hackathon
+        :param hackathon: the hackathon
+
+        :rtype: dict
+        :return: {"ready": bool, "images": [...], "hosts": {vm_name: details of images not ready}}
+        """
+        images = self.__get_images_for_pull(hackathon)
+        hosts = list(DockerHostServer.objects(hackathon=hackathon))
+        status = self.image_puller.get_images_status(hosts, images)
+        status["images"] = images
+        return status
 
     def __init__(self):
         pass
@@ -156,18 +165,8 @@ class HackathonTemplateManager(Component):
         docker_images = [du.get_image_with_tag() for du in docker_units]
         return docker_images
 
-    def __get_templates_for_pull(self, hackathon_id):
-        htrs = self.db.find_all_objects_by(HackathonTemplateRel, hackathon_id=hackathon_id)
-        templates = [h.template for h in htrs]
+    def __get_images_for_pull(self, hackathon):
         templates = filter(lambda t: t.provider == VE_PROVIDER.DOCKER and t.status == TEMPLATE_STATUS.CHECK_PASS,
-                           templates)
-        return templates
-
-    def __get_undownloaded_images_on_docker_host(self, docker_host, expected_images):
-        images = []
-        current_images = self.hosted_docker.get_pulled_images(docker_host)
-        self.log.debug('already exist images: %s on host: %s' % (current_images, docker_host.vm_name))
-        for ex_image in expected_images:
-            if ex_image not in current_images:
-                images.append(ex_image)
-        return flatten(images)
+                           hackathon.templates)
+        # templates of different hackathons may share images, ImagePuller pulls each of them once per host
+        return sorted(set(flatten(map(lambda x: self.__get_images_from_template(x), templates))))
@@ -23,12 +23,14 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 from hackathon.hazure.cloud_service_adapter import CloudServiceAdapter
+from hackathon.hazure.endpoint_allocator import get_endpoint_allocator
 
 __author__ = 'ZGQ'
 
 import sys
 import requests
 from uuid import uuid1
+from compiler.ast import flatten
 from time import strftime, sleep
 
 sys.path.append("..")
@@ -38,7 +40,10 @@ from azure.servicemanagement import (ConfigurationSet, ConfigurationSetInputEndp
                                      LinuxConfigurationSet, ServiceManagementService)
 
 from hackathon import Component, RequiredFeature, Context
-from hackathon.hmongo.models import DockerHostServer, Hackathon, AzureKey
+from bson import Binary
+from mongoengine import NotUniqueError
+
+from hackathon.hmongo.models import DockerHostServer, Hackathon, AzureKey, HostPortAllocation, Experiment
 from hackathon.constants import (AzureApiExceptionMessage, DockerPingResult, AVMStatus, AzureVMPowerState,
                                  DockerHostServerStatus, DHS_QUERY_STATE,
                                  ServiceDeploymentSlot, AzureVMSize, AzureVMEndpointName, TCPProtocol,
@@ -47,6 +52,12 @@ from hackathon.hackathon_response import ok, not_found
 
 __all__ = ["DockerHostManager"]
 
+# host ports for containers are allocated in [HOST_PORT_BASE, HOST_PORT_MAX)
+HOST_PORT_BASE = 10000
+HOST_PORT_MAX = 65535
+# retries of a reservation that conflicts with another one on the same host
+PORT_RESERVE_RETRIES = 10
+
 
 class DockerHostManager(Component):
     """Component to manage docker host server"""
@@ -66,31 +77,45 @@ class DockerHostManager(Component):
         return [host_server.dic() for host_server in host_servers]
 
     def get_available_docker_host(self, hackathon):
-        # check whether a server is still available
-        vms = DockerHostServer.objects.filter(__raw__={'$where': 'this.container_count+1 < this.container_max_count'}) \
-            .filter(hackathon=hackathon, state=DockerHostServerStatus.DOCKER_READY, disabled=False).all()
+        """Find a docker host that can hold one more container and reserve the slot for it
 
-        if self.util.is_local():
-            if len(vms) > 0:
-                return Context(state=DHS_QUERY_STATE.SUCCESS, docker_host_server=vms[0])
-            else:
-                return Context(state=DHS_QUERY_STATE.FAILED)
+        Hosts are selected and reserved in one atomic find_and_modify so that concurrent starts won't go beyond the
+        capacity of a host. The slot must be given back by 'release_docker_host' once the container is removed or
+        fails to start.
 
+        :type hackathon: Hackathon
+        :param hackathon: the hackathon that the host belongs to
+
+        :rtype: Context
+        :return: context with state in DHS_QUERY_STATE and the reserved docker_host_server if SUCCESS
+        """
+        tried = []
         has_locked_host = False
-        for host in vms:
+        while True:
+            host = self.__reserve_docker_host(hackathon, tried)
+            if host is None:
+                break
+
+            if self.util.is_local():
+                return Context(state=DHS_QUERY_STATE.SUCCESS, docker_host_server=host)
+
+            tried.append(host.id)
             # check docker status
             if not self.docker.ping(host):
-                host.state = DockerHostServerStatus.UNAVAILABLE
-                host.save()
+                self.release_docker_host(host)
+                DockerHostServer.objects(id=host.id).update_one(set__state=DockerHostServerStatus.UNAVAILABLE)
                 continue
 
             # cloud service locked?
             if not self.is_host_server_locked(host):
                 return Context(state=DHS_QUERY_STATE.SUCCESS, docker_host_server=host)
             else:
+                self.release_docker_host(host)
                 has_locked_host = True
 
-        if has_locked_host:
+        if self.util.is_local():
+            return Context(state=DHS_QUERY_STATE.FAILED)
+        elif has_locked_host:
             # still has available host but locked
             return Context(state=DHS_QUERY_STATE.ONGOING)
         elif self.start_new_docker_host_vm(hackathon):
@@ -100,6 +125,86 @@ class DockerHostManager(Component):
             # no VM found or starting
             return Context(state=DHS_QUERY_STATE.FAILED)
 
+    def release_docker_host(self, host_server):
+        """Give back the slot reserved by 'get_available_docker_host'
+
+        :type host_server: DockerHostServer|ObjectId
+        :param host_server: the host or its id
+        """
+        host_id = getattr(host_server, "id", host_server)
+        DockerHostServer.objects(id=host_id, container_count__gt=0).update_one(dec__container_count=1,
+                                                                               inc__free_slots=1)
+
+    def reserve_host_ports(self, host_server, container_ports):
+        """Reserve a host port for each container port on the docker host
+
+        Reserved ports are kept in a bitmap per host in MongoDB and changed by compare-and-set on its version, so that
+        concurrent starts in any process never get the same port. A host port near 'container port + HOST_PORT_BASE' is
+        preferred. The ports must be given back by 'release_host_ports' once the container is removed or fails to
+        start.
+
+        :type host_server: DockerHostServer
+        :param host_server: the docker host
+
+        :type container_ports: list
+        :param container_ports: ports inside container
+
+        :rtype: list
+        :return: host ports in the same order as container_ports
+        """
+        for i in range(PORT_RESERVE_RETRIES):
+            allocation = self.__get_port_allocation(host_server)
+            bitmap = bytearray(allocation.bitmap)
+            host_ports = [self.__take_free_port(bitmap, port + HOST_PORT_BASE) for port in container_ports]
+            if self.__save_port_allocation(allocation, bitmap):
+                self.log.debug("host ports %s reserved on %s" % (host_ports, host_server.vm_name))
+                return host_ports
+
+        raise Exception("fail to reserve host ports on %s because of conflicts" % host_server.vm_name)
+
+    def release_host_ports(self, host_server, host_ports):
+        """Give back the ports reserved by 'reserve_host_ports'
+
+        :type host_server: DockerHostServer|ObjectId
+        :param host_server: the host or its id
+
+        :type host_ports: list
+        :param host_ports: the host ports to release
+        """
+        host_ports = [p for p in host_ports or [] if p and HOST_PORT_BASE <= p < HOST_PORT_MAX]
+        if not host_ports:
+            return
+
+        host_id = getattr(host_server, "id", host_server)
+        for i in range(PORT_RESERVE_RETRIES):
+            allocation = HostPortAllocation.objects(host=host_id).first()
+            if not allocation:
+                return
+
+            bitmap = bytearray(allocation.bitmap)
+            for port in host_ports:
+                index = port - HOST_PORT_BASE
+                bitmap[index / 8] &= ~(1 << (index % 8)) & 0xff
+            if self.__save_port_allocation(allocation, bitmap):
+                return
+
+        self.log.warn("fail to release host ports %s of %s because of conflicts" % (host_ports, host_id))
+
+    def reconcile_docker_hosts(self):
+        """Resync the slots and host ports reserved on docker hosts with the containers on them
+
+        Reservations leak if a container is removed without 'release_docker_host' or 'release_host_ports', e.g. the
+        process died in between, or by starters that never release them. A job runs this periodically.
+        """
+        for host_server in DockerHostServer.objects(state=DockerHostServerStatus.DOCKER_READY,
+                                                    disabled=False).no_dereference():
+            try:
+                self.__reconcile_host_slots(host_server)
+                self.__reconcile_host_ports(host_server)
+            except Exception as e:
+                self.log.error("fail to reconcile docker host %s" % host_server.vm_name)
+                self.log.error(e)
+
     def is_host_server_locked(self, docker_host):
         # todo which azure key to use?
         # TODO: need to determine which service to use(Azure/Alauda/HuaweiCCE)
@@ -200,6 +305,7 @@ class DockerHostManager(Component):
                 self.log.debug('To create VM:%s in service:%s.(deployment)' % (host_name, service_name))
             except Exception as e:
                 self.log.error(e)
+                get_endpoint_allocator().invalidate(service_name)
                 return False
         else:
             try:
@@ -213,6 +319,7 @@ class DockerHostManager(Component):
                 self.log.debug('To create VM:%s in service:%s.(add role)' % (host_name, service_name))
             except Exception as e:
                 self.log.error(e)
+                get_endpoint_allocator().invalidate(service_name)
                 return False
         # storage parameters in context
         context = Context(hackathon_id=hackathon_id, request_id=result.request_id,
@@ -240,6 +347,7 @@ class DockerHostManager(Component):
                                        private_docker_api_port=args.private_docker_api_port,
                                        container_count=0,
                                        container_max_count=args.container_max_count,
+                                       free_slots=args.container_max_count,
                                        is_auto=False,
                                        disabled=args.get("disabled", False),
                                        hackathon=hackathon)
@@ -275,10 +383,7 @@ class DockerHostManager(Component):
             host_server.save()
         else:
             try:
-                containers = self.docker.list_containers(host_server)
-                if len(containers) != host_server.container_count:
-                    host_server.container_count = len(containers)
-                    host_server.save()
+                self.__reconcile_host_slots(host_server)
             except Exception as e:
                 self.log.error("Failed in sync container count")
                 self.log.error(e)
@@ -292,10 +397,7 @@ class DockerHostManager(Component):
             host_server.save()
         else:
             try:
-                containers = self.docker.list_containers(host_server)
-                if len(containers) != host_server.container_count:
-                    host_server.container_count = len(containers)
-                    host_server.save()
+                self.__reconcile_host_slots(host_server)
             except Exception as e:
                 self.log.error("Failed in sync container count")
                 self.log.error(e)
@@ -321,7 +423,7 @@ class DockerHostManager(Component):
         vm.public_dns = args.get("public_dns", vm.public_dns)
         vm.public_ip = args.get("public_ip", vm.public_ip)
         vm.private_ip = args.get("private_ip", vm.private_ip)
-        vm.container_max_count = int(args.get("container_max_count", vm.container_max_count))
+        container_max_count = int(args.get("container_max_count", vm.container_max_count))
         vm.public_docker_api_port = int(args.get("public_docker_api_port", vm.public_docker_api_port))
         vm.private_docker_api_port = int(args.get("private_docker_api_port", vm.private_docker_api_port))
         vm.disabled = args.get("disabled", vm.disabled)
@@ -331,6 +433,12 @@ class DockerHostManager(Component):
             vm.state = DockerHostServerStatus.UNAVAILABLE
 
         vm.save()
+        if container_max_count != vm.container_max_count:
+            # free_slots moves with the capacity, slots reserved in the meantime are kept
+            delta = container_max_count - vm.container_max_count
+            DockerHostServer.objects(id=vm.id).update_one(set__container_max_count=container_max_count,
+                                                          inc__free_slots=delta)
+            vm.reload()
         return self.__check_docker_host_server(vm).dic()
 
     def delete_host_server(self, host_server_id):
@@ -622,13 +730,8 @@ class DockerHostManager(Component):
         :return: the endpoint configuration set
         :rtype: class 'azure.servicemanagement.ConfigurationSet'
         """
-        used_port_set = self.__get_used_public_port_set(service_name, hackathon_id)
-        docker_port = 4243
-        ssh_port = 9000
-        while docker_port in used_port_set:
-            docker_port += 1
-        while ssh_port in used_port_set:
-            ssh_port += 1
+        docker_port, ssh_port = get_endpoint_allocator().allocate(
+            service_name, [4243, 9000], lambda: self.__get_used_public_port_set(service_name, hackathon_id))
         assert docker_port < 40000 and ssh_port < 40000
         endpoint_config = ConfigurationSet()
         endpoint_config.configuration_set_type = AzureVMEnpointConfigType.NETWORK
@@ -680,6 +783,140 @@ class DockerHostManager(Component):
             else:
                 raise Exception('Something wrong with checking deployment of service:' % service_name)
 
+    def __get_port_allocation(self, host_server):
+        allocation = HostPortAllocation.objects(host=host_server).first()
+        if allocation:
+            return allocation
+
+        # first reservation on the host, ports used by existing containers are marked as reserved
+        bitmap = self.__get_used_ports_bitmap(host_server)
+        try:
+            return HostPortAllocation(host=host_server, bitmap=Binary(str(bitmap)), version=0).save()
+        except NotUniqueError:
+            # created by another process at the same time
+            return HostPortAllocation.objects(host=host_server).first()
+
+    def __get_used_ports_bitmap(self, host_server, extra_ports=None):
+        """Bitmap of the host ports published by containers on the docker host, plus extra_ports"""
+        bitmap = bytearray((HOST_PORT_MAX - HOST_PORT_BASE + 7) / 8)
+        ports = flatten(map(lambda c: c.get("Ports") or [], self.docker.list_containers(host_server)))
+        for port in [p.get("PublicPort", 0) for p in ports] + (extra_ports or []):
+            index = (port or 0) - HOST_PORT_BASE
+            if 0 <= index < HOST_PORT_MAX - HOST_PORT_BASE:
+                bitmap[index / 8] |= 1 << (index % 8)
+        return bitmap
+
+    def __is_starting_on(self, host_server):
+        """Whether experiments of the host's hackathon are being started, their reservations are not saved yet"""
+        if Experiment.objects(hackathon=host_server.hackathon, status__in=[EStatus.INIT, EStatus.STARTING]).count():
+            self.log.debug("experiments are starting, skip reconciling docker host %s" % host_server.vm_name)
+            return True
+        return False
+
+    def __reconcile_host_slots(self, host_server):
+        """Set container_count to the count of containers on the host and free_slots accordingly
+
+        Compare-and-set on container_count that was read before checking starting experiments, so that a slot reserved
+        meanwhile fails the update instead of being overwritten
+        """
+        if self.__is_starting_on(host_server):
+            return
+
+        count = len(self.docker.list_containers(host_server))
+        free_slots = max(host_server.container_max_count - count, 0)
+        if count == host_server.container_count and free_slots == host_server.free_slots:
+            return
+
+        if DockerHostServer.objects(id=host_server.id,
+                                    container_count=host_server.container_count,
+                                    container_max_count=host_server.container_max_count).update_one(
+                set__container_count=count, set__free_slots=free_slots):
+            self.log.info("container count of %s resynced from %d to %d" % (host_server.vm_name,
+                                                                             host_server.container_count, count))
+            host_server.container_count = count
+            host_server.free_slots = free_slots
+
+    def __reconcile_host_ports(self, host_server):
+        allocation = HostPortAllocation.objects(host=host_server.id).first()
+        if not allocation:
+            return
+
+        # ports being reserved by starting experiments are not saved anywhere but the allocation. Checked after the
+        # allocation is read, so a reservation made after the check fails the compare-and-set below
+        if self.__is_starting_on(host_server):
+            return
+
+        # ports of stopped containers are kept until they are removed
+        bound_ports = []
+        for expr in Experiment.objects(virtual_environments__docker_container__host_server=host_server.id,
+                                       status=EStatus.RUNNING).no_dereference().only("virtual_environments"):
+            for ve in expr.virtual_environments:
+                container = ve.docker_container
+                if container and getattr(container.host_server, "id", None) == host_server.id:
+                    bound_ports += [p.host_port for p in container.port_bindings]
+
+        bitmap = self.__get_used_ports_bitmap(host_server, bound_ports)
+        if bitmap == bytearray(allocation.bitmap):
+            return
+
+        if self.__save_port_allocation(allocation, bitmap):
+            self.log.info("host ports of %s resynced with its containers" % host_server.vm_name)
+
+    def __take_free_port(self, bitmap, preferred_port):
+        """Mark the first free port from preferred_port, wrapping around to HOST_PORT_BASE, as reserved"""
+        size = HOST_PORT_MAX - HOST_PORT_BASE
+        start = preferred_port - HOST_PORT_BASE if HOST_PORT_BASE <= preferred_port < HOST_PORT_MAX else 0
+        for offset in range(size):
+            index = (start + offset) % size
+            if not bitmap[index / 8] & (1 << (index % 8)):
+                bitmap[index / 8] |= 1 << (index % 8)
+                return index + HOST_PORT_BASE
+
+        raise Exception("port used up on this host server")
+
+    def __save_port_allocation(self, allocation, bitmap):
+        return HostPortAllocation.objects(id=allocation.id, version=allocation.version).update_one(
+            set__bitmap=Binary(str(bitmap)),
+            inc__version=1,
+            set__update_time=self.util.get_now())
+
+    def __reserve_docker_host(self, hackathon, excluded):
+        """Select a ready host by the placement policy and reserve one slot on it atomically
+
+        Placement policies("docker.host_placement" in config):
+            most_free: the host with most free slots, spread containers evenly
+            least_loaded: the host with least containers
+            bin_pack: the host with least free slots, keep other hosts empty so that they can be shut down
+
+        :rtype: DockerHostServer
+        :return: the host reserved or None if all hosts are full
+        """
+        order_by = {
+            "most_free": "-free_slots",
+            "least_loaded": "container_count",
+            "bin_pack": "free_slots"
+        }.get(self.util.safe_get_config("docker.host_placement", "most_free"), "-free_slots")
+
+        def reserve():
+            return DockerHostServer.objects(hackathon=hackathon,
+                                            state=DockerHostServerStatus.DOCKER_READY,
+                                            disabled=False,
+                                            free_slots__gt=0,
+                                            id__nin=excluded).order_by(order_by).modify(inc__container_count=1,
+                                                                                        dec__free_slots=1,
+                                                                                        new=True)
+
+        host = reserve()
+        if host is None:
+            # hosts saved before free_slots was introduced
+            legacy_hosts = list(DockerHostServer.objects(hackathon=hackathon, free_slots__exists=False))
+            for legacy in legacy_hosts:
+                legacy.update(set__free_slots=max(legacy.container_max_count - legacy.container_count, 0))
+            if legacy_hosts:
+                host = reserve()
+
+        return host
+
     def __exist_request_host_server_by_hackathon_id(self, request_count, hackathon_id):
         """
         check whether there is a host server, belonging to a hackathon, that can hold a few more containers
@@ -693,10 +930,8 @@ class DockerHostManager(Component):
         :return: True if there exists one host server at least, otherwise False
         :rtype: bool
         """
-        vms = self.db.find_all_objects(DockerHostServer,
-                                       DockerHostServer.container_count + request_count <=
-                                       DockerHostServer.container_max_count,
-                                       DockerHostServer.hackathon_id == hackathon_id,
-                                       DockerHostServer.state == DockerHostServerStatus.DOCKER_READY,
-                                       DockerHostServer.disabled == True)# DockerHostServerDisable.ABLE)
-        return len(vms) > 0
+        vms = DockerHostServer.objects(hackathon=hackathon_id,
+                                       state=DockerHostServerStatus.DOCKER_READY,
+                                       disabled=False,
+                                       free_slots__gte=request_count)
+        return vms.count() > 0
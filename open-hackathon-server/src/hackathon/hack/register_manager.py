@@ -108,6 +108,8 @@ class RegisterManager(Component):
                     hackathon=hackathon,
                     status=status,
                     **args)
+                if user_hackathon.like:
+                    self.hackathon_manager.increase_hackathon_stat(hackathon, HACKATHON_STAT.LIKE, 1)
             else:  # visitor -> competitor
                 user_hackathon.role = HACK_USER_TYPE.COMPETITOR
                 user_hackathon.status = status
@@ -118,7 +120,8 @@ class RegisterManager(Component):
                 self.team_manager.create_default_team(hackathon, user)
                 self.__ask_for_dev_plan(hackathon, user)
 
-            self.__update_register_stat(hackathon)
+            if self.__is_counted(user_hackathon):
+                self.__increase_register_stat(hackathon, user_hackathon.user, 1)
             return user_hackathon.dic()
         except Exception as e:
             self.log.error(e)
@@ -138,6 +141,7 @@ class RegisterManager(Component):
                 # we can also create a new object here.
                 return not_found("registration not found")
 
+            was_counted = self.__is_counted(register)
             register.update_time = self.util.get_now()
             register.status = context.status
             register.save()
@@ -146,8 +150,9 @@ class RegisterManager(Component):
                 self.team_manager.create_default_team(register.hackathon, register.user)
                 self.__ask_for_dev_plan(register.hackathon, register.user)
 
-            hackathon = self.hackathon_manager.get_hackathon_by_id(register.hackathon.id)
-            self.__update_register_stat(hackathon)
+            is_counted = self.__is_counted(register)
+            if was_counted != is_counted:
+                self.__increase_register_stat(register.hackathon, register.user, 1 if is_counted else -1)
 
             return register.dic()
         except Exception as e:
@@ -163,9 +168,13 @@ class RegisterManager(Component):
         try:
             register = self.get_registration_by_id(args["id"])
             if register is not None:
-                register.delete()
                 hackathon = register.hackathon
-                self.__update_register_stat(hackathon)
+                # only the request that really deletes it is counted
+                if UserHackathon.objects(id=register.id).delete():
+                    if self.__is_counted(register):
+                        self.__increase_register_stat(hackathon, register.user, -1)
+                    if register.like:
+                        self.hackathon_manager.increase_hackathon_stat(hackathon, HACKATHON_STAT.LIKE, -1)
 
                 team = self.team_manager.get_team_by_user_and_hackathon(register.user, hackathon)
                 if not team:
@@ -205,15 +214,16 @@ class RegisterManager(Component):
 
         return detail
 
-    def __update_register_stat(self, hackathon):
-        count = UserHackathon.objects(
-            hackathon=hackathon.id,
-            status__in=[HACK_USER_STATUS.AUDIT_PASSED, HACK_USER_STATUS.AUTO_PASSED],
-            role=HACK_USER_TYPE.COMPETITOR,
-            # TODO
-            deleted=False).count()
+    def __is_counted(self, registration):
+        """Whether the registration is counted in stat HACKATHON_STAT.REGISTER"""
+        return registration.role == HACK_USER_TYPE.COMPETITOR and not registration.deleted and \
+               registration.status in [HACK_USER_STATUS.AUDIT_PASSED, HACK_USER_STATUS.AUTO_PASSED]
 
-        self.hackathon_manager.update_hackathon_stat(hackathon, HACKATHON_STAT.REGISTER, count)
+    def __increase_register_stat(self, hackathon, user, increase):
+        """Increase the registered count as well as the online count if user is online"""
+        self.hackathon_manager.increase_hackathon_stat(hackathon, HACKATHON_STAT.REGISTER, increase)
+        if user.online:
+            self.hackathon_manager.increase_hackathon_stat(hackathon, HACKATHON_STAT.ONLINE, increase)
 
     def is_user_registered(self, user_id, hackathon):
         """Check whether use registered certain hackathon"""
@@ -36,13 +36,19 @@ from mongoengine import Q, ValidationError
 from os.path import realpath, abspath, dirname
 
 from hackathon import Component, RequiredFeature
-from hackathon.hmongo.models import Team, TeamMember, TeamScore, TeamWork, Hackathon, UserHackathon, to_dic
+from hackathon.hmongo.models import Team, TeamMember, TeamScore, TeamWork, Hackathon, UserHackathon, User, to_dic
+from hackathon.hmongo.batch_loader import get_loader
+from hackathon.hmongo.projection import Projection
 from hackathon.hackathon_response import not_found, bad_request, precondition_failed, ok, forbidden
-from hackathon.constants import TEAM_MEMBER_STATUS, TEAM_SHOW_TYPE, HACK_USER_TYPE, HACKATHON_CONFIG
+from hackathon.constants import TEAM_MEMBER_STATUS, TEAM_SHOW_TYPE, HACK_USER_TYPE, HACKATHON_CONFIG, HACKATHON_STAT
 
 __all__ = ["TeamManager"]
 hack_manager = RequiredFeature("hackathon_manager")
 
+# fields of teams in the team list and the show list of hackathon
+TEAM_LIST = Projection(Team, exclude=["assets", "azure_keys", "scores", "templates", "hackathon"])
+TEAM_SHOW = Projection(Team, exclude=["assets", "awards", "azure_keys", "scores", "templates", "members"])
+
 
 class TeamManager(Component):
     """Component to manage hackathon teams"""
@@ -135,37 +141,31 @@ class TeamManager(Component):
             query &= Q(name__icontains=name)
 
         try:
-            teams = Team.objects(query).order_by('name')[:number]
+            # raw documents, teams are read only here
+            teams = list(TEAM_LIST.apply(Team.objects(query)).order_by('name')[:number])
         except ValidationError:
             return []
 
-        # check whether it's anonymous user or not
-        user = None
-        if self.user_manager.validate_login():
-            user = g.user
+        # leaders and members of all teams in one query
+        user_loader = get_loader(User)
+        user_loader.load_many([team.get("leader") for team in teams] +
+                              [m.get("user") for team in teams for m in team.get("members", [])])
 
         def get_team(team):
-            teamDic = team.dic()
-            teamDic['leader'] = {
-                'id': str(team.leader.id),
-                'name': team.leader.name,
-                'nickname': team.leader.nickname,
-                'avatar_url': team.leader.avatar_url
-            }
+            leader = user_loader.load(team.get("leader"))
+            member_users = user_loader.load_many([m.get("user") for m in team.get("members", [])])
+
+            teamDic = TEAM_LIST.dic(team)
+            teamDic['leader'] = self.__leader_dic(leader)
             teamDic['cover'] = teamDic.get('cover', '')
             teamDic['project_name'] = teamDic.get('project_name', '')
             teamDic['dev_plan'] = teamDic.get('dev_plan', '')
             teamDic['works'] = teamDic.get('works', '')
-            [teamDic.pop(key, None) for key in
-             ['assets', 'azure_keys', 'scores', 'templates', 'hackathon']]
-            teamDic["member_count"] = team.members.filter(status=TEAM_MEMBER_STATUS.APPROVED).count()
+            teamDic["member_count"] = len(
+                [m for m in teamDic["members"] if m.get("status") == TEAM_MEMBER_STATUS.APPROVED])
 
-            def sub(t):
-                m = to_dic(t)
-                m["user"] = self.user_manager.user_display_info(t.user)
-                return m
-
-            teamDic["members"] = [sub(t) for t in team.members]
+            for m, member_user in zip(teamDic["members"], member_users):
+                m["user"] = self.user_manager.user_display_info(member_user)
             return teamDic
 
         return [get_team(x) for x in teams]
@@ -190,6 +190,7 @@ class TeamManager(Component):
                     hackathon=hackathon,
                     members=[team_member])
         team.save()
+        hack_manager.increase_hackathon_stat(hackathon, HACKATHON_STAT.TEAM, 1)
 
         return team.dic()
 
@@ -248,7 +249,7 @@ class TeamManager(Component):
         member_users = [m.user for m in members]
 
         # TODO: transcation?
-        team.delete()
+        self.__delete_team(team)
 
         for u in member_users:
             self.create_default_team(hackathon, u)
@@ -277,7 +278,7 @@ class TeamManager(Component):
         hackathon = team.hackathon
         if num_team_members > 1:
             if team.leader == user:
-                team.delete()
+                self.__delete_team(team)
                 for u in member_users:
                     if u.id != user.id:
                         self.create_default_team(hackathon, u)
@@ -285,7 +286,7 @@ class TeamManager(Component):
                 Team.objects(id=team.id).update_one(pull__members__user=user)
         else:
             # num_team_members == 1
-            team.delete()
+            self.__delete_team(team)
 
         return ok()
 
@@ -372,7 +373,8 @@ class TeamManager(Component):
             # because only team leader with single team can make join request
             # so we don't have to make default team for other members in this team
             # we make the check in #NOTE1# so this is always true
-            Team.objects(hackathon=team.hackathon.id, leader=mem.user.id).delete()
+            deleted = Team.objects(hackathon=team.hackathon.id, leader=mem.user.id).delete()
+            hack_manager.increase_hackathon_stat(team.hackathon, HACKATHON_STAT.TEAM, -deleted)
 
             mem.status = TEAM_MEMBER_STATUS.APPROVED
             mem.update_time = self.util.get_now()
@@ -552,19 +554,17 @@ class TeamManager(Component):
         if show_type is not None:
             query &= Q(works__type=int(show_type))
 
+        teams = Team.objects(query).filter(works__1__exists=True).order_by('update_time', '-age')[:limit]
+        teams = list(TEAM_SHOW.apply(teams))
+        leaders = get_loader(User).load_many([team.get("leader") for team in teams])
+
         works = []
-        for team in Team.objects(query).filter(works__1__exists=True).order_by('update_time', '-age')[:limit]:
-            teamDic = team.dic()
-            teamDic['leader'] = {
-                'id': str(team.leader.id),
-                'name': team.leader.name,
-                'nickname': team.leader.nickname,
-                'avatar_url': team.leader.avatar_url
-            }
+        for team, leader in zip(teams, leaders):
+            teamDic = TEAM_SHOW.dic(team)
+            teamDic['leader'] = self.__leader_dic(leader)
             teamDic['cover'] = teamDic.get('cover', '')
             teamDic['project_name'] = teamDic.get('project_name', '')
             teamDic['dev_plan'] = teamDic.get('dev_plan', '')
-            [teamDic.pop(key, None) for key in ['assets', 'awards', 'azure_keys', 'scores', 'templates', 'members']]
             #
             # teamDic['works'] = []
             #
@@ -720,6 +720,11 @@ class TeamManager(Component):
 
         return resp
 
+    def __delete_team(self, team):
+        """Delete the team and decrease the team count of hackathon"""
+        deleted = Team.objects(id=team.id).delete()
+        hack_manager.increase_hackathon_stat(team.hackathon, HACKATHON_STAT.TEAM, -deleted)
+
     def __generate_team_name(self, hackathon, user):
         """Generate a default team name by user name. It can be updated later by team leader"""
         team_name = user.name
@@ -738,6 +743,17 @@ class TeamManager(Component):
         """
         return Team.objects(members__user=user_id).all()
 
+    def __leader_dic(self, leader):
+        """Brief of team leader in team lists, None if the leader doesn't exist"""
+        if leader is None:
+            return None
+        return {
+            'id': str(leader.id),
+            'name': leader.name,
+            'nickname': leader.nickname,
+            'avatar_url': leader.avatar_url
+        }
+
     def __get_team_by_id(self, team_id):
         """Get team by its primary key"""
         try:
@@ -23,21 +23,71 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 import os
+import socket
 from pytz import utc
 from datetime import timedelta
+from threading import Lock
 import inspect
+import uuid
 
 from apscheduler.jobstores.base import JobLookupError
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.mongodb import MongoDBJobStore
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.util import undefined
 from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_ADDED
+from mongoengine import NotUniqueError
 
 from hackathon.hackathon_factory import RequiredFeature
 from hackathon.util import safe_get_config, get_config, get_now
 from hackathon.log import log
+from hackathon.constants import HEALTH, HEALTH_STATUS
+from hackathon.hmongo.models import JobLease
+from hackathon.context_codec import encode_context, decode_context
 
 __all__ = ["HackathonScheduler"]
 
+# lanes: durable jobs are saved in the configured job store, transient ones live in memory of current process
+DURABLE = "durable"
+TRANSIENT = "transient"
+
+# lane -> count of jobs being executed
+running_jobs = {DURABLE: 0, TRANSIENT: 0}
+
+# kwargs of the "interval" trigger that define the length of a tick
+INTERVAL_UNITS = ["weeks", "days", "hours", "minutes", "seconds"]
+running_jobs_lock = Lock()
+
+# outcome of lease acquisition of durable jobs in current process
+lease_counters = {"acquired": 0, "skipped": 0}
+
+# one-off jobs rejected because the transient lane is full
+rejected_jobs = {TRANSIENT: 0}
+
+
+class CountingMemoryJobStore(MemoryJobStore):
+    """MemoryJobStore that counts its jobs, so that the count is known without listing them
+
+    The scheduler calls job stores under its own lock, the counter needs no other lock.
+    """
+
+    def __init__(self):
+        super(CountingMemoryJobStore, self).__init__()
+        self.job_count = 0
+
+    def add_job(self, job):
+        super(CountingMemoryJobStore, self).add_job(job)
+        self.job_count += 1
+
+    def remove_job(self, job_id):
+        super(CountingMemoryJobStore, self).remove_job(job_id)
+        self.job_count -= 1
+
+    def remove_all_jobs(self):
+        super(CountingMemoryJobStore, self).remove_all_jobs()
+        self.job_count = 0
+
 
 def scheduler_listener(event):
     """Custom listener for apscheduler
@@ -56,7 +106,7 @@ def scheduler_listener(event):
         log.debug("The schedule job %s executed and return value is '%s'" % (event.job_id, event.retval))
 
 
-def scheduler_executor(feature, method, context):
+def scheduler_executor(feature, method, context, lease_key=None, lease_seconds=None):
     """task for all apscheduler jobs
 
     While the context of apscheduler job will be serialized and saved into MySQL, it's hard that add an instance method
@@ -74,25 +124,120 @@ def scheduler_executor(feature, method, context):
     :type method: str|unicode
     :param method: the name of method related to instance
 
-    :type context: Context, see definition in hackathon/__init__.py
-    :param context: the expected execution context of target method
+    :type context: str|Context, see definition in hackathon/__init__.py
+    :param context: the expected execution context of target method, encoded by context_codec. Jobs saved by old
+        versions have the Context itself
+
+    :type lease_key: str|unicode
+    :param lease_key: the job is skipped unless the lease of the key is acquired by current process. Every server
+        process runs its own scheduler, the lease makes sure the job runs once in the cluster. Jobs saved by old versions
+        have no lease_key and always run
+
+    :type lease_seconds: int|float
+    :param lease_seconds: how long the lease is held. It's not released after execution, so that the other processes
+        firing the same tick of an interval job skip it too
+    """
+    if lease_key and not acquire_lease(lease_key, lease_seconds):
+        log.debug("job %s is leased by another process, skipped" % lease_key)
+        return
+
+    if isinstance(context, str):
+        context = decode_context(context)
+    return __execute(DURABLE, feature, method, context)
+
+
+def acquire_lease(lease_key, lease_seconds):
+    """Acquire the lease of a job in MongoDB, shared by all server processes
+
+    The lease is taken over if it expired, so that the jobs of a crashed process are picked up by others once its
+    leases expire.
+
+    :rtype: bool
+    :return: True if current process holds the lease. False if MongoDB fails: the job may run in another process,
+        a skipped tick is picked up by the next one while a job run twice might not be idempotent
     """
+    now = get_now()
+    owner = _lease_owner()
+    try:
+        # the upsert inserts a new lease if none exists, or fails with duplicate key if the lease is held by others
+        JobLease.objects(job_id=lease_key, lease_until__lt=now).update_one(
+            upsert=True,
+            set__owner=owner,
+            set__lease_until=now + timedelta(seconds=lease_seconds),
+            set__update_time=now)
+        acquired = True
+    except NotUniqueError:
+        acquired = False
+    except Exception as e:
+        log.error(e)
+        acquired = False
+
+    with running_jobs_lock:
+        lease_counters["acquired" if acquired else "skipped"] += 1
+    return acquired
+
+
+def release_lease(lease_key):
+    """Release a lease held by current process before it expires, so that other processes can acquire it at once
+
+    :type lease_key: str|unicode
+    :param lease_key: key of the lease acquired by acquire_lease
+    """
+    try:
+        JobLease.objects(job_id=lease_key, owner=_lease_owner()).delete()
+    except Exception as e:
+        log.error(e)
+
+
+def _lease_owner():
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def transient_executor(feature, method, context):
+    """task for apscheduler jobs of the transient lane, see scheduler_executor
+
+    Transient jobs live in memory of the process who added them, no lease is needed.
+    """
+    return __execute(TRANSIENT, feature, method, context)
+
+
+def __execute(lane, feature, method, context):
     log.debug("prepare to execute '%s.%s' with context: %s" % (feature, method, context))
-    inst = RequiredFeature(feature)
-    mtd = getattr(inst, method)
-    args_len = len(inspect.getargspec(mtd).args)
+    with running_jobs_lock:
+        running_jobs[lane] += 1
 
-    if args_len < 2:
-        # if target method doesn't expect any parameter except 'self', the args_len is 1
-        mtd()
-    else:
-        # call with execution context
-        mtd(context)
+    try:
+        inst = RequiredFeature(feature)
+        mtd = getattr(inst, method)
+        args_len = len(inspect.getargspec(mtd).args)
+
+        if args_len < 2:
+            # if target method doesn't expect any parameter except 'self', the args_len is 1
+            return mtd()
+        else:
+            # call with execution context
+            return mtd(context)
+    finally:
+        with running_jobs_lock:
+            running_jobs[lane] -= 1
 
 
 class HackathonScheduler(object):
-    """An helper class for apscheduler"""
+    """An helper class for apscheduler
+
+    Jobs run in two lanes, each has its own job store and thread pool:
+        durable: interval jobs and the one-off jobs that must survive restart. Saved in the configured job store which
+            is MongoDB or MySQL in production
+        transient: short-lived one-off jobs like polls and retries. Kept in memory of current process, the count of
+            pending jobs is bounded by 'scheduler.transient_capacity', jobs beyond it are rejected
+
+    Every server process(uWSGI worker or host) runs its own scheduler and registers the same interval jobs. Durable jobs
+    are leased in MongoDB before execution, so that a tick of an interval job is executed by one process only and a
+    one-off job by the first process who fires it. See 'scheduler.lease' in config. Interval jobs added with
+    per_process=True run in the transient lane of every process instead.
+    """
     jobstore = "ohp"
+    transient_jobstore = "transient"
 
     def get_scheduler(self):
         """Return the apscheduler instance in case you have to call it directly
@@ -103,7 +248,8 @@ class HackathonScheduler(object):
         """
         return self.__apscheduler
 
-    def add_once(self, feature, method, context=None, id=None, replace_existing=True, run_date=None, **delta):
+    def add_once(self, feature, method, context=None, id=None, replace_existing=True, run_date=None, durable=False,
+                 **delta):
         """Add a job to APScheduler and executed only once
 
         Job will be executed at 'run_date' or after certain timedelta.
@@ -134,13 +280,30 @@ class HackathonScheduler(object):
         :type run_date: datetime | None
         :param run_date: job run date. If None, job run date will be datetime.now()+timedelta(delta)
 
+        :type durable: bool
+        :param durable: save the job in durable job store so that it survives restart. Otherwise it's kept in memory,
+            and rejected if the transient lane is full
+
         :type delta: kwargs for timedelta
         :param delta: kwargs for timedelta. For example: minutes=5. Will be ignored if run_date is not None
         """
         if not run_date:
             run_date = get_now() + timedelta(**delta)
 
-        if self.__apscheduler:
+        if not self.__apscheduler:
+            return
+
+        if not durable and self.__transient_store.job_count >= self.transient_capacity:
+            # spilling over into durable lane would flood the job store when it's overloaded
+            log.error("transient job lane is full, job %s.%s rejected" % (feature, method))
+            with running_jobs_lock:
+                rejected_jobs[TRANSIENT] += 1
+            return
+
+        if durable:
+            # the lease key is made of id and run date, it must be the same in every process that loads the job from
+            # job store. The run date tells apart the jobs that reuse an id, one after another
+            id = id or uuid.uuid4().hex
             self.__apscheduler.add_job(scheduler_executor,
                                        trigger='date',
                                        run_date=run_date,
@@ -148,10 +311,23 @@ class HackathonScheduler(object):
                                        max_instances=1,
                                        replace_existing=replace_existing,
                                        jobstore=self.jobstore,
+                                       executor="default",
+                                       args=[feature, method, self.__encode(context)],
+                                       kwargs=self.__lease_kwargs("%s@%s" % (id, run_date.isoformat()),
+                                                                  self.one_off_lease_seconds))
+        else:
+            self.__apscheduler.add_job(transient_executor,
+                                       trigger='date',
+                                       run_date=run_date,
+                                       id=id,
+                                       max_instances=1,
+                                       replace_existing=replace_existing,
+                                       jobstore=self.transient_jobstore,
+                                       executor=TRANSIENT,
                                        args=[feature, method, context])
 
     def add_interval(self, feature, method, context=None, id=None, replace_existing=True, next_run_time=undefined,
-                     **interval):
+                     per_process=False, **interval):
         """Add an interval job to APScheduler and executed.
 
         Job will be executed firstly at 'next_run_time'. And then executed in interval.
@@ -181,10 +357,39 @@ class HackathonScheduler(object):
         :type next_run_time: datetime | undefined
         :param next_run_time: the first time the job will be executed. leave undefined to don't execute until interval time reached
 
+        :type per_process: bool
+        :param per_process: run the job in every process, for jobs working on the memory of current process like the
+            write-behind buffers and in-process indexes. Such job is kept in the transient lane without lease. Otherwise
+            the job is saved in durable job store and a tick runs once in the cluster
+
         :type interval: kwargs for "interval" trigger
         :param interval: kwargs for "interval" trigger. For example: minutes=5.
         """
-        if self.__apscheduler:
+        if self.__apscheduler and per_process:
+            id = id or uuid.uuid4().hex
+            # the same job might be saved in durable job store by old versions, where it runs in one process only
+            try:
+                self.__apscheduler.remove_job(id, jobstore=self.jobstore)
+            except JobLookupError:
+                pass
+            except Exception as e:
+                log.error(e)
+
+            self.__apscheduler.add_job(transient_executor,
+                                       trigger='interval',
+                                       id=id,
+                                       max_instances=1,
+                                       replace_existing=replace_existing,
+                                       next_run_time=next_run_time,
+                                       jobstore=self.transient_jobstore,
+                                       executor=TRANSIENT,
+                                       args=[feature, method, context],
+                                       **interval)
+        elif self.__apscheduler:
+            id = id or uuid.uuid4().hex
+            # hold the lease for almost a whole tick so that other processes firing the same tick skip it
+            seconds = timedelta(**dict((k, v) for k, v in interval.items() if k in INTERVAL_UNITS)).total_seconds()
+            lease_seconds = max(seconds - self.tick_margin_seconds, seconds / 2)
             self.__apscheduler.add_job(scheduler_executor,
                                        trigger='interval',
                                        id=id,
@@ -192,7 +397,8 @@ class HackathonScheduler(object):
                                        replace_existing=replace_existing,
                                        next_run_time=next_run_time,
                                        jobstore=self.jobstore,
-                                       args=[feature, method, context],
+                                       args=[feature, method, self.__encode(context)],
+                                       kwargs=self.__lease_kwargs(id, lease_seconds),
                                        **interval)
 
     def remove_job(self, job_id):
@@ -203,7 +409,8 @@ class HackathonScheduler(object):
         """
         if self.__apscheduler:
             try:
-                self.__apscheduler.remove_job(job_id, self.jobstore)
+                # look up in both lanes
+                self.__apscheduler.remove_job(job_id)
             except JobLookupError:
                 log.debug("remove job failed because job %s not found" % job_id)
             except Exception as e:
@@ -212,10 +419,77 @@ class HackathonScheduler(object):
     def has_job(self, job_id):
         """Check the existence of specific job """
         if self.__apscheduler:
-            job = self.__apscheduler.get_job(job_id, jobstore=self.jobstore)
+            job = self.__apscheduler.get_job(job_id)
             return job is not None
         return False
 
+    def get_next_run_time(self, job_id):
+        """Return when the job will run next time
+
+        :type job_id: str | unicode
+        :param job_id: the id of job
+
+        :rtype: datetime
+        :return: datetime without tzinfo like get_now(), None if the job not found
+        """
+        if self.__apscheduler:
+            job = self.__apscheduler.get_job(job_id)
+            if job and job.next_run_time:
+                return job.next_run_time.astimezone(utc).replace(tzinfo=None)
+        return None
+
+    def stats(self):
+        """Return the count of pending and running jobs as well as thread pool size of both lanes
+
+        :rtype: dict
+        :return: dict keyed by lane
+        """
+        return {
+            DURABLE: {
+                "pending": self.__count_jobs(self.__durable_store),
+                "running": running_jobs[DURABLE],
+                "max_workers": self.durable_workers
+            },
+            TRANSIENT: {
+                "pending": self.__count_jobs(self.__transient_store),
+                "running": running_jobs[TRANSIENT],
+                "max_workers": self.transient_workers,
+                "capacity": self.transient_capacity,
+                "rejected": rejected_jobs[TRANSIENT]
+            },
+            "lease": dict(lease_counters, enabled=self.lease_enabled)
+        }
+
+    def report_health(self):
+        """Report the job counters as a health check item. Warning if the transient lane is full"""
+        stats = self.stats()
+        if stats[TRANSIENT]["pending"] >= self.transient_capacity:
+            stats[HEALTH.STATUS] = HEALTH_STATUS.WARNING
+            stats[HEALTH.DESCRIPTION] = "transient job lane is full"
+        else:
+            stats[HEALTH.STATUS] = HEALTH_STATUS.OK
+        return stats
+
+    def __encode(self, context):
+        # durable jobs are pickled into job store with their args, the compact encoding keeps the documents small
+        return encode_context(context) if context is not None else None
+
+    def __lease_kwargs(self, id, lease_seconds):
+        if not self.lease_enabled:
+            return {}
+        return {"lease_key": id, "lease_seconds": lease_seconds}
+
+    def __count_jobs(self, store):
+        """Count jobs without loading them, get_jobs would unpickle every job of the store"""
+        if store is None:
+            return 0
+        if isinstance(store, CountingMemoryJobStore):
+            return store.job_count
+        if isinstance(store, MongoDBJobStore):
+            return store.collection.count()
+        # SQLAlchemyJobStore
+        return store.engine.execute(store.jobs_t.count()).scalar()
+
     def __init__(self, app):
         """Initialize APScheduler
 
@@ -224,6 +498,14 @@ class HackathonScheduler(object):
         """
         self.app = app
         self.__apscheduler = None
+        self.__durable_store = None
+        self.__transient_store = None
+        self.durable_workers = safe_get_config("scheduler.durable_workers", 10)
+        self.transient_workers = safe_get_config("scheduler.transient_workers", 20)
+        self.transient_capacity = safe_get_config("scheduler.transient_capacity", 1000)
+        self.lease_enabled = safe_get_config("scheduler.lease.enabled", True)
+        self.one_off_lease_seconds = safe_get_config("scheduler.lease.one_off_seconds", 600)
+        self.tick_margin_seconds = safe_get_config("scheduler.lease.tick_margin_seconds", 5)
 
         # NOT instantiate while in flask DEBUG mode or in the main thread
         # It's to avoid APScheduler being instantiated twice
@@ -231,20 +513,27 @@ class HackathonScheduler(object):
             self.__apscheduler = BackgroundScheduler(timezone=utc)
 
             # add MySQL job store
+            # job stores are kept to count their jobs, see stats
             job_store_type = safe_get_config("scheduler.job_store", "memory")
             if job_store_type == "mysql":
                 log.debug("add aps_cheduler job store based on mysql")
-                self.__apscheduler.add_jobstore('sqlalchemy',
-                                                alias=self.jobstore,
-                                                url=get_config("scheduler.job_store_url"))
+                from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+                self.__durable_store = SQLAlchemyJobStore(url=get_config("scheduler.job_store_url"))
             elif job_store_type == "mongodb":
                 log.debug("add aps_cheduler job store based on mongodb")
-                self.__apscheduler.add_jobstore('mongodb',
-                                                alias=self.jobstore,
-                                                database=safe_get_config("scheduler.database", "apscheduler"),
-                                                collection=safe_get_config("scheduler.collection", "jobs"),
-                                                host=safe_get_config("scheduler.host", "localhost"),
-                                                port=safe_get_config("scheduler.port", 27017))
+                self.__durable_store = MongoDBJobStore(database=safe_get_config("scheduler.database", "apscheduler"),
+                                                       collection=safe_get_config("scheduler.collection", "jobs"),
+                                                       host=safe_get_config("scheduler.host", "localhost"),
+                                                       port=safe_get_config("scheduler.port", 27017))
+            else:
+                self.__durable_store = CountingMemoryJobStore()
+            self.__apscheduler.add_jobstore(self.__durable_store, alias=self.jobstore)
+
+            # the transient lane
+            self.__transient_store = CountingMemoryJobStore()
+            self.__apscheduler.add_jobstore(self.__transient_store, alias=self.transient_jobstore)
+            self.__apscheduler.add_executor(ThreadPoolExecutor(self.durable_workers), alias="default")
+            self.__apscheduler.add_executor(ThreadPoolExecutor(self.transient_workers), alias=TRANSIENT)
 
             # add event listener
             self.__apscheduler.add_listener(scheduler_listener, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_ADDED)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+__all__ = ["EndpointAllocator", "get_endpoint_allocator"]
+
+import time
+from bisect import bisect_left
+from threading import Lock
+
+from hackathon.util import safe_get_config
+from utils import take_unassigned_endpoints
+
+
+class EndpointAllocator(object):
+    """Allocate public endpoints of azure cloud services from a per-process cache of assigned endpoints
+
+    The assigned endpoints of a cloud service are read from azure once and kept sorted, endpoints allocated by this
+    process are added right away and released ones removed. So a burst of allocations on the same cloud service costs
+    one azure read instead of one per allocation. The legacy service management API exposes no ETag for hosted
+    services, the cache is refreshed once it's older than max_age_seconds or invalidated after a failed update.
+
+    Don't create it directly, use get_endpoint_allocator() so that all starters share the cache.
+
+    :Example:
+        allocator = get_endpoint_allocator()
+        public_ports = allocator.allocate(cloud_service_name, [8080, 22],
+                                          lambda: vm_adapter.get_assigned_endpoints(cloud_service_name))
+    """
+
+    def __init__(self, max_age_seconds=60):
+        self.max_age_seconds = max_age_seconds
+        # cloud service name -> (loaded_at, sorted list of assigned endpoints)
+        self.__services = {}
+        # cloud service name -> Lock, so that concurrent allocations on one cloud service share a single load
+        self.__service_locks = {}
+        self.__lock = Lock()
+
+        self.loads = 0
+        self.allocations = 0
+
+    def allocate(self, cloud_service_name, endpoints, load):
+        """Assign public endpoints for the desired ones and reserve them in cache
+
+        :type cloud_service_name: str|unicode
+        :param cloud_service_name: the name of cloud service
+
+        :type endpoints: list
+        :param endpoints: a list of int or str, the desired endpoints
+
+        :type load: function
+        :param load: function that returns the endpoints assigned in cloud service, called on cache miss
+
+        :rtype: list
+        :return a list of int, public endpoint for each of the desired ones
+        """
+        with self.__get_service_lock(cloud_service_name):
+            entry = self.__services.get(cloud_service_name)
+            if entry is None or entry[0] + self.max_age_seconds < time.time():
+                entry = (time.time(), sorted(set(map(int, load()))))
+                self.__services[cloud_service_name] = entry
+                self.loads += 1
+
+            self.allocations += 1
+            return take_unassigned_endpoints(endpoints, entry[1])
+
+    def release(self, cloud_service_name, endpoints):
+        """Remove endpoints from cache after they are deleted from cloud service or failed to be assigned
+
+        :type endpoints: list
+        :param endpoints: a list of int or str
+        """
+        with self.__get_service_lock(cloud_service_name):
+            entry = self.__services.get(cloud_service_name)
+            if entry is None:
+                return
+
+            assigned = entry[1]
+            for endpoint in map(int, endpoints):
+                i = bisect_left(assigned, endpoint)
+                if i < len(assigned) and assigned[i] == endpoint:
+                    del assigned[i]
+
+    def invalidate(self, cloud_service_name):
+        """Drop the cache of cloud service so that the next allocation reads azure again"""
+        with self.__get_service_lock(cloud_service_name):
+            self.__services.pop(cloud_service_name, None)
+
+    def stats(self):
+        """Return the count of cached cloud services, azure reads and allocations"""
+        return {
+            "cloud_services": len(self.__services),
+            "loads": self.loads,
+            "allocations": self.allocations
+        }
+
+    def __get_service_lock(self, cloud_service_name):
+        with self.__lock:
+            return self.__service_locks.setdefault(cloud_service_name, Lock())
+
+
+endpoint_allocator = None
+endpoint_allocator_lock = Lock()
+
+
+def get_endpoint_allocator():
+    """Get the endpoint allocator shared by the whole process
+
+    :rtype: EndpointAllocator
+    """
+    global endpoint_allocator
+    if endpoint_allocator is None:
+        with endpoint_allocator_lock:
+            if endpoint_allocator is None:
+                endpoint_allocator = EndpointAllocator(safe_get_config("azure.endpoint_cache_seconds", 60))
+    return endpoint_allocator
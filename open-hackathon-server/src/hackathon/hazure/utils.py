@@ -24,7 +24,10 @@ THE SOFTWARE.
 """
 
 __author__ = "rapidhere"
-__all__ = ["get_network_config", "get_remote_parameters", "add_endpoint_to_network_config", "find_unassigned_endpoints"]
+__all__ = ["get_network_config", "get_remote_parameters", "add_endpoint_to_network_config", "find_unassigned_endpoints",
+           "take_unassigned_endpoints"]
+
+from bisect import bisect_left, insort
 
 from azure.servicemanagement import ConfigurationSet, ConfigurationSetInputEndpoint
 from hackathon.template.template_constants import AZURE_UNIT
@@ -32,14 +35,21 @@ from hackathon.template.template_constants import AZURE_UNIT
 # endpoint constants
 ENDPOINT_PREFIX = 'AUTO-'
 ENDPOINT_PROTOCOL = 'TCP'
+MAX_ENDPOINT = 65535
 
 
-def get_network_config(network_config, assigned_endpoints):
+def get_network_config(network_config, assigned_endpoints=None, assign=None):
     """A helper to generate network config from azure_template_unit's network config
 
     decouple from azure_template_unit.get_network_config
     Public endpoint should be assigned in real time
+
+    :param assigned_endpoints: a list of int or str, endpoints already assigned in cloud service
+    :param assign: function that takes a list of endpoints and returns the public endpoints assigned to them,
+        overrides assigned_endpoints. e.g. the allocate method of EndpointAllocator
     """
+    if assign is None:
+        assign = lambda e: find_unassigned_endpoints(e, assigned_endpoints or [])
 
     nc = network_config
 
@@ -48,16 +58,15 @@ def get_network_config(network_config, assigned_endpoints):
     input_endpoints = nc[AZURE_UNIT.NETWORK_CONFIG_INPUT_ENDPOINTS]
     # avoid duplicate endpoint under same cloud service
     endpoints = map(lambda i: i[AZURE_UNIT.NETWORK_CONFIG_INPUT_ENDPOINTS_LOCAL_PORT], input_endpoints)
-    unassigned_endpoints = map(str, find_unassigned_endpoints(endpoints, assigned_endpoints))
-    map(lambda (i, u): i.update({AZURE_UNIT.NETWORK_CONFIG_INPUT_ENDPOINTS_PORT: u}),
-        zip(input_endpoints, unassigned_endpoints))
+    unassigned_endpoints = map(str, assign(endpoints))
 
-    for input_endpoint in input_endpoints:
+    # the raw network config belongs to a template unit shared by experiments, don't write the public ports back
+    for input_endpoint, port in zip(input_endpoints, unassigned_endpoints):
         network_config.input_endpoints.input_endpoints.append(
             ConfigurationSetInputEndpoint(
                 input_endpoint[AZURE_UNIT.NETWORK_CONFIG_INPUT_ENDPOINTS_NAME],
                 input_endpoint[AZURE_UNIT.NETWORK_CONFIG_INPUT_ENDPOINTS_PROTOCOL],
-                input_endpoint[AZURE_UNIT.NETWORK_CONFIG_INPUT_ENDPOINTS_PORT],
+                port,
                 input_endpoint[AZURE_UNIT.NETWORK_CONFIG_INPUT_ENDPOINTS_LOCAL_PORT]
             )
         )
@@ -91,17 +100,37 @@ def find_unassigned_endpoints(endpoints, assigned_endpoints):
     :param assigned_endpoints: a list of int or str
     :return: unassigned_endpoints: a list of int
     """
-    endpoints = map(int, endpoints)
-    assigned_endpoints = map(int, assigned_endpoints)
+    return take_unassigned_endpoints(endpoints, sorted(set(map(int, assigned_endpoints))))
+
+
+def take_unassigned_endpoints(endpoints, sorted_assigned):
+    """
+    Return a list of unassigned endpoints, each is the first free one from the desired endpoint on(wrapping around)
+    :param endpoints: a list of int or str, the desired endpoints
+    :param sorted_assigned: a sorted list of int without duplicates, the endpoints returned are inserted into it
+    :return: unassigned_endpoints: a list of int
+    """
     unassigned_endpoints = []
-    for endpoint in endpoints:
-        while endpoint in assigned_endpoints:
-            endpoint = (endpoint + 1) % 65536
-        assigned_endpoints.append(endpoint)
+    for endpoint in map(int, endpoints):
+        endpoint = _next_free_endpoint(sorted_assigned, endpoint)
+        insort(sorted_assigned, endpoint)
         unassigned_endpoints.append(endpoint)
     return unassigned_endpoints
 
 
+def _next_free_endpoint(sorted_assigned, endpoint):
+    # the gap after a run of consecutive assigned endpoints is found by one binary search plus a walk over the run
+    for start in [endpoint, 0]:
+        endpoint = start
+        i = bisect_left(sorted_assigned, endpoint)
+        while i < len(sorted_assigned) and sorted_assigned[i] == endpoint:
+            endpoint += 1
+            i += 1
+        if endpoint <= MAX_ENDPOINT:
+            return endpoint
+    raise Exception("no unassigned endpoint left")
+
+
 def add_endpoint_to_network_config(network_config, public_endpoints, private_endpoints):
     """
     Return a new network config
@@ -28,7 +28,12 @@ import sys
 
 sys.path.append("..")
 
-from hackathon.util import get_now
+import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from hackathon.log import log
+from hackathon.util import get_now, safe_get_config
 from hackathon import RequiredFeature
 from hackathon.constants import HEALTH_STATUS
 
@@ -39,6 +44,15 @@ __all__ = ["report_health"]
 app_start_time = get_now()
 
 STATUS = "status"
+DESCRIPTION = "description"
+
+# items are checked concurrently, an item that doesn't respond before the deadline is reported as timeout
+executor = ThreadPoolExecutor(max_workers=safe_get_config("health.max_workers", 8))
+timeout_seconds = safe_get_config("health.timeout_seconds", 10)
+
+# reports are cached so that probes from several load balancers don't check all items every time
+cache_seconds = safe_get_config("health.cache_seconds", 10)
+report_cache = {}  # q -> (expire_at, health)
 
 # all available health check items
 all_health_items = {
@@ -47,7 +61,10 @@ all_health_items = {
     "guacamole": RequiredFeature("health_check_guacamole"),
     "azure": RequiredFeature("health_check_azure"),
     "storage": RequiredFeature("storage"),
-    "mongodb": RequiredFeature("health_check_mongodb")
+    "mongodb": RequiredFeature("health_check_mongodb"),
+    "cache": RequiredFeature("cache"),
+    "scheduler": RequiredFeature("scheduler"),
+    "warm_pool": RequiredFeature("warm_pool")
 }
 
 # basic health check items which are fundamental for OHP
@@ -57,6 +74,9 @@ basic_health_items = {
     "storage": RequiredFeature("storage")
 }
 
+# q -> lock held while its report is generated, a slow item of one report won't hold back reports of other q
+report_locks = dict((q, Lock()) for q in [None, "all"] + all_health_items.keys())
+
 
 def __report_detail(health, items):
     """Report the details of health check item
@@ -70,8 +90,24 @@ def __report_detail(health, items):
     :rtype dict
     :return health status including overall status and details of sub items
     """
-    for key, value in items.iteritems():
-        sub_report = value.report_health()
+    futures = dict((executor.submit(value.report_health), key) for key, value in items.iteritems())
+    done, not_done = wait(futures.keys(), timeout=timeout_seconds)
+
+    for future, key in futures.iteritems():
+        if future in not_done:
+            sub_report = {
+                STATUS: HEALTH_STATUS.WARNING,
+                DESCRIPTION: "no response in %d seconds" % timeout_seconds
+            }
+        elif future.exception() is not None:
+            log.error(future.exception())
+            sub_report = {
+                STATUS: HEALTH_STATUS.ERROR,
+                DESCRIPTION: str(future.exception())
+            }
+        else:
+            sub_report = future.result()
+
         health[key] = sub_report
         if sub_report[STATUS] != HEALTH_STATUS.OK and health[STATUS] != HEALTH_STATUS.ERROR:
             health[STATUS] = sub_report[STATUS]
@@ -87,6 +123,25 @@ def report_health(q):
     :rtype dict
     :return health status including overall status and details of sub items
     """
+    if q != "all" and q not in all_health_items:
+        q = None  # basic items
+
+    cached = report_cache.get(q)
+    if cached and cached[0] > time.time():
+        return cached[1]
+
+    # only one report per q is generated at a time, others wait for it and get it from cache
+    with report_locks[q]:
+        cached = report_cache.get(q)
+        if cached and cached[0] > time.time():
+            return cached[1]
+
+        health = __generate_report(q)
+        report_cache[q] = (time.time() + cache_seconds, health)
+        return health
+
+
+def __generate_report(q):
     items = basic_health_items
     if q == "all":
         items = all_health_items
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+from bson import DBRef
+from flask import g, has_request_context
+from mongoengine.base import BaseDocument
+
+__all__ = ["BatchLoader", "get_loader"]
+
+
+class BatchLoader(object):
+    """Load documents of one collection by the values of a key, one `$in` query for many values
+
+    Loaded documents are memoized, a value is queried at most once in the lifetime of the loader. Use get_loader() to
+    share loaders in a request.
+
+    :Example:
+        users = get_loader(User).load_many(user_ids)
+
+        # teams with Team.leader filled so that team.leader won't query DB one by one
+        teams = get_loader(User).resolve(Team.objects(hackathon=hackathon), "leader")
+
+        # the UserHackathon of each user in a hackathon
+        rels = get_loader(UserHackathon, key="user", hackathon=hackathon).load_many(user_ids)
+    """
+
+    def __init__(self, document, key="id", **filters):
+        self.document = document
+        self.key = key
+        self.filters = filters
+        # key value -> document, None if not found
+        self.__loaded = {}
+
+    def load(self, value):
+        return self.load_many([value])[0]
+
+    def load_many(self, values):
+        """Load documents whose key equals to the values
+
+        :type values: list
+        :param values: values of the key. None is allowed and always loaded as None
+
+        :rtype: list
+        :return documents in the same order as values, None if not found. The first one is returned if several
+            documents have the same key
+        """
+        values = [_ref_id(v) for v in values]
+        missing = set(v for v in values if v is not None and v not in self.__loaded)
+        if missing:
+            query = dict(self.filters)
+            query[self.key + "__in"] = list(missing)
+            # the key is read from raw rows, a ReferenceField key would be dereferenced one by one on documents
+            db_key = self.document._fields[self.key].db_field
+            for son in self.document.objects(**query).as_pymongo():
+                found = _ref_id(son.get(db_key))
+                if found in missing:
+                    self.__loaded[found] = self.document._from_son(son)
+                    missing.remove(found)
+            for v in missing:
+                self.__loaded[v] = None
+
+        return [self.__loaded.get(v) for v in values]
+
+    def resolve(self, queryset, field):
+        """Query documents whose ReferenceField is filled by the documents of this loader
+
+        A reference whose document doesn't exist is left as it is and dereferenced on access.
+
+        :type queryset: QuerySet
+        :param queryset: query of the documents with the field
+
+        :type field: str|unicode
+        :param field: name of the ReferenceField
+
+        :rtype: list
+        :return: documents of the queryset
+        """
+        db_field = queryset._document._fields[field].db_field
+        sons = list(queryset.as_pymongo())
+        refs = self.load_many([son.get(db_field) for son in sons])
+        for son, ref in zip(sons, refs):
+            if ref is not None:
+                son[db_field] = ref
+        return [queryset._document._from_son(son) for son in sons]
+
+
+def _ref_id(value):
+    # the id of a DBRef or a document, value itself otherwise
+    if isinstance(value, DBRef):
+        return value.id
+    if isinstance(value, BaseDocument):
+        return value.pk
+    return value
+
+
+def get_loader(document, key="id", **filters):
+    """Get the loader shared in current request, or a new one out of request
+
+    :type document: class
+    :param document: the Document class to load
+
+    :type key: str|unicode
+    :param key: field to load documents by, "id" by default
+
+    :param filters: other conditions of the query
+
+    :rtype: BatchLoader
+    """
+    if not has_request_context():
+        return BatchLoader(document, key, **filters)
+
+    loaders = getattr(g, "batch_loaders", None)
+    if loaders is None:
+        loaders = g.batch_loaders = {}
+
+    loader_key = (document, key, tuple(sorted((k, _ref_id(v)) for k, v in filters.items())))
+    loader = loaders.get(loader_key)
+    if loader is None:
+        loader = loaders[loader_key] = BatchLoader(document, key, **filters)
+    return loader
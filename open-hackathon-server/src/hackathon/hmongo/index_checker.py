@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+from bson import ObjectId
+from mongoengine import Q
+
+from hackathon.util import get_now
+from hackathon.constants import HACK_USER_TYPE, HACK_USER_STATUS, HACKATHON_STAT, EStatus
+from models import User, UserToken, Template, Hackathon, UserHackathon, HackathonStat, HackathonNotice, Team, \
+    DockerHostServer, Experiment, ProvisioningCheckpoint, JobLease, HostImage, \
+    HostPortAllocation
+
+__all__ = ["QUERY_SHAPES", "check_query_shapes", "sync_indexes"]
+
+# options that make two indexes with the same keys different. MongoDB refuses to create the index if they differ
+INDEX_OPTIONS = ["unique", "sparse", "expireAfterSeconds"]
+
+MODELS = [User, UserToken, Template, Hackathon, UserHackathon, HackathonStat, HackathonNotice, Team, DockerHostServer,
+          Experiment, ProvisioningCheckpoint, JobLease, HostImage, HostPortAllocation]
+
+
+def _id():
+    # any id works, explain() only cares about the shape of the query
+    return ObjectId()
+
+
+# hot query shapes: (description, function that returns the queryset). Register new ones here when adding queries on
+# big collections so that `python check_indexes.py` tells whether they are covered by declared indexes
+QUERY_SHAPES = [
+    ("User by name and password",
+     lambda: User.objects(name="admin", password="")),
+    ("User by provider and openid",
+     lambda: User.objects(provider="github", openid="")),
+    ("UserToken by token",
+     lambda: UserToken.objects(token="5d2ba2c4-f6e5-11e5-9ce9-5e5517507c66")),
+    ("Hackathon by status",
+     lambda: Hackathon.objects(status=1)),
+    ("UserHackathon by user and hackathon",
+     lambda: UserHackathon.objects(user=_id(), hackathon=_id(), role=HACK_USER_TYPE.COMPETITOR)),
+    ("UserHackathon by user and role",
+     lambda: UserHackathon.objects(user=_id(), role=HACK_USER_TYPE.ADMIN)),
+    ("UserHackathon registered users of hackathon",
+     lambda: UserHackathon.objects(hackathon=_id(),
+                                   role=HACK_USER_TYPE.COMPETITOR,
+                                   deleted=False,
+                                   status__in=[HACK_USER_STATUS.AUTO_PASSED, HACK_USER_STATUS.AUDIT_PASSED])),
+    ("HackathonStat by hackathon and type",
+     lambda: HackathonStat.objects(hackathon=_id(), type=HACKATHON_STAT.REGISTER)),
+    ("HackathonStat hot hackathons",
+     lambda: HackathonStat.objects(type=HACKATHON_STAT.REGISTER, count__gt=0).order_by("-count")),
+    ("HackathonNotice public notices",
+     lambda: HackathonNotice.objects(Q(hackathon__in=[_id(), _id()]) | Q(hackathon=None), receiver=None).order_by(
+         "-update_time")),
+    ("HackathonNotice public notices by cursor",
+     lambda: HackathonNotice.objects((Q(update_time__lt=get_now()) | Q(update_time=get_now(), id__lt=_id())) &
+                                     (Q(hackathon__in=[_id(), _id()]) | Q(hackathon=None)),
+                                     receiver=None).order_by("-update_time", "-id")),
+    ("HackathonNotice unread notices of user",
+     lambda: HackathonNotice.objects(receiver=_id(), hackathon=_id(), is_read=False).order_by("-update_time")),
+    ("Team by hackathon and member",
+     lambda: Team.objects(hackathon=_id(), members__user=_id())),
+    ("Team by member",
+     lambda: Team.objects(members__user=_id())),
+    ("Team by hackathon and name",
+     lambda: Team.objects(hackathon=_id(), name="").order_by("name")),
+    ("DockerHostServer by hackathon and state",
+     lambda: DockerHostServer.objects(hackathon=_id(), state=2)),
+    ("DockerHostServer most free",
+     lambda: DockerHostServer.objects(hackathon=_id(), state=2, disabled=False, free_slots__gt=0).order_by(
+         "-free_slots")),
+    ("DockerHostServer least loaded",
+     lambda: DockerHostServer.objects(hackathon=_id(), state=2, disabled=False, free_slots__gt=0).order_by(
+         "container_count")),
+    ("HostPortAllocation of host",
+     lambda: HostPortAllocation.objects(host=_id())),
+    ("HostImage of hosts",
+     lambda: HostImage.objects(host__in=[_id(), _id()], image__in=["", ""])),
+    ("Experiment of hackathon by cursor",
+     lambda: Experiment.objects(hackathon=_id(), id__lt=_id()).order_by("-id")),
+    ("Experiment to be recycled",
+     lambda: Experiment.objects(hackathon=_id(), status=EStatus.RUNNING, create_time__lt=get_now())),
+    ("Experiment expired",
+     lambda: Experiment.objects(status=EStatus.RUNNING, expires_at__lte=get_now()).order_by("expires_at")),
+    ("Experiment to be recycled soonest",
+     lambda: Experiment.objects(status=EStatus.RUNNING, expires_at__ne=None).order_by("expires_at")),
+    ("Experiment of user",
+     lambda: Experiment.objects(user=_id(), hackathon=_id(), status__in=[EStatus.RUNNING, EStatus.STARTING])),
+    ("Experiment pre-allocated",
+     lambda: Experiment.objects(status=EStatus.RUNNING, hackathon=_id(), template=_id(), user=None)),
+    ("Experiment starting in warm pool",
+     lambda: Experiment.objects(status=EStatus.STARTING, hackathon=_id(), template=_id(), user=None)),
+    ("Experiment starting of template",
+     lambda: Experiment.objects(user=None, template=_id(), status=EStatus.STARTING)),
+    ("Experiment starting",
+     lambda: Experiment.objects(status=EStatus.STARTING)),
+    ("Experiment by virtual environment name",
+     lambda: Experiment.objects(virtual_environments__name="")),
+    ("ProvisioningCheckpoint by step id",
+     lambda: ProvisioningCheckpoint.objects(step_id="")),
+    ("ProvisioningCheckpoint orphans",
+     lambda: ProvisioningCheckpoint.objects(lease_until__lt=get_now())),
+    ("JobLease expired lease of job",
+     lambda: JobLease.objects(job_id="", lease_until__lt=get_now())),
+]
+
+
+def _collect_stages(plan, stages):
+    stages.append(plan.get("stage"))
+    if "inputStage" in plan:
+        _collect_stages(plan["inputStage"], stages)
+    for p in plan.get("inputStages", []):
+        _collect_stages(p, stages)
+    return stages
+
+
+def explain_problems(queryset):
+    """Return the problems of the winning plan of a queryset, empty list if it's fully covered by index
+
+    :type queryset: QuerySet
+    :param queryset: the query to be explained
+
+    :rtype: list
+    :return list of problem description
+    """
+    explain = queryset.explain()
+    problems = []
+
+    if "queryPlanner" in explain:
+        stages = _collect_stages(explain["queryPlanner"]["winningPlan"], [])
+        if "COLLSCAN" in stages:
+            problems.append("COLLSCAN")
+        if "SORT" in stages:
+            problems.append("in-memory SORT")
+    else:
+        # mongodb before 3.0
+        if explain.get("cursor", "").startswith("BasicCursor"):
+            problems.append("COLLSCAN")
+        if explain.get("scanAndOrder"):
+            problems.append("in-memory SORT")
+
+    return problems
+
+
+def check_query_shapes(shapes=QUERY_SHAPES):
+    """Explain all registered query shapes and report those not covered by index
+
+    :type shapes: list
+    :param shapes: list of (description, function returns QuerySet)
+
+    :rtype: list
+    :return list of (description, problems) for the shapes not covered
+    """
+    uncovered = []
+    for description, build in shapes:
+        problems = explain_problems(build())
+        if problems:
+            uncovered.append((description, problems))
+
+    return uncovered
+
+
+def sync_indexes(models=MODELS):
+    """Create declared indexes, drop the existing ones that conflict with them
+
+    An index whose keys are declared with different options(e.g. the unique index of User that was once misspelled
+    'unqiue') cannot be created until the old one is dropped, mongoengine raises error upon first query otherwise. A
+    unique index cannot be created on duplicate documents either, they are removed before, the oldest one is kept.
+
+    :rtype: list
+    :return list of "collection.index" that exist in DB but not declared in models
+    """
+    undeclared = []
+    for model in models:
+        # not model._get_collection() which creates indexes and fails on the conflicting ones
+        collection = model._get_db()[model._get_collection_name()]
+        existing = collection.index_information()
+
+        declared = {}
+        for spec in model._meta["index_specs"]:
+            declared[tuple(spec["fields"])] = spec
+
+        unique_keys = set(tuple(info["key"]) for info in existing.itervalues() if info.get("unique"))
+        for name, info in existing.iteritems():
+            spec = declared.get(tuple(info["key"]))
+            if spec is None:
+                if name not in ["_id_", "_cls_1"]:
+                    undeclared.append("%s.%s" % (collection.name, name))
+            elif any(spec.get(opt) != info.get(opt) for opt in INDEX_OPTIONS if spec.get(opt) or info.get(opt)):
+                collection.drop_index(name)
+
+        for fields, spec in declared.iteritems():
+            if spec.get("unique") and fields not in unique_keys:
+                remove_duplicates(collection, fields)
+
+        model.ensure_indexes()
+
+    return undeclared
+
+
+def remove_duplicates(collection, fields):
+    """Delete the documents that have the same values on the fields as others, keep the oldest one
+
+    :type fields: tuple
+    :param fields: keys of index, list of (field, direction)
+
+    :rtype: int
+    :return count of documents deleted
+    """
+    group_id = dict((f.replace(".", "_"), "$" + f) for f, direction in fields)
+    pipeline = [
+        {"$group": {"_id": group_id, "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}]
+
+    deleted = 0
+    for group in collection.aggregate(pipeline, allowDiskUse=True):
+        deleted += collection.delete_many({"_id": {"$in": sorted(group["ids"])[1:]}}).deleted_count
+    return deleted
@@ -30,7 +30,7 @@ from mongoengine import *
 
 from hackathon.util import get_now, make_serializable
 from hackathon.constants import TEMPLATE_STATUS, HACK_USER_TYPE
-from pagination import Pagination
+from pagination import Pagination, CursorPagination
 
 
 def to_dic(obj):
@@ -53,6 +53,9 @@ class HQuerySet(QuerySet):
     def paginate(self, page, per_page):
         return Pagination(self, page, per_page)
 
+    def paginate_by_cursor(self, cursor, per_page, order_by="id", with_total=False):
+        return CursorPagination(self, cursor, per_page, order_by, with_total)
+
 
 class HDocumentBase(DynamicDocument):
     """
@@ -118,10 +121,12 @@ class User(HDocumentBase):
     meta = {
         "indexes": [
             {
-                # default unqiue is not sparse, so we have to set it by ourselves
+                # default unique is not sparse, so we have to set it by ourselves
+                # users login by db(e.g. admin) have neither provider nor openid
                 "fields": ["provider", "openid"],
-                "unqiue": True,
-                "sparse": True}]}
+                "unique": True,
+                "sparse": True},
+            "name"]}
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
@@ -141,6 +146,11 @@ class UserToken(HDocumentBase):
                 # but mongodb only support Single Key Index on Hashed Token so far
                 # set the `cls` option to False can disable this beahviour on mongoengine
                 "fields": ["#token"],
+                "cls": False},
+            {
+                # TTL index, mongodb removes the token once it expires. TTL index must be a single field index
+                "fields": ["expire_date"],
+                "expireAfterSeconds": 0,
                 "cls": False}]}
 
     def __init__(self, **kwargs):
@@ -155,6 +165,7 @@ class Template(HDocumentBase):
     description = StringField()
     virtual_environment_count = IntField(min_value=1, required=True)
     creator = ReferenceField(User)
+    content_hash = StringField()  # sha1 of the content, key of the local template store
 
     def __init__(self, **kwargs):
         super(Template, self).__init__(**kwargs)
@@ -223,6 +234,9 @@ class Hackathon(HDocumentBase):
     judge_end_time = DateTimeField()
     archive_time = DateTimeField()
 
+    meta = {
+        "indexes": ["status"]}
+
     def __init__(self, **kwargs):
         super(Hackathon, self).__init__(**kwargs)
 
@@ -237,6 +251,11 @@ class UserHackathon(HDocumentBase):
     remark = StringField()
     deleted = BooleanField(default=False)
 
+    meta = {
+        "indexes": [
+            ("user", "hackathon", "role"),
+            ("hackathon", "role", "status")]}
+
     def __init__(self, **kwargs):
         super(UserHackathon, self).__init__(**kwargs)
 
@@ -246,6 +265,14 @@ class HackathonStat(HDocumentBase):
     count = IntField(min_value=0)
     hackathon = ReferenceField(Hackathon)
 
+    meta = {
+        "indexes": [
+            {
+                # counters are increased by upsert on (hackathon, type), one stat per type
+                "fields": ["hackathon", "type"],
+                "unique": True},
+            ("type", "-count")]}
+
 
 class HackathonNotice(HDocumentBase):
     category = IntField()  # category: Class HACK_NOTICE_CATEGORY, controls how icons/descriptions are shown at front-end
@@ -258,6 +285,12 @@ class HackathonNotice(HDocumentBase):
     receiver = ReferenceField(User)
     is_read = BooleanField(default=False)
 
+    meta = {
+        "indexes": [
+            # receiver is None for public notices, the hackathon filter is applied on the sorted index scan. id breaks
+            # ties of update_time in cursor pagination
+            ("receiver", "-update_time", "-id")]}
+
     def __init__(self, **kwargs):
         super(HackathonNotice, self).__init__(**kwargs)
 
@@ -302,6 +335,11 @@ class Team(HDocumentBase):
     azure_keys = ListField(ReferenceField(AzureKey))
     templates = ListField(ReferenceField(Template))  # templates for team
 
+    meta = {
+        "indexes": [
+            ("hackathon", "name"),
+            ("members.user", "hackathon")]}
+
     def __init__(self, **kwargs):
         super(Team, self).__init__(**kwargs)
 
@@ -313,17 +351,63 @@ class DockerHostServer(HDocumentBase):
     public_docker_api_port = IntField(min_value=1, max_value=65535, default=4243)
     private_ip = StringField()
     private_docker_api_port = IntField(min_value=1, max_value=65535, default=4243)
-    container_count = IntField(required=True, min_value=0, default=0)
+    container_count = IntField(required=True, min_value=0, default=0)  # containers running or reserved
     container_max_count = IntField(required=True, min_value=0)
+    # container_max_count - container_count, stored so that it can be indexed. Changed only by atomic updates together
+    # with container_count, see DockerHostManager
+    free_slots = IntField(default=0)
     is_auto = BooleanField(default=False)  # 0-started manually 1-started by OHP server
     state = IntField(default=0)  # 0-VM starting, 1-docker init, 2-docker API ready, 3-unavailable
     disabled = BooleanField(default=False)  # T-disabled by manager, F-available
     hackathon = ReferenceField(Hackathon)
 
+    meta = {
+        "indexes": [
+            # for placement policies, see DockerHostManager.get_available_docker_host
+            ("hackathon", "state", "free_slots"),
+            ("hackathon", "state", "container_count")]}
+
     def __init__(self, **kwargs):
         super(DockerHostServer, self).__init__(**kwargs)
 
 
+class HostPortAllocation(HDocumentBase):
+    """Host ports reserved on a docker host, see DockerHostManager.reserve_host_ports"""
+    host = ReferenceField(DockerHostServer, required=True)
+    # one bit per port from HOST_PORT_BASE, set if reserved
+    bitmap = BinaryField()
+    # increased by every change so that concurrent reservations won't overwrite each other
+    version = IntField(default=0)
+
+    meta = {
+        "indexes": [
+            {"fields": ["host"], "unique": True}]}
+
+    def __init__(self, **kwargs):
+        super(HostPortAllocation, self).__init__(**kwargs)
+
+
+class HostImage(HDocumentBase):
+    """A docker image on a docker host, see ImagePuller"""
+    host = ReferenceField(DockerHostServer, required=True)
+    image = StringField(required=True)  # name:tag
+    status = IntField()  # DockerImageStatus in constants.py
+    # progress of pulling: layers, layers_done, current and total bytes of the layers being downloaded
+    progress = DictField()
+    error = StringField()
+    owner = StringField()  # host:pid of the process pulling the image
+    lease_until = DateTimeField()
+    failures = IntField(default=0)  # consecutive failed pulls
+    retry_after = DateTimeField()  # a failed image isn't pulled again before it
+
+    meta = {
+        "indexes": [
+            {"fields": ["host", "image"], "unique": True}]}
+
+    def __init__(self, **kwargs):
+        super(HostImage, self).__init__(**kwargs)
+
+
 class PortBinding(DynamicEmbeddedDocument):
     # for simplicity, the port won't be released until the corresponding container removed(not stopped).
     # that means a port occupied by stopped container won't be allocated to new container. So it's possible to start the
@@ -422,6 +506,60 @@ class Experiment(HDocumentBase):
     azure_key = ReferenceField(AzureKey)
     hackathon = ReferenceField(Hackathon)
     virtual_environments = EmbeddedDocumentListField(VirtualEnvironment, default=[])
+    # when to recycle the experiment, set once a user gets it and extended by heart beats. None if never recycled
+    expires_at = DateTimeField()
+
+    meta = {
+        "indexes": [
+            ("hackathon", "status", "create_time"),
+            # experiments of hackathon in cursor pagination
+            ("hackathon", "-id"),
+            ("status", "expires_at"),
+            # user is None for pre-allocated experiments
+            ("user", "hackathon", "status"),
+            ("template", "status", "user"),
+            "status",
+            "virtual_environments.name"]}
 
     def __init__(self, **kwargs):
         super(Experiment, self).__init__(**kwargs)
+
+
+class ProvisioningCheckpoint(HDocumentBase):
+    """The latest step of an in-flight provisioning chain, see ProvisioningEngine"""
+    step_id = StringField(required=True)
+    # changes every time a new step starts with the same step_id
+    token = StringField()
+    feature = StringField()
+    method = StringField()
+    timeout_method = StringField()
+    context = BinaryField()  # Context encoded by context_codec
+    timeout_seconds = IntField()
+    interval_seconds = FloatField()
+    max_interval_seconds = FloatField()
+    owner = StringField()  # host:pid of the process running the step
+    lease_until = DateTimeField()
+
+    meta = {
+        "indexes": [
+            {"fields": ["step_id"], "unique": True},
+            "lease_until"]}
+
+    def __init__(self, **kwargs):
+        super(ProvisioningCheckpoint, self).__init__(**kwargs)
+
+
+class JobLease(HDocumentBase):
+    """Lease of a scheduled job, makes sure a job is executed by only one server process of the cluster at a time"""
+    job_id = StringField(required=True)
+    owner = StringField()  # host:pid of the process executing the job
+    lease_until = DateTimeField()
+
+    meta = {
+        "indexes": [
+            {"fields": ["job_id"], "unique": True},
+            # leases of removed jobs are purged by mongodb one day after they expire
+            {"fields": ["lease_until"], "expireAfterSeconds": 24 * 3600, "cls": False}]}
+
+    def __init__(self, **kwargs):
+        super(JobLease, self).__init__(**kwargs)
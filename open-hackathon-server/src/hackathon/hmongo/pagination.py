@@ -6,12 +6,19 @@ provided similar interfaces with SQL-Alchemy's Pagination
 """
 import math
 import sys
+import json
+import base64
+from datetime import datetime
 
+from bson import ObjectId
 from flask import abort
 
+from mongoengine import Q
 from mongoengine.queryset import QuerySet
 
-__all__ = ("Pagination")
+__all__ = ("Pagination", "CursorPagination")
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
 
 
 class Pagination(object):
@@ -35,7 +42,8 @@ class Pagination(object):
 
         self.items = iterable[start_index:end_index]
         if isinstance(self.items, QuerySet):
-            self.items = self.items.select_related()
+            # raw documents of as_pymongo() have no reference to be dereferenced
+            self.items = list(self.items) if self.items._as_pymongo else self.items.select_related()
         if not self.items and page != 1:
             abort(404)
 
@@ -119,3 +127,109 @@ class Pagination(object):
                 last = num
         if last != self.pages:
             yield None
+
+
+class CursorPagination(object):
+    """Keyset pagination of a QuerySet, constant cost no matter how deep the page is
+
+    Items are ordered by a key plus id to break ties, a page is the first `per_page` items after the last item of the
+    previous page. Nothing is skipped or counted unless the total is asked for. The position is handed to client as an
+    opaque token in `next_cursor`, None if there are no more items.
+
+    The key should be covered by an index together with the filters, otherwise mongodb sorts in memory. Raw documents
+    of as_pymongo() are supported, the key must be in their fields.
+
+    :Example:
+        pagination = Hackathon.objects(status=1).paginate_by_cursor(cursor, 20, "-create_time")
+        pagination.items, pagination.next_cursor
+    """
+
+    def __init__(self, queryset, cursor, per_page, order_by="id", with_total=False):
+        if per_page < 1:
+            abort(404)
+
+        self.cursor = cursor
+        self.per_page = per_page
+        self.order_by = order_by
+
+        field = order_by.lstrip("+-")
+        descending = order_by.startswith("-")
+        if field == "pk":
+            field = "id"
+
+        # count before the position is applied, it's the total of all pages
+        self.total = queryset.count() if with_total else None
+
+        if field == "id":
+            queryset = queryset.order_by(order_by)
+        else:
+            queryset = queryset.order_by(order_by, "-id" if descending else "+id")
+        if cursor:
+            value, last_id = decode_cursor(cursor)
+            queryset = queryset.filter(_after(field, descending, value, last_id))
+
+        # one more to tell whether there is a next page
+        raw = queryset._as_pymongo
+        queryset = queryset.limit(per_page + 1)
+        items = list(queryset) if raw else list(queryset.select_related())
+        self.has_next = len(items) > per_page
+        self.items = items[:per_page]
+
+        self.next_cursor = None
+        if self.has_next:
+            last = self.items[-1]
+            if raw:
+                db_field = queryset._document._fields[field].db_field
+                self.next_cursor = encode_cursor(None if field == "id" else last.get(db_field), last["_id"])
+            else:
+                self.next_cursor = encode_cursor(None if field == "id" else getattr(last, field), last.id)
+
+
+def _after(field, descending, value, last_id):
+    """Return the condition of items after (value, last_id) in the order of (field, id)"""
+    compare = "lt" if descending else "gt"
+    after_id = Q(**{"id__" + compare: last_id})
+    if field == "id":
+        return after_id
+
+    tie = Q(**{field: value}) & after_id
+    # null is the smallest value in sort, it comes last in descending order and first in ascending order
+    if value is None:
+        return tie if descending else tie | Q(**{field + "__ne": None})
+
+    after = Q(**{field + "__" + compare: value}) | tie
+    return after | Q(**{field: None}) if descending else after
+
+
+def encode_cursor(value, last_id):
+    """Encode the position after an item into an url-safe token
+
+    :param value: value of the ordering key of the item, should be None if ordered by id
+
+    :type last_id: ObjectId
+    :param last_id: id of the item
+
+    :rtype: str
+    """
+    if isinstance(value, datetime):
+        value = {"$date": value.strftime(DATE_FORMAT)}
+    elif isinstance(value, ObjectId):
+        value = {"$oid": str(value)}
+    return base64.urlsafe_b64encode(json.dumps([value, str(last_id)], separators=(",", ":")))
+
+
+def decode_cursor(cursor):
+    """Decode the token returned by encode_cursor, respond 400 if it's malformed
+
+    :rtype: tuple
+    :return (value, last_id)
+    """
+    try:
+        value, last_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if isinstance(value, dict) and "$date" in value:
+            value = datetime.strptime(value["$date"], DATE_FORMAT)
+        elif isinstance(value, dict) and "$oid" in value:
+            value = ObjectId(value["$oid"])
+        return value, ObjectId(last_id)
+    except Exception:
+        abort(400)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+import copy
+
+from hackathon.util import make_raw_serializable
+
+__all__ = ["Projection"]
+
+
+class Projection(object):
+    """Fields of a document returned by a read-only endpoint, to serialize raw documents without building models
+
+    Compile one per endpoint at module level. apply() turns a query into one returning raw dicts of the fields only,
+    dic() serializes a raw dict to what HDocumentBase.dic() returns: declared fields missing in DB are filled with
+    their defaults, '_id' is renamed to 'id'.
+
+    :Example:
+        NOTICE_LIST = Projection(HackathonNotice, exclude=["related_id"])
+
+        [NOTICE_LIST.dic(n) for n in NOTICE_LIST.apply(HackathonNotice.objects(receiver=None))]
+    """
+
+    def __init__(self, document, only=None, exclude=None):
+        self.only = ["id"] + [f for f in only if f != "id"] if only else None
+        self.exclude = list(exclude or [])
+
+        # db field -> function returns the default value
+        self.defaults = {}
+        for name, field in document._fields.iteritems():
+            if (self.only and name not in self.only) or name in self.exclude or field.default is None:
+                continue
+            self.defaults[field.db_field] = _default_factory(field.default)
+
+    def apply(self, queryset):
+        """Return the query of raw documents with the fields only
+
+        :type queryset: QuerySet
+        :rtype: QuerySet
+        """
+        if self.only:
+            queryset = queryset.only(*self.only)
+        elif self.exclude:
+            queryset = queryset.exclude(*self.exclude)
+        return queryset.as_pymongo()
+
+    def dic(self, raw):
+        """Serialize a raw document returned by the query of apply(), the raw document is modified
+
+        :type raw: dict
+        :rtype: dict
+        """
+        for db_field, default in self.defaults.iteritems():
+            if db_field not in raw:
+                raw[db_field] = default()
+
+        raw.pop("_cls", None)
+        if "_id" in raw:
+            raw["id"] = raw.pop("_id")
+        return make_raw_serializable(raw)
+
+
+def _default_factory(default):
+    if callable(default):
+        return default
+    if isinstance(default, (dict, list)):
+        return lambda: copy.deepcopy(default)
+    return lambda: default
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+import os
+import time
+import heapq
+import socket
+import uuid
+from datetime import timedelta
+from itertools import count
+from threading import Thread, Condition, Lock
+
+from concurrent.futures import ThreadPoolExecutor
+
+from hackathon.hackathon_factory import RequiredFeature
+from hackathon.hmongo.models import ProvisioningCheckpoint
+from hackathon.util import safe_get_config, get_now
+from hackathon.log import log
+from hackathon.context_codec import encode_context, decode_context
+
+__all__ = ["ProvisioningEngine", "CONTINUE"]
+
+# returned by a step to be polled again later. Any other return value finishes the step
+CONTINUE = "continue"
+
+# multiplier of the poll interval after each attempt that returns CONTINUE
+BACKOFF = 1.5
+
+
+class ProvisioningStep(object):
+    """A step in flight: call 'feature.method(context)' until it returns anything but CONTINUE or 'deadline' reached
+
+    The step fails, like a timeout, if the method raises 'provisioning.max_step_errors' times in a row
+    """
+
+    def __init__(self, step_id, token, feature, method, context, timeout_method, timeout_seconds, interval_seconds,
+                 max_interval_seconds):
+        self.step_id = step_id
+        self.token = token
+        self.feature = feature
+        self.method = method
+        self.context = context
+        self.timeout_method = timeout_method
+        self.timeout_seconds = timeout_seconds
+        self.interval_seconds = interval_seconds
+        self.max_interval_seconds = max_interval_seconds
+        self.deadline = time.time() + timeout_seconds
+        # consecutive exceptions raised by method
+        self.errors = 0
+
+
+class ProvisioningEngine(object):
+    """Run the steps of experiment provisioning in a worker pool of current process
+
+    Starting an experiment is a chain of steps, most of them wait for remote operations: a free docker host, azure
+    network config, VM status... Every attempt used to be a new APScheduler job with the whole context serialized into
+    job store. Here a step stays in memory and is polled with growing interval until it's done or times out. Only state
+    transitions, that is starting a new step, are checkpointed to MongoDB.
+
+    Steps are identified by 'step_id', usually one per experiment or virtual environment: a step that starts the next
+    step with the same id replaces itself, so one provisioning chain has at most one checkpoint.
+
+    A checkpoint is leased to its process until the step's deadline. Steps of a dead process are picked up by
+    'resume_orphans' of another process once the lease expired.
+
+    :Example:
+        engine = RequiredFeature("provisioning_engine")
+
+        # azure_docker.query_vm_status(context) is called every 3~10 seconds until it returns anything but CONTINUE.
+        # azure_docker._on_virtual_environment_failed(context) is called if it's still going on after 200 seconds
+        engine.start_step("%s-%s" % (experiment_id, ve_name), "azure_docker", "query_vm_status", context,
+                          timeout_method="_on_virtual_environment_failed", timeout_seconds=200,
+                          interval_seconds=3, max_interval_seconds=10)
+    """
+
+    def __init__(self):
+        # step id -> the latest ProvisioningStep
+        self.__steps = {}
+        # heap of (due time, sequence, step)
+        self.__queue = []
+        self.__sequence = count()
+        self.__condition = Condition(Lock())
+
+        self.__pid = None
+        self.__origin = None
+        self.__executor = None
+
+    def start_step(self, step_id, feature, method, context, timeout_method=None, timeout_seconds=600,
+                   interval_seconds=3, max_interval_seconds=30, delay_seconds=0):
+        """Start a step, replace the in-flight one with the same id
+
+        :type step_id: str|unicode
+        :param step_id: id of the provisioning chain
+
+        :type feature: str|unicode
+        :param feature: the instance key for hackathon_factory
+
+        :type method: str|unicode
+        :param method: name of the method to call. It returns CONTINUE to be polled again
+
+        :type context: Context
+        :param context: the only argument of method, must be serializable
+
+        :type timeout_method: str|unicode
+        :param timeout_method: name of the method called with context when the step times out or keeps raising
+
+        :type timeout_seconds: int
+        :param timeout_seconds: seconds before the step times out
+
+        :type interval_seconds: int
+        :param interval_seconds: seconds before the first poll. It grows after every poll up to max_interval_seconds
+
+        :type delay_seconds: int
+        :param delay_seconds: seconds before the first call
+        """
+        self.ensure_running()
+        step = ProvisioningStep(step_id, uuid.uuid4().hex, feature, method, context, timeout_method,
+                                timeout_seconds, interval_seconds, max_interval_seconds)
+        self.__checkpoint(step)
+        self.__schedule(step, delay_seconds)
+
+    def resume_orphans(self):
+        """Take over the checkpointed steps whose lease expired, for example because their process died
+
+        :rtype: int
+        :return the count of steps resumed
+        """
+        self.ensure_running()
+        resumed = 0
+        while True:
+            now = get_now()
+            checkpoint = ProvisioningCheckpoint.objects(lease_until__lt=now).modify(
+                new=True,
+                set__owner=self.__origin,
+                set__lease_until=now + timedelta(seconds=safe_get_config("provisioning.lease_grace_seconds", 60)),
+                set__update_time=now)
+            if checkpoint is None:
+                return resumed
+
+            try:
+                step = ProvisioningStep(checkpoint.step_id, checkpoint.token, checkpoint.feature, checkpoint.method,
+                                        decode_context(checkpoint.context), checkpoint.timeout_method,
+                                        checkpoint.timeout_seconds, checkpoint.interval_seconds,
+                                        checkpoint.max_interval_seconds)
+            except Exception as e:
+                log.error(e)
+                checkpoint.delete()
+                continue
+
+            # lease it until the new deadline
+            self.__checkpoint(step)
+            log.debug("resume provisioning step %s.%s of %s" % (step.feature, step.method, step.step_id))
+            self.__schedule(step, 0)
+            resumed += 1
+
+    def in_flight(self):
+        """Return the count of steps in flight in current process"""
+        return len(self.__steps)
+
+    def ensure_running(self):
+        """Start the dispatcher thread and worker pool if they're not started in current process"""
+        if self.__pid == os.getpid():
+            return
+
+        with self.__condition:
+            if self.__pid == os.getpid():
+                return
+
+            # steps inherited from parent process are owned by the parent
+            self.__steps = {}
+            self.__queue = []
+            self.__pid = os.getpid()
+            self.__origin = "%s:%d" % (socket.gethostname(), self.__pid)
+            self.__executor = ThreadPoolExecutor(max_workers=safe_get_config("provisioning.max_workers", 8))
+            t = Thread(target=self.__dispatch, name="provisioning-engine")
+            t.setDaemon(True)
+            t.start()
+
+    def __schedule(self, step, delay_seconds):
+        with self.__condition:
+            self.__steps[step.step_id] = step
+            heapq.heappush(self.__queue, (time.time() + delay_seconds, next(self.__sequence), step))
+            self.__condition.notify()
+
+    def __is_current(self, step):
+        return self.__steps.get(step.step_id) is step
+
+    def __dispatch(self):
+        """Hand the steps to worker pool when they're due"""
+        while True:
+            with self.__condition:
+                while not self.__queue or self.__queue[0][0] > time.time():
+                    self.__condition.wait(self.__queue[0][0] - time.time() if self.__queue else None)
+                due, seq, step = heapq.heappop(self.__queue)
+
+            if self.__is_current(step):
+                self.__executor.submit(self.__run, step)
+
+    def __run(self, step):
+        try:
+            result = self.__call(step.feature, step.method, step.context)
+            step.errors = 0
+        except Exception as e:
+            log.error(e)
+            # retried as CONTINUE in case the error is transient, e.g. a network glitch
+            step.errors += 1
+            result = CONTINUE
+
+        if not self.__is_current(step):
+            # replaced by a newer step with the same id
+            return
+
+        if result != CONTINUE:
+            self.__finish(step)
+        elif step.errors >= safe_get_config("provisioning.max_step_errors", 3):
+            log.warn("provisioning step %s.%s of %s failed %d times" % (step.feature, step.method, step.step_id,
+                                                                       step.errors))
+            self.__fail(step)
+        elif time.time() >= step.deadline:
+            log.warn("provisioning step %s.%s of %s timed out" % (step.feature, step.method, step.step_id))
+            self.__fail(step)
+        else:
+            step.interval_seconds = min(step.interval_seconds * BACKOFF, step.max_interval_seconds)
+            self.__schedule(step, step.interval_seconds)
+
+    def __fail(self, step):
+        """Finish the step and call its timeout_method, which rolls back what the provisioning chain has done"""
+        self.__finish(step)
+        if step.timeout_method:
+            try:
+                self.__call(step.feature, step.timeout_method, step.context)
+            except Exception as e:
+                log.error(e)
+
+    def __finish(self, step):
+        with self.__condition:
+            if self.__is_current(step):
+                self.__steps.pop(step.step_id)
+
+        try:
+            # the checkpoint is overwritten if a newer step with the same id started
+            ProvisioningCheckpoint.objects(step_id=step.step_id, token=step.token).delete()
+        except Exception as e:
+            log.error(e)
+
+    def __checkpoint(self, step):
+        try:
+            lease_seconds = step.timeout_seconds + safe_get_config("provisioning.lease_grace_seconds", 60)
+            now = get_now()
+            ProvisioningCheckpoint.objects(step_id=step.step_id).update_one(
+                upsert=True,
+                set__token=step.token,
+                set__feature=step.feature,
+                set__method=step.method,
+                set__context=encode_context(step.context),
+                set__timeout_method=step.timeout_method,
+                set__timeout_seconds=step.timeout_seconds,
+                set__interval_seconds=step.interval_seconds,
+                set__max_interval_seconds=step.max_interval_seconds,
+                set__owner=self.__origin,
+                set__lease_until=now + timedelta(seconds=lease_seconds),
+                set__update_time=now)
+        except Exception as e:
+            # the step still runs in memory, it cannot be resumed by other process if current one dies
+            log.error(e)
+
+    def __call(self, feature, method, context):
+        return getattr(RequiredFeature(feature), method)(context)
@@ -32,97 +32,136 @@ from hackathon.constants import VE_PROVIDER
 
 __all__ = ["DockerTemplateUnit"]
 
+# every unit is merged from the defaults, never modify it
+DEFAULT_CONFIG = {
+    DOCKER_UNIT.NAME: 'docker',
+    DOCKER_UNIT.TYPE: 'ubuntu terminal',
+    DOCKER_UNIT.DESCRIPTION: '',
+    DOCKER_UNIT.PORTS: [
+        {
+            DOCKER_UNIT.PORTS_NAME: 'Deploy',
+            DOCKER_UNIT.PORTS_PORT: 22,
+            DOCKER_UNIT.PORTS_PUBLIC: True,
+            DOCKER_UNIT.PORTS_PROTOCOL: 'tcp',
+        }
+    ],
+    DOCKER_UNIT.REMOTE: {
+        DOCKER_UNIT.REMOTE_PROVIDER: 'guacamole',
+        DOCKER_UNIT.REMOTE_PROTOCOL: 'ssh',
+        DOCKER_UNIT.REMOTE_USERNAME: 'root',
+        DOCKER_UNIT.REMOTE_PASSWORD: 'root',
+        DOCKER_UNIT.REMOTE_PORT: 22,
+    },
+    DOCKER_UNIT.HOSTNAME: '',
+    DOCKER_UNIT.DOMAIN_NAME: '',
+    DOCKER_UNIT.USER: '',
+    DOCKER_UNIT.ATTACH_STDIN: False,
+    DOCKER_UNIT.ATTACH_STDOUT: True,
+    DOCKER_UNIT.ATTACH_STDERR: True,
+    DOCKER_UNIT.TTY: True,
+    DOCKER_UNIT.OPEN_STDIN: True,
+    DOCKER_UNIT.STDIN_ONCE: True,
+    DOCKER_UNIT.ENV: [],
+    DOCKER_UNIT.CMD: [],
+    DOCKER_UNIT.ENTRY_POINT: '',
+    DOCKER_UNIT.IMAGE: '',
+    DOCKER_UNIT.LABELS: {},
+    DOCKER_UNIT.VOLUMES: {},
+    DOCKER_UNIT.WORKING_DIR: '',
+    DOCKER_UNIT.NETWORK_DISABLED: False,
+    DOCKER_UNIT.EXPOSED_PORTS: {},
+    DOCKER_UNIT.MAC_ADDRESS: '',
+    DOCKER_UNIT.SECURITY_OPTS: [''],
+    DOCKER_UNIT.HOST_CONFIG: {
+        DOCKER_UNIT.HOST_CONFIG_BINDS: [],
+        DOCKER_UNIT.HOST_CONFIG_LINKS: [],
+        DOCKER_UNIT.HOST_CONFIG_LXC_CONF: {},
+        DOCKER_UNIT.HOST_CONFIG_MEMORY: 0,
+        DOCKER_UNIT.HOST_CONFIG_MEMORY_SWAP: 0,
+        DOCKER_UNIT.HOST_CONFIG_CPU_SHARES: 0,
+        DOCKER_UNIT.HOST_CONFIG_CPUSET_CPUS: '',
+        DOCKER_UNIT.HOST_CONFIG_PORT_BINDING: {},
+        DOCKER_UNIT.HOST_CONFIG_PUBLISH_ALL_PORTS: False,
+        DOCKER_UNIT.HOST_CONFIG_PRIVILEGED: False,
+        DOCKER_UNIT.HOST_CONFIG_READONLY_ROOTFS: False,
+        DOCKER_UNIT.HOST_CONFIG_DNS: [],
+        DOCKER_UNIT.HOST_CONFIG_DNS_SEARCH: [],
+        DOCKER_UNIT.HOST_CONFIG_EXTRA_HOSTS: [],
+        DOCKER_UNIT.HOST_CONFIG_VOLUMES_FROM: [],
+        DOCKER_UNIT.HOST_CONFIG_CAP_ADD: [],
+        DOCKER_UNIT.HOST_CONFIG_CAP_DROP: [],
+        DOCKER_UNIT.HOST_CONFIG_RESTART_POLICY: {
+            DOCKER_UNIT.HOST_CONFIG_RESTART_POLICY_NAME: '',
+            DOCKER_UNIT.HOST_CONFIG_RESTART_POLICY_MAXIMUM_RETRY_COUNT: 0,
+        },
+        DOCKER_UNIT.HOST_CONFIG_NETWORK_MODE: '',
+        DOCKER_UNIT.HOST_CONFIG_DEVICES: [],
+        DOCKER_UNIT.HOST_CONFIG_ULIMITS: [],
+        DOCKER_UNIT.HOST_CONFIG_LOG_CONFIG: {
+            DOCKER_UNIT.HOST_CONFIG_LOG_CONFIG_TYPE: 'json-file',
+            DOCKER_UNIT.HOST_CONFIG_LOG_CONFIG_CONFIG: {},
+        },
+        DOCKER_UNIT.HOST_CONFIG_CGROUP_PARENT: '',
+    },
+}
+
+# keys of the unit that are not arguments of docker remote api
+UNIT_ONLY_KEYS = [DOCKER_UNIT.NAME, DOCKER_UNIT.TYPE, DOCKER_UNIT.PROVIDER, DOCKER_UNIT.DESCRIPTION, DOCKER_UNIT.PORTS,
+                  DOCKER_UNIT.REMOTE]
+
 
 class DockerTemplateUnit(TemplateUnit):
     """
     Smallest unit in docker template
+
+    A unit is compiled once per template version and shared by all experiments(and threads) that use the template, so
+    it must never be modified. Per-experiment data like the container name and assigned ports are set on a cheap
+    overlay that shares everything else with the unit, see overlay().
     """
+    __slots__ = ("dic", "name", "ports", "image_with_tag", "container_config")
 
-    def __init__(self, dic):
-        super(DockerTemplateUnit, self).__init__(VE_PROVIDER.DOCKER)
+    def __init__(self, dic, provider=VE_PROVIDER.DOCKER):
+        super(DockerTemplateUnit, self).__init__(provider)
         self.dic = self.load_default_config()
-        for key, value in dic.iteritems():
-            self.dic[key] = value
+        self.dic.update(dic)
+        self.name = self.dic[DOCKER_UNIT.NAME]
+        self.ports = self.dic[DOCKER_UNIT.PORTS]
+
+        image = self.dic[DOCKER_UNIT.IMAGE]
+        self.image_with_tag = image if len(image.split(':')) == 2 else image + ':latest'
+
+        config = dict((k, v) for k, v in self.dic.iteritems() if k not in UNIT_ONLY_KEYS)
+        if not config[DOCKER_UNIT.CMD]:
+            config.pop(DOCKER_UNIT.CMD, [])
+        if not config[DOCKER_UNIT.ENTRY_POINT]:
+            config.pop(DOCKER_UNIT.ENTRY_POINT, "")
+        self.container_config = config
 
     def load_default_config(self):
-        dic = {
-            DOCKER_UNIT.NAME: 'docker',
-            DOCKER_UNIT.TYPE: 'ubuntu terminal',
-            DOCKER_UNIT.DESCRIPTION: '',
-            DOCKER_UNIT.PORTS: [
-                {
-                    DOCKER_UNIT.PORTS_NAME: 'Deploy',
-                    DOCKER_UNIT.PORTS_PORT: 22,
-                    DOCKER_UNIT.PORTS_PUBLIC: True,
-                    DOCKER_UNIT.PORTS_PROTOCOL: 'tcp',
-                }
-            ],
-            DOCKER_UNIT.REMOTE: {
-                DOCKER_UNIT.REMOTE_PROVIDER: 'guacamole',
-                DOCKER_UNIT.REMOTE_PROTOCOL: 'ssh',
-                DOCKER_UNIT.REMOTE_USERNAME: 'root',
-                DOCKER_UNIT.REMOTE_PASSWORD: 'root',
-                DOCKER_UNIT.REMOTE_PORT: 22,
-            },
-            DOCKER_UNIT.HOSTNAME: '',
-            DOCKER_UNIT.DOMAIN_NAME: '',
-            DOCKER_UNIT.USER: '',
-            DOCKER_UNIT.ATTACH_STDIN: False,
-            DOCKER_UNIT.ATTACH_STDOUT: True,
-            DOCKER_UNIT.ATTACH_STDERR: True,
-            DOCKER_UNIT.TTY: True,
-            DOCKER_UNIT.OPEN_STDIN: True,
-            DOCKER_UNIT.STDIN_ONCE: True,
-            DOCKER_UNIT.ENV: [],
-            DOCKER_UNIT.CMD: [],
-            DOCKER_UNIT.ENTRY_POINT: '',
-            DOCKER_UNIT.IMAGE: '',
-            DOCKER_UNIT.LABELS: {},
-            DOCKER_UNIT.VOLUMES: {},
-            DOCKER_UNIT.WORKING_DIR: '',
-            DOCKER_UNIT.NETWORK_DISABLED: False,
-            DOCKER_UNIT.EXPOSED_PORTS: {},
-            DOCKER_UNIT.MAC_ADDRESS: '',
-            DOCKER_UNIT.SECURITY_OPTS: [''],
-            DOCKER_UNIT.HOST_CONFIG: {
-                DOCKER_UNIT.HOST_CONFIG_BINDS: [],
-                DOCKER_UNIT.HOST_CONFIG_LINKS: [],
-                DOCKER_UNIT.HOST_CONFIG_LXC_CONF: {},
-                DOCKER_UNIT.HOST_CONFIG_MEMORY: 0,
-                DOCKER_UNIT.HOST_CONFIG_MEMORY_SWAP: 0,
-                DOCKER_UNIT.HOST_CONFIG_CPU_SHARES: 0,
-                DOCKER_UNIT.HOST_CONFIG_CPUSET_CPUS: '',
-                DOCKER_UNIT.HOST_CONFIG_PORT_BINDING: {},
-                DOCKER_UNIT.HOST_CONFIG_PUBLISH_ALL_PORTS: False,
-                DOCKER_UNIT.HOST_CONFIG_PRIVILEGED: False,
-                DOCKER_UNIT.HOST_CONFIG_READONLY_ROOTFS: False,
-                DOCKER_UNIT.HOST_CONFIG_DNS: [],
-                DOCKER_UNIT.HOST_CONFIG_DNS_SEARCH: [],
-                DOCKER_UNIT.HOST_CONFIG_EXTRA_HOSTS: [],
-                DOCKER_UNIT.HOST_CONFIG_VOLUMES_FROM: [],
-                DOCKER_UNIT.HOST_CONFIG_CAP_ADD: [],
-                DOCKER_UNIT.HOST_CONFIG_CAP_DROP: [],
-                DOCKER_UNIT.HOST_CONFIG_RESTART_POLICY: {
-                    DOCKER_UNIT.HOST_CONFIG_RESTART_POLICY_NAME: '',
-                    DOCKER_UNIT.HOST_CONFIG_RESTART_POLICY_MAXIMUM_RETRY_COUNT: 0,
-                },
-                DOCKER_UNIT.HOST_CONFIG_NETWORK_MODE: '',
-                DOCKER_UNIT.HOST_CONFIG_DEVICES: [],
-                DOCKER_UNIT.HOST_CONFIG_ULIMITS: [],
-                DOCKER_UNIT.HOST_CONFIG_LOG_CONFIG: {
-                    DOCKER_UNIT.HOST_CONFIG_LOG_CONFIG_TYPE: 'json-file',
-                    DOCKER_UNIT.HOST_CONFIG_LOG_CONFIG_CONFIG: {},
-                },
-                DOCKER_UNIT.HOST_CONFIG_CGROUP_PARENT: '',
-            },
-        }
-        return dic
+        return dict(DEFAULT_CONFIG)
 
-    def set_name(self, name):
-        self.dic[DOCKER_UNIT.NAME] = name
+    def overlay(self, name=None, ports=None):
+        """Return a unit that has its own container name and/or ports, and shares the rest with this unit
+
+        :type name: str|unicode
+        :param name: name of the container
+
+        :type ports: list
+        :param ports: the port config with host ports assigned
+
+        :rtype: DockerTemplateUnit
+        """
+        unit = object.__new__(self.__class__)
+        unit.provider = self.provider
+        unit.dic = self.dic
+        unit.name = self.name if name is None else name
+        unit.ports = self.ports if ports is None else ports
+        unit.image_with_tag = self.image_with_tag
+        unit.container_config = self.container_config
+        return unit
 
     def get_name(self):
-        return self.dic[DOCKER_UNIT.NAME]
+        return self.name
 
     def get_type(self):
         return self.dic[DOCKER_UNIT.TYPE]
@@ -132,40 +171,29 @@ class DockerTemplateUnit(TemplateUnit):
 
     def get_container_config(self):
         """
-        Compose post data for docker remote api create
+        Compose post data for docker remote api create, the host ports are taken from the ports of overlay
         :return:
         """
-        for p in self.dic[DOCKER_UNIT.PORTS]:
+        config = dict(self.container_config)
+        host_config = dict(config[DOCKER_UNIT.HOST_CONFIG])
+        exposed_ports = dict(config[DOCKER_UNIT.EXPOSED_PORTS])
+        port_bindings = dict(host_config[DOCKER_UNIT.HOST_CONFIG_PORT_BINDING])
+        for p in self.ports:
             key = '%d/%s' % (p[DOCKER_UNIT.PORTS_PORT], p[DOCKER_UNIT.PORTS_PROTOCOL])
-            self.dic[DOCKER_UNIT.EXPOSED_PORTS][key] = {}
-            self.dic[DOCKER_UNIT.HOST_CONFIG][DOCKER_UNIT.HOST_CONFIG_PORT_BINDING][key] = \
-                [{DOCKER_UNIT.HOST_CONFIG_HOST_IP: '',
-                  DOCKER_UNIT.HOST_CONFIG_HOST_PORT: str(p[DOCKER_UNIT.PORTS_HOST_PORT])}]
-        self.dic.pop(DOCKER_UNIT.NAME, "")
-        self.dic.pop(DOCKER_UNIT.TYPE, "")
-        self.dic.pop(DOCKER_UNIT.PROVIDER, "")
-        self.dic.pop(DOCKER_UNIT.DESCRIPTION, "")
-        self.dic.pop(DOCKER_UNIT.PORTS, None)
-        self.dic.pop(DOCKER_UNIT.REMOTE, None)
-        if not self.dic[DOCKER_UNIT.CMD]:
-            self.dic.pop(DOCKER_UNIT.CMD, [])
-        if not self.dic[DOCKER_UNIT.ENTRY_POINT]:
-            self.dic.pop(DOCKER_UNIT.ENTRY_POINT, "")
-        return self.dic
+            exposed_ports[key] = {}
+            port_bindings[key] = [{DOCKER_UNIT.HOST_CONFIG_HOST_IP: '',
+                                   DOCKER_UNIT.HOST_CONFIG_HOST_PORT: str(p[DOCKER_UNIT.PORTS_HOST_PORT])}]
 
-    def get_image_with_tag(self):
-        image = self.dic[DOCKER_UNIT.IMAGE]
-        data = image.split(':')
-        if len(data) == 2:
-            return image
-        else:
-            return image + ':latest'
+        host_config[DOCKER_UNIT.HOST_CONFIG_PORT_BINDING] = port_bindings
+        config[DOCKER_UNIT.HOST_CONFIG] = host_config
+        config[DOCKER_UNIT.EXPOSED_PORTS] = exposed_ports
+        return config
 
-    def set_ports(self, port_cfg):
-        self.dic[DOCKER_UNIT.PORTS] = port_cfg
+    def get_image_with_tag(self):
+        return self.image_with_tag
 
     def get_ports(self):
-        return self.dic[DOCKER_UNIT.PORTS]
+        return self.ports
 
     def get_remote(self):
         return self.dic[DOCKER_UNIT.REMOTE]
@@ -206,5 +234,5 @@ class DockerTemplateUnit(TemplateUnit):
                 "endpoint_type": "tcp-endpoint"
             })
 
-        map(lambda p: convert(p), self.dic[DOCKER_UNIT.PORTS])
+        map(lambda p: convert(p), self.ports)
         return instance_ports
@@ -36,16 +36,18 @@ from huawei_template_unit import HuaweiTemplateUnit
 __all__ = ["TemplateContent"]
 
 
-class TemplateContent:
+class TemplateContent(object):
     """The content of a template in dict format
 
-    It's the only type that for template saving and loading.
+    It's the only type that for template saving and loading. A loaded TemplateContent is shared by all experiments of
+    the same template version, don't modify it or its units.
     """
+    __slots__ = ("name", "description", "units")
 
     def __init__(self, name, description, units):
         self.name = name
         self.description = description
-        self.units = units
+        self.units = tuple(units)
 
     @staticmethod
     def from_dict(args):
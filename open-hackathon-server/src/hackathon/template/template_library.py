@@ -27,22 +27,31 @@ import sys
 from werkzeug.exceptions import BadRequest, InternalServerError, Forbidden
 
 sys.path.append("..")
-from os.path import isfile
 import json
-import requests
+from collections import OrderedDict
+from threading import Lock
 
 from flask import g, request
 from mongoengine import Q
 
 from hackathon import Component, RequiredFeature, Context
 from hackathon.hmongo.models import Template, Experiment
+from hackathon.hmongo.projection import Projection
 from hackathon.hackathon_response import ok, internal_server_error, forbidden
 from hackathon.constants import FILE_TYPE, TEMPLATE_STATUS
 from template_constants import TEMPLATE
 from template_content import TemplateContent
+from template_store import TemplateStore
 
 __all__ = ["TemplateLibrary"]
 
+# content hash -> TemplateContent. Templates are compiled once per version and shared by the whole process
+compiled_templates = OrderedDict()
+compiled_templates_lock = Lock()
+
+# fields of templates in search results
+TEMPLATE_LIST = Projection(Template)
+
 
 class TemplateLibrary(Component):
     """Component to manage templates"""
@@ -69,32 +78,61 @@ class TemplateLibrary(Component):
     def search_template(self, args):
         """Search template by status, name or description"""
         criterion = self.__generate_search_criterion(args)
-        return [t.dic() for t in Template.objects(criterion)]
+        return [TEMPLATE_LIST.dic(t) for t in TEMPLATE_LIST.apply(Template.objects(criterion))]
 
     def load_template(self, template):
-        """load template into memory either from a local cache path or an remote uri
-        load template from local file > from from azure
+        """load template into memory either from the local template store or an remote uri
+        compiled template of the same version > local store by its content hash > remote url, revalidated by
+        ETag/If-Modified-Since
+
+        The returned TemplateContent is shared, don't modify it. Use unit.overlay() for per-experiment changes
         :param template:
         :return:
         """
+        content_hash = template.content_hash
+        compiled = self.__get_compiled_template(content_hash)
+        if compiled is not None:
+            return compiled
 
-        def internal_load_template():
-            # todo local cache not valid, disabled temprary
-            # local_path = template.local_path
-            # if local_path is not None and isfile(local_path):
-            #     with open(local_path) as template_file:
-            #         return TemplateContent.from_dict(json.load(template_file))
-            # else:
-            try:
-                req = requests.get(template.url)
-                return TemplateContent.from_dict(json.loads(req.content))
-            except Exception as e:
-                self.log.warn("Fail to load template from remote file %s" % template.url)
-                self.log.error(e)
-                return None
+        try:
+            content = self.store.get(content_hash)
+            if content is None:
+                content_hash, content = self.store.fetch(template.url)
+                if content_hash != template.content_hash:
+                    Template.objects(id=template.id).update_one(set__content_hash=content_hash)
+                    template.content_hash = content_hash
+
+            compiled = TemplateContent.from_dict(content)
+            self.__put_compiled_template(content_hash, compiled)
+            return compiled
+        except Exception as e:
+            self.log.warn("Fail to load template from remote file %s" % template.url)
+            self.log.error(e)
+            return None
+
+    def load_template_by_ref(self, template_id, content_hash=None):
+        """load template by reference, used by jobs whose context carries only the id and version of template
 
-        cache_key = self.__get_template_cache_key(template.id)
-        return self.cache.get_cache(key=cache_key, createfunc=internal_load_template)
+        :type template_id: ObjectId|str|unicode
+        :param template_id: id of Template
+
+        :type content_hash: str|unicode
+        :param content_hash: the version of template that the job started with. The latest version is loaded if None
+
+        :rtype: TemplateContent
+        """
+        compiled = self.__get_compiled_template(content_hash)
+        if compiled is not None:
+            return compiled
+
+        content = self.store.get(content_hash)
+        if content is not None:
+            compiled = TemplateContent.from_dict(content)
+            self.__put_compiled_template(content_hash, compiled)
+            return compiled
+
+        template = Template.objects(id=template_id).only("url", "content_hash").first()
+        return self.load_template(template) if template else None
 
     def create_template(self, args):
         """ Create template """
@@ -150,8 +188,7 @@ class TemplateLibrary(Component):
             if Experiment.objects(template=template).count() > 0:
                 return forbidden("template already in use")
 
-            # remove template cache and storage
-            self.cache.invalidate(self.__get_template_cache_key(template_id))
+            # remove template storage
             self.storage.delete(template.url)
 
             # remove record in DB
@@ -167,7 +204,8 @@ class TemplateLibrary(Component):
         Template.objects(id=template_id).update_one(status=TEMPLATE_STATUS.CHECK_PASS)
 
     def __init__(self):
-        pass
+        self.store = TemplateStore(self.util.safe_get_config("template.store_dir", "/tmp/hackathon/templates"),
+                                   timeout=self.util.safe_get_config("template.fetch_timeout_seconds", 10))
 
     def __create_or_update_template(self, template_content):
         """Internally create template
@@ -200,6 +238,8 @@ class TemplateLibrary(Component):
 
             self.log.debug("saving template as file [%s]" % file_name)
             context = self.storage.save(context)
+            # keep a copy in local template store so that it won't be downloaded again on this server
+            context.content_hash = self.store.put(context.content)
             return context
         except Exception as ex:
             self.log.error(ex)
@@ -227,6 +267,7 @@ class TemplateLibrary(Component):
                     name=template_content.name,
                     url=context.url,
                     local_path=context.get("physical_path"),
+                    content_hash=context.content_hash,
                     provider=provider,
                     creator=g.user,
                     status=TEMPLATE_STATUS.UNCHECKED,
@@ -236,11 +277,11 @@ class TemplateLibrary(Component):
                 template.update(
                     url=context.url,
                     local_path=context.get("physical_path"),
+                    content_hash=context.content_hash,
                     update_time=self.util.get_now(),
                     provider=provider,
                     description=template_content.description,
                     virtual_environment_count=len(template_content.units))
-                self.cache.invalidate(self.__get_template_cache_key(template.id))
 
             return template.dic()
         except Exception as ex:
@@ -275,8 +316,22 @@ class TemplateLibrary(Component):
 
         return criterion
 
-    def __get_template_cache_key(self, template_id):
-        return "__template__%s__" % str(template_id)
+    def __get_compiled_template(self, content_hash):
+        if not content_hash:
+            return None
+        with compiled_templates_lock:
+            compiled = compiled_templates.pop(content_hash, None)
+            if compiled is not None:
+                # re-insert as most recently used
+                compiled_templates[content_hash] = compiled
+            return compiled
+
+    def __put_compiled_template(self, content_hash, compiled):
+        capacity = self.util.safe_get_config("template.compiled_capacity", 100)
+        with compiled_templates_lock:
+            compiled_templates[content_hash] = compiled
+            while len(compiled_templates) > capacity:
+                compiled_templates.popitem(last=False)
 
     def __load_template_content(self, args):
         """ Convert dict of template content into TemplateContent object
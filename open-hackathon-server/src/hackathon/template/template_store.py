@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+import os
+import json
+import hashlib
+import tempfile
+from os.path import join, isfile
+
+import requests
+
+from hackathon.log import log
+
+__all__ = ["TemplateStore", "hash_template"]
+
+
+def hash_template(content):
+    """Return the content hash of a template
+
+    The dict is dumped in canonical form so that the same template gets the same hash no matter where it's loaded from
+
+    :type content: dict
+    :param content: the template content
+
+    :rtype: tuple
+    :return (hash, canonical json)
+    """
+    data = json.dumps(content, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(data).hexdigest(), data
+
+
+class TemplateStore(object):
+    """Content-addressed store of templates on local disk
+
+    Templates are saved in '<base_dir>/objects/<hash>.json', once written a file never changes. The ETag and
+    Last-Modified of a remote url are kept in '<base_dir>/refs/<hash of url>.json' together with the hash of the
+    content, so that a template is downloaded again only if it's changed on remote storage. All files are written to
+    a temporary file first then renamed, server processes on the same machine share the store safely.
+    """
+
+    def __init__(self, base_dir, timeout=10):
+        self.base_dir = base_dir
+        self.timeout = timeout
+        self.objects_dir = join(base_dir, "objects")
+        self.refs_dir = join(base_dir, "refs")
+        for d in [self.objects_dir, self.refs_dir]:
+            if not os.path.exists(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    # created by another process
+                    pass
+
+    def get(self, content_hash):
+        """Load template content by hash from local disk
+
+        :rtype: dict
+        :return: the template content, None if not found
+        """
+        path = self.__object_path(content_hash)
+        if not content_hash or not isfile(path):
+            return None
+
+        with open(path) as f:
+            return json.load(f)
+
+    def put(self, content):
+        """Save template content to local disk
+
+        :type content: dict
+        :param content: the template content
+
+        :rtype: str
+        :return: hash of the content
+        """
+        content_hash, data = hash_template(content)
+        path = self.__object_path(content_hash)
+        if not isfile(path):
+            self.__write_atomic(path, data)
+        return content_hash
+
+    def fetch(self, url):
+        """Load template from remote url, revalidating the local copy by ETag/If-Modified-Since
+
+        :type url: str|unicode
+        :param url: the url of template
+
+        :rtype: tuple
+        :return (hash, content) of the template
+        """
+        ref_path = join(self.refs_dir, "%s.json" % hashlib.sha1(url).hexdigest())
+        ref = self.__read_ref(ref_path)
+
+        headers = {}
+        if ref and isfile(self.__object_path(ref["hash"])):
+            if ref.get("etag"):
+                headers["If-None-Match"] = ref["etag"]
+            if ref.get("last_modified"):
+                headers["If-Modified-Since"] = ref["last_modified"]
+
+        resp = requests.get(url, headers=headers, timeout=self.timeout)
+        if resp.status_code == 304:
+            content = self.get(ref["hash"])
+            if content is not None:
+                return ref["hash"], content
+
+            # removed just now, fetch the full content
+            resp = requests.get(url, timeout=self.timeout)
+
+        resp.raise_for_status()
+        content = json.loads(resp.content)
+        content_hash = self.put(content)
+        self.__write_atomic(ref_path, json.dumps({
+            "hash": content_hash,
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified")
+        }))
+        return content_hash, content
+
+    def __object_path(self, content_hash):
+        return join(self.objects_dir, "%s.json" % content_hash)
+
+    def __read_ref(self, ref_path):
+        if not isfile(ref_path):
+            return None
+        try:
+            with open(ref_path) as f:
+                return json.load(f)
+        except Exception as e:
+            log.error(e)
+            return None
+
+    def __write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except Exception:
+            if isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
@@ -29,6 +29,7 @@ class TemplateUnit(object):
 
     An unit is a dict too that includes arguments for docker container or azure VM.
     Each unit represents a virtual_environment that can be started or stopped independently"""
+    __slots__ = ("provider",)
 
     def __init__(self, provider):
         """Construct an new unit
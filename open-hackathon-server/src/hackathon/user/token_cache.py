@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+import sys
+
+sys.path.append("..")
+
+from collections import OrderedDict
+from datetime import timedelta
+from threading import Lock
+
+from hackathon.util import get_now
+
+__all__ = ["TokenCache"]
+
+
+class TokenEntry(object):
+    """A cached token: id of the user it belongs to and when it expires"""
+
+    def __init__(self, user_id, expire_date, cached_time):
+        self.user_id = user_id
+        self.expire_date = expire_date
+        self.cached_time = cached_time
+
+
+class TokenCache(object):
+    """Bounded in-process cache of API tokens with write-behind of the token expire date
+
+    Every API call validates the token in http headers and then extends its expire date. Both used to hit MongoDB. With
+    this cache, a token is loaded from DB only once every 'ttl_seconds'. Extensions of the expire date are recorded in
+    memory and written back in one batch by 'flush', which is supposed to be called by a scheduled job in every process
+    since the extensions are kept in memory of the process.
+
+    Only the id of the user is cached, the user itself is loaded per request so that changes of the user take effect at
+    once. The cache is shared by all instances of UserManager in current process, entries are evicted in LRU order once
+    'capacity' reached.
+
+    :Example:
+        cache = TokenCache(capacity=10000, ttl_seconds=60)
+
+        user_id = cache.get(token)
+        if user_id is None:
+            t = UserToken.objects(token=token).no_dereference().first()
+            cache.put(token, t.user.id, t.expire_date)
+
+        cache.touch(token, new_expire_date)
+        cache.flush(lambda expire_dates: ...)
+    """
+
+    def __init__(self, capacity=10000, ttl_seconds=60):
+        self.capacity = capacity
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.__entries = OrderedDict()
+        # token -> the newest expire date that has not been written back to DB
+        self.__pending = {}
+        self.__lock = Lock()
+
+    def get(self, token):
+        """Return id of the user related to the token if the token is cached and still valid
+
+        :type token: str|unicode
+        :param token: the token from http headers
+
+        :rtype: ObjectId
+        :return id of the user of the token or None if token not cached, cache entry stale or token expired
+        """
+        now = get_now()
+        with self.__lock:
+            entry = self.__entries.pop(token, None)
+            if entry is None:
+                return None
+
+            if entry.expire_date < now or entry.cached_time + self.ttl < now:
+                return None
+
+            # re-insert to mark it as the most recently used
+            self.__entries[token] = entry
+            return entry.user_id
+
+    def put(self, token, user_id, expire_date):
+        """Add or replace a token in cache
+
+        :type token: str|unicode
+        :param token: the token
+
+        :type user_id: ObjectId
+        :param user_id: id of the user that the token belongs to
+
+        :type expire_date: datetime
+        :param expire_date: expire date of the token loaded from DB
+        """
+        with self.__lock:
+            self.__entries.pop(token, None)
+            # an extension not written back yet is newer than what we just read from DB
+            pending = self.__pending.get(token)
+            if pending and pending > expire_date:
+                expire_date = pending
+
+            self.__entries[token] = TokenEntry(user_id, expire_date, get_now())
+            while len(self.__entries) > self.capacity:
+                self.__entries.popitem(last=False)
+
+    def touch(self, token, expire_date):
+        """Extend the expire date of a token. The change will be written back to DB upon next 'flush'
+
+        :type token: str|unicode
+        :param token: the token to be extended
+
+        :type expire_date: datetime
+        :param expire_date: the new expire date
+        """
+        with self.__lock:
+            entry = self.__entries.get(token)
+            if entry:
+                entry.expire_date = expire_date
+            self.__pending[token] = expire_date
+
+    def invalidate(self, token):
+        """Remove a token from cache as well as its pending extension, for example when user logout"""
+        with self.__lock:
+            self.__entries.pop(token, None)
+            self.__pending.pop(token, None)
+
+    def invalidate_user(self, user_id):
+        """Remove all tokens of specific user from cache"""
+        with self.__lock:
+            tokens = [t for t, e in self.__entries.iteritems() if str(e.user_id) == str(user_id)]
+            for t in tokens:
+                self.__entries.pop(t, None)
+                self.__pending.pop(t, None)
+
+    def flush(self, writer):
+        """Write back all pending expire date extensions
+
+        Extensions are coalesced per token: a token touched many times since last flush is written once, with its
+        latest expire date.
+
+        :type writer: function
+        :param writer: function(expire_dates) that persists the new expire dates in one batch, expire_dates is a dict
+            of token -> expire date
+
+        :rtype: int
+        :return the count of tokens written back
+        """
+        with self.__lock:
+            pending = self.__pending
+            self.__pending = {}
+
+        if not pending:
+            return 0
+
+        try:
+            writer(pending)
+        except Exception:
+            # keep the extensions for next flush unless they are overwritten by newer ones
+            with self.__lock:
+                for token, expire_date in pending.iteritems():
+                    self.__pending.setdefault(token, expire_date)
+            raise
+
+        return len(pending)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__pending.clear()
@@ -33,20 +33,40 @@ import uuid
 
 from flask import request, g
 from mongoengine import Q, NotUniqueError, ValidationError
+from pymongo import UpdateOne
 
 from hackathon.hackathon_response import bad_request, internal_server_error, not_found, ok
 from hackathon.constants import HTTP_HEADER, HACK_USER_TYPE, FILE_TYPE
 from hackathon import Component, Context, RequiredFeature
 from hackathon.hmongo.models import UserToken, User, UserEmail, UserProfile, UserHackathon
+from hackathon.hmongo.batch_loader import get_loader
+from hackathon.util import safe_get_config
+from hackathon.cache.invalidation_bus import CacheInvalidationBus
+from token_cache import TokenCache
 
 __all__ = ["UserManager"]
 
 users_operation_time = {}
 
+# shared by all UserManager instances so that the token is validated against DB once per ttl instead of per request
+token_cache = TokenCache(capacity=safe_get_config("login.token_cache.capacity", 10000),
+                         ttl_seconds=safe_get_config("login.token_cache.ttl_seconds", 60))
+
 
 class UserManager(Component):
     """Component for user management"""
     admin_manager = RequiredFeature("admin_manager")
+    hackathon_manager = RequiredFeature("hackathon_manager")
+
+    def __init__(self):
+        # tokens revoked in current process are dropped from the token cache of other processes too
+        self.token_bus = None
+        if safe_get_config("cache.invalidation.enabled", False):
+            self.token_bus = CacheInvalidationBus(self.db,
+                                                  on_invalidate=token_cache.invalidate,
+                                                  on_clear=token_cache.clear,
+                                                  collection=safe_get_config("login.token_cache.invalidation_collection",
+                                                                             "token_invalidation"))
 
     def validate_login(self):
         """Make sure user token is included in http request headers and it must NOT be expired
@@ -69,10 +89,17 @@ class UserManager(Component):
 
     def logout(self, user_id):
         try:
+            # revoke the token of current request, in DB as well as in the token cache of every process
+            token = request.headers.get(HTTP_HEADER.TOKEN)
+            if token:
+                UserToken.objects(token=token).delete()
+                token_cache.invalidate(token)
+                if self.token_bus:
+                    self.token_bus.publish_invalidate(token)
+
             user = self.get_user_by_id(user_id)
             if user:
-                user.online = False
-                user.save()
+                self.__set_online(user, False)
             return ok()
         except Exception as e:
             self.log.error(e)
@@ -99,7 +126,8 @@ class UserManager(Component):
         else:
             time_interval = timedelta(hours=self.util.safe_get_config("login.token_valid_time_minutes", 60))
             new_toke_time = self.util.get_now() + time_interval
-            UserToken.objects(token=request.headers[HTTP_HEADER.TOKEN]).update(expire_date=new_toke_time)
+            # written back to DB in batch by flush_token_expire_dates
+            token_cache.touch(request.headers[HTTP_HEADER.TOKEN], new_toke_time)
 
         users_operation_time[user.id] = self.util.get_now()
 
@@ -111,10 +139,30 @@ class UserManager(Component):
                              if (self.util.get_now() - users_operation_time[user_id]).seconds > 3600]
         # 3600s- expire as token expire
 
-        User.objects(id__in=overtime_user_ids).update(online=False)
+        if overtime_user_ids:
+            # only users who are really online now are counted as offline
+            online_user_ids = [u.id for u in User.objects(id__in=overtime_user_ids, online=True).only("id")]
+            User.objects(id__in=online_user_ids).update(online=False)
+            self.hackathon_manager.increase_online_stat(online_user_ids, -1)
+
         for user_id in overtime_user_ids:
             users_operation_time.pop(user_id, "")
 
+    def flush_token_expire_dates(self):
+        """Write back the extended expire dates of tokens in cache. It's called by a scheduled job in every process"""
+
+        def update_expire_date(expire_dates):
+            # one bulk write, every token keeps its own expire date. Tokens are saved as UUID by the token field
+            token_field = UserToken._fields["token"]
+            UserToken._get_collection().bulk_write(
+                [UpdateOne({"token": token_field.to_mongo(token)}, {"$set": {"expire_date": expire_date}})
+                 for token, expire_date in expire_dates.iteritems()],
+                ordered=False)
+
+        count = token_cache.flush(update_expire_date)
+        if count:
+            self.log.debug("expire date of %d tokens written back" % count)
+
     def get_user_by_id(self, user_id):
         """Query user by unique id
 
@@ -157,18 +205,20 @@ class UserManager(Component):
         """
 
         keyword = args.get("keyword", "")
-        page = int(args.get("page", 1))
-        per_page = int(args.get("per_page", 20))
 
-        pagination = User.objects(
+        pagination = self.util.paginate_query(User.objects(
             Q(name__icontains=keyword) |
             Q(nickname__icontains=keyword) |
-            Q(emails__email__icontains=keyword)).paginate(page, per_page)
+            Q(emails__email__icontains=keyword)), args)
+
+        # the UserHackathon of all users in page in one query
+        rel_loader = get_loader(UserHackathon, key="user", hackathon=hackathon)
+        rel_loader.load_many(pagination.items)
 
         def get_user_details(user):
             user_info = self.user_display_info(user)
 
-            user_hackathon = UserHackathon.objects(hackathon=hackathon, user=user).first()
+            user_hackathon = rel_loader.load(user)
             user_info["role"] = user_hackathon.role if user_hackathon else HACK_USER_TYPE.VISITOR
             user_info["remark"] = user_hackathon.remark if user_hackathon else ""
 
@@ -280,15 +330,39 @@ class UserManager(Component):
         """
         if "authenticated" in g and g.authenticated:
             return g.user
-        else:
+
+        if self.token_bus:
+            self.token_bus.ensure_listening()
+
+        user_id = token_cache.get(token)
+        if user_id is None:
             # todo eliminate the warning related to 'objects'
-            t = UserToken.objects(token=token).first()
-            if t and t.expire_date >= self.util.get_now():
-                g.authenticated = True
-                g.user = t.user
-                return t.user
+            t = UserToken.objects(token=token).no_dereference().first()
+            if t and t.user and t.expire_date >= self.util.get_now():
+                user_id = t.user.id
+                token_cache.put(token, user_id, t.expire_date)
+
+        # the user is loaded per request, only the token is cached
+        user = User.objects(id=user_id).first() if user_id else None
+        if user is not None:
+            g.authenticated = True
+            g.user = user
+
+        return user
 
-        return None
+    def __set_online(self, user, online):
+        """Update the online status of user as well as the online stat of hackathons that user registered
+
+        :type user: User
+        :param user: the user who login or logout
+
+        :type online: bool
+        :param online: True if user login, False if logout
+        """
+        # only the request that really flips the flag is counted
+        if User.objects(id=user.id, online__ne=online).update_one(set__online=online):
+            self.hackathon_manager.increase_online_stat([user.id], 1 if online else -1)
+        user.online = online
 
     def __generate_api_token(self, admin):
         token_issue_date = self.util.get_now()
@@ -310,9 +384,9 @@ class UserManager(Component):
             self.log.warn("invalid user/pwd login: username=%s, encoded pwd=%s" % (username, enc_pwd))
             return None
 
-        user.online = True
         user.login_times = (user.login_times or 0) + 1
         user.save()
+        self.__set_online(user, True)
 
         token = self.__generate_api_token(user)
         return {
@@ -358,8 +432,8 @@ class UserManager(Component):
                 access_token=context.get("access_token", user.access_token),
                 avatar_url=context.get("avatar_url", user.avatar_url),
                 last_login_time=self.util.get_now(),
-                login_times=user.login_times + 1,
-                online=True)
+                login_times=user.login_times + 1)
+            self.__set_online(user, True)
             map(lambda x: self.__create_or_update_email(user, x), email_list)
         else:
             user = User(openid=openid,
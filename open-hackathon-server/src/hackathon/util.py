@@ -38,7 +38,7 @@ from datetime import datetime, timedelta
 from mailthon import email
 from mailthon.postman import Postman
 from mailthon.middleware import TLS, Auth
-from bson import ObjectId
+from bson import ObjectId, DBRef
 
 from hackathon_factory import RequiredFeature
 from hackathon.log import log
@@ -50,6 +50,8 @@ try:
 except ImportError:
     from config_sample import Config
 
+EPOCH = datetime.utcfromtimestamp(0)
+
 __all__ = [
     "get_config",
     "safe_get_config",
@@ -64,6 +66,7 @@ __all__ = [
     "DisabledSms",
     "ChinaTelecomSms",
     "make_serializable",
+    "make_raw_serializable",
 ]
 
 
@@ -85,6 +88,29 @@ def make_serializable(item):
         return item
 
 
+def make_raw_serializable(item):
+    """make a raw document from pymongo serializable, the same as make_serializable but without recursion
+
+    Nested dicts and lists are converted in place by walking them with a stack. DBRefs are converted to their ids.
+    """
+    root = [item]
+    stack = [root]
+    while stack:
+        container = stack.pop()
+        keys = container.iterkeys() if isinstance(container, dict) else xrange(len(container))
+        for k in keys:
+            v = container[k]
+            if isinstance(v, (dict, list)):
+                stack.append(v)
+            elif isinstance(v, datetime):
+                container[k] = long((v.replace(tzinfo=None) - EPOCH).total_seconds() * 1000)
+            elif isinstance(v, (ObjectId, UUID)):
+                container[k] = str(v)
+            elif isinstance(v, DBRef):
+                container[k] = str(v.id)
+    return root[0]
+
+
 def get_config(key):
     """Get configured value from configuration file according to specified key
 
@@ -227,14 +253,19 @@ class Utility(object):
             return False
         return v.lower() in ["yes", "true", "y", "t", "1"]
 
+    def is_error(self, resp):
+        """Whether a return value of managers is an error response made by hackathon_response"""
+        return isinstance(resp, dict) and "error" in resp
+
     def make_serializable(self, v):
         return make_serializable(v)
 
     def paginate(self, pagination, func=None):
         """Convert pagination results from DB to serializable dict
 
-        :type pagination: Pagination
-        :param pagination: object of Pagination defined in flask-SqlAlchemy
+        :type pagination: Pagination|CursorPagination
+        :param pagination: object of Pagination defined in flask-SqlAlchemy, or CursorPagination in hmongo. The
+            latter responds "cursor" and "next" instead of "page", "total" is None unless it's asked for
 
         :type func: function
         :param func: a function that to be applied to each item
@@ -243,12 +274,38 @@ class Utility(object):
         if func:
             items = map(lambda item: func(item), pagination.items)
 
-        return {
+        ret = {
             "items": items,
-            "page": pagination.page,
             "per_page": pagination.per_page,
             "total": pagination.total
         }
+        if hasattr(pagination, "next_cursor"):
+            ret["cursor"] = pagination.cursor
+            ret["next"] = pagination.next_cursor
+        else:
+            ret["page"] = pagination.page
+        return ret
+
+    def paginate_query(self, queryset, args, order_by="id", default_per_page=20):
+        """Paginate a query by page number, or by cursor if the client sends "cursor"(empty for the first page)
+
+        :type queryset: HQuerySet
+        :param queryset: the query, not ordered
+
+        :type args: dict|Context
+        :param args: args of request: page, per_page, cursor and with_total
+
+        :type order_by: str|unicode
+        :param order_by: the ordering key, e.g. '-create_time'
+
+        :rtype: Pagination|CursorPagination
+        """
+        per_page = int(args.get("per_page", default_per_page))
+        if "cursor" in args:
+            return queryset.paginate_by_cursor(args.get("cursor"), per_page, order_by,
+                                               self.str2bool(str(args.get("with_total", ""))))
+
+        return queryset.order_by(order_by).paginate(int(args.get("page", 1)), per_page)
 
     def is_local(self):
         return safe_get_config("environment", "local") == "local"
@@ -100,6 +100,7 @@ def init_routes():
     api.add_resource(AdminHackathonTemplateListResource,
                      "/api/admin/hackathon/template/list")  # get templates of hackathon
     api.add_resource(AdminHackathonTemplateResource, "/api/admin/hackathon/template")  # select template for hackathon
+    api.add_resource(AdminHackathonImagesResource, "/api/admin/hackathon/images")  # whether images pulled to hosts
     api.add_resource(AdminExperimentResource, "/api/admin/experiment")  # start expr by admin
     api.add_resource(AdminExperimentListResource, "/api/admin/experiment/list")  # get expr list of hackathon
     api.add_resource(HackathonAdminListResource, "/api/admin/hackathon/administrator/list")  # list admin/judges
@@ -594,6 +594,12 @@ class AdminHackathonTemplateResource(HackathonResource):
         return hackathon_template_manager.delete_template_from_hackathon(args['template_id'])
 
 
+class AdminHackathonImagesResource(HackathonResource):
+    @admin_privilege_required
+    def get(self):
+        return hackathon_template_manager.get_images_status(g.hackathon)
+
+
 class AdminExperimentResource(HackathonResource):
     @admin_privilege_required
     def post(self):
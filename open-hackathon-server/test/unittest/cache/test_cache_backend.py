@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+from mock import Mock
+
+# setup import path
+try:
+    import hackathon  # noqa
+except ImportError:
+    import os
+    import sys
+    BASE_DIR = os.path.dirname(__file__)
+    sys.path.append(os.path.realpath(os.path.join(BASE_DIR, "..", "..", "..", "src")))
+
+from hackathon.cache.cache_backend import MemoryCacheBackend, TieredCacheBackend
+
+
+class MemoryCacheBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = MemoryCacheBackend(capacity=2)
+
+    def test_get_set(self):
+        self.assertEqual((False, None), self.backend.get("a"))
+
+        self.backend.set("a", {"k": "v"}, 60)
+        self.assertEqual((True, {"k": "v"}), self.backend.get("a"))
+        self.assertEqual(1, self.backend.hits)
+        self.assertEqual(1, self.backend.misses)
+
+    def test_copy_on_read(self):
+        self.backend.set("a", {"k": "v"}, 60)
+        found, value = self.backend.get("a")
+        value["k"] = "changed"
+        self.assertEqual((True, {"k": "v"}), self.backend.get("a"))
+
+    def test_expire(self):
+        self.backend.set("a", 1, -1)
+        self.assertEqual((False, None), self.backend.get("a"))
+
+    def test_lru_eviction(self):
+        self.backend.set("a", 1, 60)
+        self.backend.set("b", 2, 60)
+        self.backend.get("a")
+        self.backend.set("c", 3, 60)
+
+        self.assertEqual((True, 1), self.backend.get("a"))
+        self.assertEqual((False, None), self.backend.get("b"))
+        self.assertEqual(1, self.backend.evictions)
+
+    def test_delete(self):
+        self.backend.set("a", 1, 60)
+        self.backend.delete("a")
+        self.assertEqual((False, None), self.backend.get("a"))
+
+
+class TieredCacheBackendTest(unittest.TestCase):
+    def test_promote_from_l2(self):
+        l1 = MemoryCacheBackend(capacity=10)
+        l2 = Mock()
+        l2.get.return_value = (True, "v")
+        backend = TieredCacheBackend(l1, l2)
+
+        self.assertEqual((True, "v"), backend.get("a"))
+        self.assertEqual((True, "v"), backend.get("a"))
+        self.assertEqual(1, l2.get.call_count)
+
+    def test_set_and_delete_both_levels(self):
+        l1 = MemoryCacheBackend(capacity=10)
+        l2 = Mock()
+        backend = TieredCacheBackend(l1, l2)
+
+        backend.set("a", 1, 60)
+        l2.set.assert_called_with("a", 1, 60)
+        backend.delete("a")
+        l2.delete.assert_called_with("a")
+        self.assertEqual((False, None), l1.get("a"))
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+from mock import Mock
+
+# setup import path
+try:
+    import hackathon  # noqa
+except ImportError:
+    import os
+    import sys
+    BASE_DIR = os.path.dirname(__file__)
+    sys.path.append(os.path.realpath(os.path.join(BASE_DIR, "..", "..", "..", "src")))
+
+from hackathon.hazure.utils import find_unassigned_endpoints
+from hackathon.hazure.endpoint_allocator import EndpointAllocator
+
+
+class EndpointAllocatorTest(unittest.TestCase):
+    def test_find_unassigned_endpoints(self):
+        self.assertEqual(find_unassigned_endpoints([80, "80", 22], ["80", 81, 23]), [82, 83, 22])
+        self.assertEqual(find_unassigned_endpoints([65535, 65535], [65535, 0]), [1, 2])
+
+    def test_allocate_loads_once(self):
+        load = Mock(return_value=[8080, 8081, 22])
+        allocator = EndpointAllocator(max_age_seconds=60)
+
+        self.assertEqual(allocator.allocate("cs", [8080, 22], load), [8082, 23])
+        self.assertEqual(allocator.allocate("cs", [8080], load), [8083])
+        self.assertEqual(load.call_count, 1)
+
+    def test_release_and_invalidate(self):
+        load = Mock(return_value=[8080])
+        allocator = EndpointAllocator(max_age_seconds=60)
+
+        self.assertEqual(allocator.allocate("cs", [8080], load), [8081])
+        allocator.release("cs", [8081])
+        self.assertEqual(allocator.allocate("cs", [8080], load), [8081])
+
+        allocator.invalidate("cs")
+        allocator.allocate("cs", [8080], load)
+        self.assertEqual(load.call_count, 2)
+
+    def test_expired_cache_is_reloaded(self):
+        load = Mock(return_value=[])
+        allocator = EndpointAllocator(max_age_seconds=-1)
+
+        allocator.allocate("cs", [8080], load)
+        allocator.allocate("cs", [8080], load)
+        self.assertEqual(load.call_count, 2)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+
+from bson import ObjectId
+from mock import patch, MagicMock
+
+# setup import path
+try:
+    import hackathon  # noqa
+except ImportError:
+    import os
+    import sys
+    BASE_DIR = os.path.dirname(__file__)
+    sys.path.append(os.path.realpath(os.path.join(BASE_DIR, "..", "..", "..", "src")))
+
+from hackathon.hmongo.models import User, UserHackathon
+from hackathon.hmongo.batch_loader import BatchLoader, get_loader
+
+
+def queryset(document, rows):
+    qs = MagicMock()
+    qs._document = document
+    # copies, so that a test can see whether the raw rows are reused
+    qs.as_pymongo.side_effect = lambda: [dict(row) for row in rows]
+    return qs
+
+
+class BatchLoaderTest(unittest.TestCase):
+    def setUp(self):
+        self.ids = [ObjectId() for i in range(3)]
+        self.rows = [{"_id": oid, "name": "user%d" % i} for i, oid in enumerate(self.ids)]
+
+    def test_load_many(self):
+        with patch.object(User, "objects") as objects:
+            objects.return_value = queryset(User, self.rows)
+            missing = ObjectId()
+            users = BatchLoader(User).load_many([self.ids[2], None, missing, self.ids[0], self.ids[2]])
+
+            self.assertEqual(1, objects.call_count)
+            self.assertEqual(set([self.ids[0], self.ids[2], missing]), set(objects.call_args[1]["id__in"]))
+            self.assertEqual(["user2", None, None, "user0", "user2"], [u and u.name for u in users])
+            self.assertTrue(isinstance(users[0], User))
+
+    def test_memoized(self):
+        with patch.object(User, "objects") as objects:
+            objects.return_value = queryset(User, self.rows)
+            loader = BatchLoader(User)
+            loader.load_many(self.ids[:2] + [ObjectId()])
+            first = loader.load(self.ids[0])
+
+            self.assertEqual(1, objects.call_count)
+            self.assertTrue(first is loader.load(self.ids[0]))
+
+            loader.load(self.ids[2])
+            self.assertEqual(2, objects.call_count)
+            self.assertEqual([self.ids[2]], objects.call_args[1]["id__in"])
+
+    def test_load_by_reference(self):
+        hackathon_id = ObjectId()
+        rows = [{"_id": ObjectId(), "user": oid, "hackathon": hackathon_id, "role": i}
+                for i, oid in enumerate(self.ids)]
+        with patch.object(UserHackathon, "objects") as objects:
+            objects.return_value = queryset(UserHackathon, rows)
+            rels = BatchLoader(UserHackathon, key="user", hackathon=hackathon_id).load_many(
+                [User(id=self.ids[1]), self.ids[0]])
+
+            self.assertEqual(hackathon_id, objects.call_args[1]["hackathon"])
+            self.assertEqual([1, 0], [rel.role for rel in rels])
+
+    def test_resolve(self):
+        missing = ObjectId()
+        rows = [{"_id": ObjectId(), "user": oid, "role": 1} for oid in self.ids[:2] + [missing]]
+        with patch.object(User, "objects") as objects:
+            objects.return_value = queryset(User, self.rows)
+            rels = BatchLoader(User).resolve(queryset(UserHackathon, rows), "user")
+
+            self.assertEqual(1, objects.call_count)
+            self.assertEqual(["user0", "user1"], [rel.user.name for rel in rels[:2]])
+            self.assertTrue(all(isinstance(rel, UserHackathon) for rel in rels))
+            # not found, left to be dereferenced
+            self.assertEqual(missing, rels[2].to_mongo()["user"])
+
+    def test_get_loader_out_of_request(self):
+        self.assertFalse(get_loader(User) is get_loader(User))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+from datetime import datetime
+
+from bson import ObjectId
+from werkzeug.exceptions import BadRequest
+
+# setup import path
+try:
+    import hackathon  # noqa
+except ImportError:
+    import os
+    import sys
+    BASE_DIR = os.path.dirname(__file__)
+    sys.path.append(os.path.realpath(os.path.join(BASE_DIR, "..", "..", "..", "src")))
+
+from hackathon.hmongo.models import HackathonNotice
+from hackathon.hmongo.pagination import encode_cursor, decode_cursor, _after
+
+NOW = datetime(2016, 5, 1, 3, 4, 5, 123000)
+
+
+class CursorCodecTest(unittest.TestCase):
+    def test_round_trip(self):
+        oid = ObjectId()
+        for value in [NOW, ObjectId(), 3, u"name", None]:
+            self.assertEqual((value, oid), decode_cursor(encode_cursor(value, oid)))
+
+    def test_url_safe(self):
+        cursor = encode_cursor(u"a/b+c?", ObjectId())
+        self.assertFalse(any(c in cursor for c in "+/?&"))
+
+    def test_bad_cursor(self):
+        self.assertRaises(BadRequest, decode_cursor, "not a cursor")
+        self.assertRaises(BadRequest, decode_cursor, encode_cursor(1, ObjectId())[:-4])
+        self.assertRaises(BadRequest, decode_cursor, encode_cursor(1, "not an id"))
+
+
+class AfterTest(unittest.TestCase):
+    def query(self, field, descending, value, last_id):
+        return _after(field, descending, value, last_id).to_query(HackathonNotice)
+
+    def test_by_id(self):
+        oid = ObjectId()
+        self.assertEqual({"_id": {"$lt": oid}}, self.query("id", True, None, oid))
+        self.assertEqual({"_id": {"$gt": oid}}, self.query("id", False, None, oid))
+
+    def test_descending(self):
+        oid = ObjectId()
+        # smaller keys, ties with smaller ids, then nulls which are sorted last
+        self.assertEqual({"$or": [{"update_time": {"$lt": NOW}},
+                                  {"update_time": NOW, "_id": {"$lt": oid}},
+                                  {"update_time": None}]},
+                         self.query("update_time", True, NOW, oid))
+
+    def test_ascending(self):
+        oid = ObjectId()
+        self.assertEqual({"$or": [{"category": {"$gt": 1}},
+                                  {"category": 1, "_id": {"$gt": oid}}]},
+                         self.query("category", False, 1, oid))
+
+    def test_descending_after_null(self):
+        oid = ObjectId()
+        # nulls are the last ones, only the tie remains
+        self.assertEqual({"update_time": None, "_id": {"$lt": oid}}, self.query("update_time", True, None, oid))
+
+    def test_ascending_after_null(self):
+        oid = ObjectId()
+        # nulls are the first ones, followed by all the non-null keys
+        self.assertEqual({"$or": [{"category": None, "_id": {"$gt": oid}},
+                                  {"category": {"$ne": None}}]},
+                         self.query("category", False, None, oid))
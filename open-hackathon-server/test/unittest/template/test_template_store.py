@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, Mock
+
+# setup import path
+try:
+    import hackathon  # noqa
+except ImportError:
+    import sys
+    BASE_DIR = os.path.dirname(__file__)
+    sys.path.append(os.path.realpath(os.path.join(BASE_DIR, "..", "..", "..", "src")))
+
+from hackathon.template.template_store import TemplateStore, hash_template
+
+URL = "http://storage/templates/ubuntu.js"
+TEMPLATE = {"name": "ubuntu", "virtual_environments": [{"name": "vm", "ports": [22]}]}
+
+
+def response(status_code, content=None, headers=None):
+    resp = Mock()
+    resp.status_code = status_code
+    resp.content = json.dumps(content) if content is not None else ""
+    resp.headers = headers or {}
+    if status_code >= 400:
+        resp.raise_for_status.side_effect = Exception(status_code)
+    return resp
+
+
+class TemplateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.store = TemplateStore(self.base_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_hash_canonical(self):
+        reordered = json.loads(json.dumps(TEMPLATE, sort_keys=True, indent=4))
+        self.assertEqual(hash_template(TEMPLATE), hash_template(reordered))
+        self.assertNotEqual(hash_template(TEMPLATE)[0], hash_template({"name": "windows"})[0])
+
+    def test_put_get(self):
+        content_hash = self.store.put(TEMPLATE)
+        self.assertEqual(hash_template(TEMPLATE)[0], content_hash)
+        self.assertEqual(TEMPLATE, self.store.get(content_hash))
+        self.assertEqual(content_hash, self.store.put(dict(TEMPLATE)))
+        # no temporary file left
+        self.assertEqual(["%s.json" % content_hash], os.listdir(self.store.objects_dir))
+
+    def test_get_missing(self):
+        self.assertIsNone(self.store.get("0" * 40))
+        self.assertIsNone(self.store.get(None))
+
+    @patch("hackathon.template.template_store.requests.get")
+    def test_fetch(self, get):
+        get.return_value = response(200, TEMPLATE, {"ETag": '"v1"', "Last-Modified": "Sun, 01 May 2016 03:04:05 GMT"})
+
+        content_hash, content = self.store.fetch(URL)
+
+        self.assertEqual(TEMPLATE, content)
+        self.assertEqual(TEMPLATE, self.store.get(content_hash))
+        self.assertEqual({}, get.call_args[1]["headers"])
+
+    @patch("hackathon.template.template_store.requests.get")
+    def test_revalidate_not_modified(self, get):
+        get.return_value = response(200, TEMPLATE, {"ETag": '"v1"', "Last-Modified": "Sun, 01 May 2016 03:04:05 GMT"})
+        content_hash = self.store.fetch(URL)[0]
+
+        get.return_value = response(304)
+        self.assertEqual((content_hash, TEMPLATE), self.store.fetch(URL))
+        self.assertEqual({"If-None-Match": '"v1"', "If-Modified-Since": "Sun, 01 May 2016 03:04:05 GMT"},
+                         get.call_args[1]["headers"])
+        self.assertEqual(2, get.call_count)
+
+    @patch("hackathon.template.template_store.requests.get")
+    def test_revalidate_modified(self, get):
+        get.return_value = response(200, TEMPLATE, {"ETag": '"v1"'})
+        old_hash = self.store.fetch(URL)[0]
+
+        changed = dict(TEMPLATE, name="ubuntu-16")
+        get.return_value = response(200, changed, {"ETag": '"v2"'})
+        content_hash, content = self.store.fetch(URL)
+
+        self.assertNotEqual(old_hash, content_hash)
+        self.assertEqual(changed, content)
+        # the old version is kept for templates still referring to it
+        self.assertEqual(TEMPLATE, self.store.get(old_hash))
+
+        get.return_value = response(304)
+        self.store.fetch(URL)
+        self.assertEqual({"If-None-Match": '"v2"'}, get.call_args[1]["headers"])
+
+    @patch("hackathon.template.template_store.requests.get")
+    def test_local_copy_removed(self, get):
+        get.return_value = response(200, TEMPLATE, {"ETag": '"v1"'})
+        content_hash = self.store.fetch(URL)[0]
+        os.remove(os.path.join(self.store.objects_dir, "%s.json" % content_hash))
+
+        # no conditional request without the local copy
+        self.assertEqual((content_hash, TEMPLATE), self.store.fetch(URL))
+        self.assertEqual({}, get.call_args[1]["headers"])
+
+    @patch("hackathon.template.template_store.requests.get")
+    def test_fetch_error(self, get):
+        get.return_value = response(404)
+        self.assertRaises(Exception, self.store.fetch, URL)
+        self.assertEqual([], os.listdir(self.store.refs_dir))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+import cPickle as pickle
+from datetime import datetime
+from decimal import Decimal
+
+from bson import ObjectId
+
+# setup import path
+try:
+    import hackathon  # noqa
+except ImportError:
+    import os
+    import sys
+    BASE_DIR = os.path.dirname(__file__)
+    sys.path.append(os.path.realpath(os.path.join(BASE_DIR, "..", "..", "src")))
+
+from hackathon.context import Context
+from hackathon.context_codec import encode_context, decode_context, CODEC_VERSION
+
+
+class ContextCodecTest(unittest.TestCase):
+    def round_trip(self, context):
+        data = encode_context(context)
+        self.assertTrue(data.startswith(CODEC_VERSION))
+        return decode_context(data)
+
+    def test_plain_values(self):
+        ctx = self.round_trip(Context(s="str", u=u"开放黑客松", i=1, l=10L ** 20, f=1.5, b=True, n=None,
+                                      items=[1, "a", None]))
+        self.assertEqual(u"str", ctx.s)
+        self.assertEqual(u"开放黑客松", ctx.u)
+        self.assertEqual(1, ctx.i)
+        self.assertEqual(10L ** 20, ctx.l)
+        self.assertEqual(1.5, ctx.f)
+        self.assertTrue(ctx.b)
+        self.assertIsNone(ctx.n)
+        self.assertEqual([1, u"a", None], ctx.items)
+
+    def test_tagged_values(self):
+        oid = ObjectId()
+        now = datetime(2016, 5, 1, 3, 4, 5, 123456)
+        raw = "\xff\x00\x01"
+        ctx = self.round_trip(Context(oid=oid, date=now, raw=raw, dic={"port": 22, "name": "ssh"}))
+
+        self.assertEqual(oid, ctx.oid)
+        self.assertEqual(now, ctx.date)
+        self.assertEqual(raw, ctx.raw)
+        self.assertIsInstance(ctx.dic, dict)
+        self.assertEqual({"port": 22, "name": "ssh"}, ctx.dic)
+
+    def test_nested_context(self):
+        oid = ObjectId()
+        ctx = self.round_trip(Context(experiment_id=oid, ve=Context(name="ve", ports=[Context(port=22)])))
+
+        self.assertIsInstance(ctx.ve, Context)
+        self.assertEqual(oid, ctx.experiment_id)
+        self.assertEqual(u"ve", ctx.ve.name)
+        self.assertIsInstance(ctx.ve.ports[0], Context)
+        self.assertEqual(22, ctx.ve.ports[0].port)
+
+    def test_pickle_fallback(self):
+        ctx = self.round_trip(Context(amount=Decimal("1.5"), dic={1: "non-string key"}))
+        self.assertEqual(Decimal("1.5"), ctx.amount)
+        self.assertEqual({1: "non-string key"}, ctx.dic)
+
+    def test_legacy_pickles(self):
+        oid = ObjectId()
+        for protocol in [0, 2]:
+            data = pickle.dumps(Context(experiment_id=oid, nested=Context(a=1)), protocol)
+            self.assertFalse(data.startswith(CODEC_VERSION))
+
+            ctx = decode_context(data)
+            self.assertEqual(oid, ctx.experiment_id)
+            self.assertEqual(1, ctx.nested.a)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Copyright (c) Microsoft Open Technologies (Shanghai) Co. Ltd.  All rights reserved.
+
+The MIT License (MIT)
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+from datetime import datetime, timedelta
+from mock import Mock, patch
+
+# setup import path
+try:
+    import hackathon  # noqa
+except ImportError:
+    import os
+    import sys
+    BASE_DIR = os.path.dirname(__file__)
+    sys.path.append(os.path.realpath(os.path.join(BASE_DIR, "..", "..", "..", "src")))
+
+from hackathon.user.token_cache import TokenCache
+
+NOW = datetime(2016, 1, 1, 12, 0, 0)
+
+
+class TokenCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = NOW
+        self.patcher = patch("hackathon.user.token_cache.get_now", lambda: self.now)
+        self.patcher.start()
+        self.cache = TokenCache(capacity=2, ttl_seconds=60)
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("a"))
+
+        self.cache.put("a", 1, NOW + timedelta(hours=1))
+        self.assertEqual(1, self.cache.get("a"))
+
+    def test_lru_eviction(self):
+        self.cache.put("a", 1, NOW + timedelta(hours=1))
+        self.cache.put("b", 2, NOW + timedelta(hours=1))
+        self.cache.get("a")
+        self.cache.put("c", 3, NOW + timedelta(hours=1))
+
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("c"))
+
+    def test_ttl(self):
+        self.cache.put("a", 1, NOW + timedelta(hours=1))
+        self.now = NOW + timedelta(seconds=61)
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_expired_token(self):
+        self.cache.put("a", 1, NOW + timedelta(seconds=10))
+        self.now = NOW + timedelta(seconds=11)
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_touch_extends_cached_token(self):
+        self.cache.put("a", 1, NOW + timedelta(seconds=10))
+        self.cache.touch("a", NOW + timedelta(seconds=30))
+        self.now = NOW + timedelta(seconds=20)
+        self.assertIsNotNone(self.cache.get("a"))
+
+    def test_put_keeps_pending_extension(self):
+        self.cache.touch("a", NOW + timedelta(hours=2))
+        # reloaded from DB before the extension is written back
+        self.cache.put("a", 1, NOW + timedelta(seconds=10))
+        self.now = NOW + timedelta(seconds=20)
+        self.assertIsNotNone(self.cache.get("a"))
+
+    def test_flush_writes_expire_date_per_token(self):
+        self.cache.touch("a", NOW + timedelta(minutes=1))
+        self.cache.touch("b", NOW + timedelta(minutes=5))
+        self.cache.touch("a", NOW + timedelta(minutes=2))
+
+        writer = Mock()
+        self.assertEqual(2, self.cache.flush(writer))
+        writer.assert_called_once_with({"a": NOW + timedelta(minutes=2), "b": NOW + timedelta(minutes=5)})
+
+        # nothing pending any more
+        self.assertEqual(0, self.cache.flush(writer))
+        self.assertEqual(1, writer.call_count)
+
+    def test_flush_failure_keeps_pending(self):
+        self.cache.touch("a", NOW + timedelta(minutes=1))
+        self.assertRaises(Exception, self.cache.flush, Mock(side_effect=Exception("db down")))
+
+        writer = Mock()
+        self.assertEqual(1, self.cache.flush(writer))
+        writer.assert_called_once_with({"a": NOW + timedelta(minutes=1)})
+
+    def test_invalidate(self):
+        self.cache.put("a", 1, NOW + timedelta(hours=1))
+        self.cache.put("b", 1, NOW + timedelta(hours=1))
+        self.cache.touch("a", NOW + timedelta(hours=2))
+        self.cache.invalidate("a")
+
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(1, self.cache.get("b"))
+        writer = Mock()
+        self.assertEqual(0, self.cache.flush(writer))
+
+    def test_invalidate_user(self):
+        self.cache.put("a", 1, NOW + timedelta(hours=1))
+        self.cache.touch("a", NOW + timedelta(hours=2))
+        self.cache.invalidate_user(1)
+
+        self.assertIsNone(self.cache.get("a"))
+        writer = Mock()
+        self.assertEqual(0, self.cache.flush(writer))
+        self.assertFalse(writer.called)